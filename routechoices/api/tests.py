@@ -1,8 +1,10 @@
 import json
 import random
 import time
+from unittest.mock import patch
 
 import arrow
+import gps_data_codec
 from allauth.account.models import EmailAddress
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -739,6 +741,66 @@ class LocationApiTestCase(EssentialApiBase):
         nb_points = len(Device.objects.get(aid=dev_id).locations["timestamps"])
         self.assertEqual(nb_points, 4)
 
+    def test_locations_api_gw_encoded(self):
+        dev_id = self.get_device_id()
+        t = int(time.time())
+        res = self.client.post(
+            self.url,
+            {
+                "device_id": dev_id,
+                "encoded_data": gps_data_codec.encode(
+                    [(t, 1.1, 3.1), (t + 1, 1.2, 3.2), (t + 2, 1.3, 3.3)]
+                ),
+                "secret": settings.POST_LOCATION_SECRETS[0],
+            },
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data.get("location_count"), 3)
+        device = Device.objects.get(aid=dev_id)
+        self.assertEqual(device.locations["latitudes"], [1.1, 1.2, 1.3])
+        res = self.client.post(
+            self.url,
+            {
+                "device_id": dev_id,
+                "encoded_data": gps_data_codec.encode([(t + 3, 91, 3.1)]),
+                "secret": settings.POST_LOCATION_SECRETS[0],
+            },
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = json.loads(res.content)
+        self.assertIn("Invalid latitude value", errors[0])
+
+    def test_locations_api_gw_archived_event(self):
+        device = Device.objects.create()
+        club = Club.objects.create(name="Test club", slug="club")
+        event = Event.objects.create(
+            club=club,
+            name="Past event",
+            start_date=arrow.get().shift(hours=-3).datetime,
+            end_date=arrow.get().shift(hours=-2).datetime,
+        )
+        Competitor.objects.create(
+            name="Alice", short_name="A", event=event, device=device
+        )
+        t = arrow.get().shift(hours=-2, minutes=-30).int_timestamp
+        with patch.object(
+            Device, "get_events_between_dates", return_value=set()
+        ) as mock_get_events:
+            # Live data, no ended event is affected, no need to look for them
+            device.add_locations([(int(time.time()), 1.1, 3.1)])
+            mock_get_events.assert_not_called()
+            # Data uploaded late during an ended event
+            device.add_locations([(t, 1.1, 3.1)])
+            mock_get_events.assert_called_once()
+        # Ended events windows are updated when the event is edited
+        event.end_date = arrow.get().shift(hours=-3).datetime
+        event.save()
+        with patch.object(
+            Device, "get_events_between_dates", return_value=set()
+        ) as mock_get_events:
+            device.add_locations([(t + 1, 1.1, 3.1)])
+            mock_get_events.assert_not_called()
+
     def test_locations_api_gw_invalid_cast(self):
         dev_id = self.get_device_id()
         t = time.time()
@@ -757,6 +819,43 @@ class LocationApiTestCase(EssentialApiBase):
         self.assertEqual(len(errors), 1)
         self.assertIn("Invalid data format", errors[0])
 
+    def test_locations_api_gw_invalid_type(self):
+        dev_id = self.get_device_id()
+        t = time.time()
+        for latitudes in ([[1.1], [1.2]], [{"lat": 1.1}, 1.2]):
+            res = self.client.post(
+                self.url,
+                {
+                    "device_id": dev_id,
+                    "latitudes": latitudes,
+                    "longitudes": [3.1, 3.2],
+                    "timestamps": [t, t + 1],
+                    "secret": settings.POST_LOCATION_SECRETS[0],
+                },
+                format="json",
+            )
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            errors = json.loads(res.content)
+            self.assertIn("Invalid data format", errors[0])
+
+    def test_locations_api_gw_invalid_timestamp(self):
+        dev_id = self.get_device_id()
+        t = time.time()
+        for timestamps in (f"{t},1e19", f"{t},-1e19", f"{t},-1"):
+            res = self.client.post(
+                self.url,
+                {
+                    "device_id": dev_id,
+                    "latitudes": "1.1,1.2",
+                    "longitudes": "3.1,3.2",
+                    "timestamps": timestamps,
+                    "secret": settings.POST_LOCATION_SECRETS[0],
+                },
+            )
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            errors = json.loads(res.content)
+            self.assertIn("Invalid timestamp value", errors[0])
+
     def test_locations_api_gw_invalid_lon(self):
         dev_id = self.get_device_id()
         t = time.time()
@@ -881,6 +980,95 @@ class LocationApiTestCase(EssentialApiBase):
         self.assertIn("No such device ID", errors[0])
 
 
+class LocationBulkApiTestCase(EssentialApiBase):
+    def setUp(self):
+        super().setUp()
+        self.url = self.reverse_and_check("locations_bulk_api_gw", "/locations/bulk")
+
+    def test_locations_bulk_api_gw(self):
+        dev_id = self.get_device_id()
+        dev_id_2 = self.get_device_id()
+        t = int(time.time())
+        res = self.client.post(
+            self.url,
+            {
+                "devices": [
+                    {
+                        "device_id": dev_id,
+                        "latitudes": [1.1, 1.2],
+                        "longitudes": [3.1, 3.2],
+                        "timestamps": [t, t + 1],
+                        "battery": 75,
+                    },
+                    {
+                        "device_id": dev_id_2,
+                        "encoded_data": gps_data_codec.encode(
+                            [(t, 1.1, 3.1), (t + 1, 1.2, 3.2), (t + 2, 1.3, 3.3)]
+                        ),
+                    },
+                    {
+                        "device_id": dev_id,
+                        "latitudes": "1.3",
+                        "longitudes": "3.3",
+                        "timestamps": f"{t + 2}",
+                    },
+                    {
+                        "device_id": "doesnotexist",
+                        "latitudes": [1.1],
+                        "longitudes": [3.1],
+                        "timestamps": [t],
+                    },
+                    {
+                        "device_id": dev_id_2,
+                        "latitudes": [1.1],
+                        "longitudes": [182],
+                        "timestamps": [t + 3],
+                    },
+                ],
+                "secret": settings.POST_LOCATION_SECRETS[0],
+            },
+            format="json",
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        results = res.data["results"]
+        self.assertEqual(
+            [r["status"] for r in results], ["ok", "ok", "ok", "error", "error"]
+        )
+        self.assertEqual(results[1]["location_count"], 3)
+        self.assertEqual(results[3]["error"], "No such device ID")
+        self.assertEqual(results[4]["error"], "Invalid longitude value")
+        device = Device.objects.get(aid=dev_id)
+        self.assertEqual(device.location_count, 3)
+        self.assertEqual(device.battery_level, 75)
+        self.assertEqual(Device.objects.get(aid=dev_id_2).location_count, 3)
+
+    def test_locations_bulk_api_gw_bad_secret(self):
+        d = Device.objects.create(aid="12345678")
+        t = int(time.time())
+        res = self.client.post(
+            self.url,
+            {
+                "devices": [
+                    {
+                        "device_id": d.aid,
+                        "latitudes": [1.1],
+                        "longitudes": [3.1],
+                        "timestamps": [t],
+                    },
+                ],
+                "secret": "bad secret",
+            },
+            format="json",
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data["results"][0]["error"], "Authentication Failed")
+        self.assertEqual(Device.objects.get(aid=d.aid).location_count, 0)
+
+    def test_locations_bulk_api_gw_no_devices(self):
+        res = self.client.post(self.url, {}, format="json")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class RouteUploadApiTestCase(EssentialApiBase):
     def setUp(self):
         super().setUp()
@@ -30,6 +30,11 @@ urlpatterns = [
     re_path(r"^device_id/?$", views.get_device_id, name="device_id_api"),  # deprecated
     re_path(r"^device/?$", views.create_device_id, name="device_api"),
     re_path(r"^locations/?$", views.locations_api_gw, name="locations_api_gw"),
+    re_path(
+        r"^locations/bulk/?$",
+        views.locations_bulk_api_gw,
+        name="locations_bulk_api_gw",
+    ),
     re_path(r"^time/?$", views.get_time, name="time_api"),
     re_path(r"^search/device/?$", views.device_search, name="device_search_api"),
     re_path(r"^search/user/?$", views.user_search, name="user_search_api"),
@@ -96,6 +101,11 @@ urlpatterns = [
         views.event_data,
         name="event_data",
     ),
+    re_path(
+        r"^events/(?P<event_id>[0-9a-zA-Z_-]+)/routes/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.cbor$",
+        views.event_route_tile,
+        name="event_route_tile",
+    ),
     re_path(
         r"^events/(?P<event_id>[0-9a-zA-Z_-]+)/zip/?$",
         views.event_zip,
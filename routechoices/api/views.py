@@ -9,6 +9,7 @@ from zipfile import ZipFile
 
 import arrow
 import gps_data_codec
+import numpy as np
 import orjson as json
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
@@ -16,7 +17,6 @@ from django.contrib.auth.models import User
 from django.contrib.gis.geoip2 import GeoIP2
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db.models import Prefetch, Q
 from django.http import HttpResponse
 from django.http.response import Http404
@@ -62,6 +62,7 @@ from routechoices.lib.helpers import (
     short_random_key,
     short_random_slug,
 )
+from routechoices.lib.route_tiles import encode_route_tile
 from routechoices.lib.s3 import s3_object_url
 from routechoices.lib.streaming_response import StreamingHttpRangeResponse
 from routechoices.lib.third_party_downloader import GpsSeurantaNet
@@ -80,6 +81,10 @@ api_GET_HEAD_view = api_view(["GET", "HEAD"])
 api_POST_view = api_view(["POST"])
 api_GET_POST_view = api_view(["GET", "POST"])
 
+MAX_BULK_LOCATIONS_DEVICES = 500
+# Unix timestamps of locations fit in 32 bits unsigned, until year 2106
+MAX_LOCATION_TIMESTAMP = 2**32
+
 
 class PostDataThrottle(AnonRateThrottle):
     rate = "70/min"
@@ -90,6 +95,72 @@ class PostDataThrottle(AnonRateThrottle):
         return super().allow_request(request, view)
 
 
+def parse_locations_values(values):
+    if isinstance(values, str):
+        values = values.split(",")
+    elif not isinstance(values, list):
+        raise ValueError("Invalid values")
+    values = [x for x in values if x not in ("", None)]
+    # Nested lists or objects would not be converted to a flat array
+    if not all(isinstance(x, (str, int, float)) for x in values):
+        raise ValueError("Invalid values")
+    return np.array(values, dtype=np.float64)
+
+
+def parse_locations(data):
+    """Parse and validate the locations posted for a device"""
+    encoded_data = data.get("encoded_data")
+    if encoded_data:
+        try:
+            locations = gps_data_codec.decode(encoded_data)
+            locations = np.array(locations, dtype=np.float64).reshape(-1, 3)
+        except BaseException:
+            # The codec panics (not an Exception subclass) on malformed data
+            raise ValidationError("Invalid data format")
+        times = locations[:, LOCATION_TIMESTAMP_INDEX]
+        lats = locations[:, LOCATION_LATITUDE_INDEX]
+        lons = locations[:, LOCATION_LONGITUDE_INDEX]
+    else:
+        try:
+            lats = parse_locations_values(data.get("latitudes", ""))
+            lons = parse_locations_values(data.get("longitudes", ""))
+            times = parse_locations_values(data.get("timestamps", ""))
+        except (TypeError, ValueError):
+            raise ValidationError("Invalid data format")
+    if not (len(lats) == len(lons) == len(times)):
+        raise ValidationError(
+            "Latitudes, longitudes, and timestamps, should have same amount of points"
+        )
+    if not np.isfinite(times).all():
+        raise ValidationError("Invalid data format")
+    # Larger values would wrap around when cast to integers
+    if not ((times >= 0) & (times < MAX_LOCATION_TIMESTAMP)).all():
+        raise ValidationError("Invalid timestamp value")
+    times = times.astype(np.int64)
+    # Points with a null coordinate or timestamp are ignored
+    valid = (times != 0) & (lats != 0) & (lons != 0)
+    times, lats, lons = times[valid], lats[valid], lons[valid]
+    # Written so that NaN values fail the checks
+    if not (np.abs(lons) <= 180).all():
+        raise ValidationError("Invalid longitude value")
+    if not (np.abs(lats) <= 90).all():
+        raise ValidationError("Invalid latitude value")
+    return list(zip(times.tolist(), lats.tolist(), lons.tolist()))
+
+
+def parse_battery_level(value):
+    # Invalid values are ignored to stay compatible with legacy apps
+    if not value:
+        return None
+    try:
+        battery_level = int(value)
+    except Exception:
+        return None
+    if battery_level < 0 or battery_level > 100:
+        return None
+    return battery_level
+
+
 def serve_from_s3(
     bucket,
     request,
@@ -589,8 +660,18 @@ def event_detail(request, event_id):
         "maps": [],
     }
 
+    if event.ended:
+        output["route_tiles_url"] = request.build_absolute_uri(
+            reverse(
+                "event_route_tile",
+                host="api",
+                kwargs={"event_id": event.aid, "z": 0, "x": 0, "y": 0},
+            )
+        ).replace("/0/0/0.cbor", "/{z}/{x}/{y}.cbor")
+
     if event.start_date < now():
         output["announcement"] = event.notice.text if event.has_notice else ""
+        is_private = event.privacy == PRIVACY_PRIVATE
 
         if event.map:
             map_data = {
@@ -602,6 +683,10 @@ def event_detail(request, event_id):
                 "modification_date": event.map.modification_date,
                 "default": True,
                 "id": event.map.aid,
+                "tiles_url": (
+                    f"{request.scheme}:"
+                    f"{event.map.get_tiles_url(private=is_private)}"
+                ),
                 "url": request.build_absolute_uri(
                     reverse(
                         "event_map_download",
@@ -622,6 +707,9 @@ def event_detail(request, event_id):
                 "modification_date": m.map.modification_date,
                 "default": False,
                 "id": m.map.aid,
+                "tiles_url": (
+                    f"{request.scheme}:{m.map.get_tiles_url(private=is_private)}"
+                ),
                 "url": request.build_absolute_uri(
                     reverse(
                         "event_map_download",
@@ -1179,6 +1267,42 @@ def event_data(request, event_id):
     return Response(response, headers=headers)
 
 
+@swagger_auto_schema(
+    method="get",
+    auto_schema=None,
+)
+@api_GET_view
+def event_route_tile(request, event_id, z, x, y):
+    """
+    Tracks of the competitors of an archived event crossing a z/x/y tile,
+    clipped and simplified for its zoom level and encoded as CBOR
+    """
+    event = get_object_or_404(
+        Event.objects.select_related("club"), aid=event_id, end_date__lt=now()
+    )
+    event.check_user_permission(request.user)
+    z, x, y = int(z), int(x), int(y)
+    if z > 30 or x >= 2**z or y >= 2**z:
+        raise Http404()
+
+    cache_key = f"event:{event.aid}:routes:{event.routes_version}:tile:{z}:{x}:{y}"
+    try:
+        data = cache.get(cache_key)
+    except Exception:
+        data = None
+    if data is None:
+        data = encode_route_tile(event.routes_tracks(z), z, x, y)
+        try:
+            cache.set(cache_key, data, 7 * 24 * 3600)
+        except Exception:
+            pass
+
+    headers = {"ETag": f'W/"{safe64encodedsha(data)}"'}
+    if event.privacy == PRIVACY_PRIVATE:
+        headers["Cache-Control"] = "Private"
+    return HttpResponse(data, content_type="application/cbor", headers=headers)
+
+
 @swagger_auto_schema(
     method="get",
     auto_schema=None,
@@ -1280,13 +1404,21 @@ def ip_latlon(request):
                 ),
                 example="1661489045,1661489046,1661489047",
             ),
+            "encoded_data": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description=(
+                    "Locations encoded with gps_data_codec, "
+                    "replaces latitudes, longitudes and timestamps"
+                ),
+                example="jn|sfjA_zuE_n|QA_pR_pR",
+            ),
             "battery": openapi.Schema(
                 type=openapi.TYPE_INTEGER,
                 description="Battery load percentage value",
                 example="85",
             ),
         },
-        required=["device_id", "latitudes", "longitudes", "timestamps"],
+        required=["device_id"],
     ),
     responses={
         "201": openapi.Response(
@@ -1330,48 +1462,11 @@ def locations_api_gw(request):
     if not device.user_agent or device_user_agent != device.user_agent:
         device.user_agent = device_user_agent
 
-    try:
-        lats = [float(x) for x in request.data.get("latitudes", "").split(",") if x]
-        lons = [float(x) for x in request.data.get("longitudes", "").split(",") if x]
-        times = [
-            int(float(x)) for x in request.data.get("timestamps", "").split(",") if x
-        ]
-    except ValueError:
-        raise ValidationError("Invalid data format")
-    if not (len(lats) == len(lons) == len(times)):
-        raise ValidationError(
-            "Latitudes, longitudes, and timestamps, should have same amount of points"
-        )
-    loc_array = []
-    for i, _ in enumerate(times):
-        if times[i] and lats[i] and lons[i]:
-            lat = lats[i]
-            lon = lons[i]
-            tim = times[i]
-            try:
-                validate_longitude(lon)
-            except DjangoValidationError:
-                raise ValidationError("Invalid longitude value")
-            try:
-                validate_latitude(lat)
-            except DjangoValidationError:
-                raise ValidationError("Invalid latitude value")
-            loc_array.append((tim, lat, lon))
+    loc_array = parse_locations(request.data)
 
-    if battery_level_posted:
-        try:
-            battery_level = int(battery_level_posted)
-        except Exception:
-            pass
-            # raise ValidationError("Invalid battery_level value type")
-            # Do not raise exception to stay compatible with legacy apps
-        else:
-            if battery_level < 0 or battery_level > 100:
-                # raise ValidationError("battery_level value not in 0-100 range")
-                # Do not raise exception to stay compatible with legacy apps
-                pass
-            else:
-                device.battery_level = battery_level
+    battery_level = parse_battery_level(battery_level_posted)
+    if battery_level is not None:
+        device.battery_level = battery_level
 
     if len(loc_array) > 0:
         device.add_locations(loc_array, save=False)
@@ -1382,6 +1477,159 @@ def locations_api_gw(request):
     )
 
 
+@swagger_auto_schema(
+    method="post",
+    operation_id="upload_devices_locations",
+    operation_description=(
+        "Upload lists of locations of several devices at once, "
+        "results are returned per device"
+    ),
+    tags=["Devices"],
+    request_body=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "devices": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                description=(
+                    f"Up to {MAX_BULK_LOCATIONS_DEVICES} devices, "
+                    "each with its locations either as lists "
+                    "(or comma separated values) of latitudes, longitudes and "
+                    "timestamps, or as a gps_data_codec encoded string"
+                ),
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "device_id": openapi.Schema(type=openapi.TYPE_STRING),
+                        "latitudes": openapi.Schema(
+                            type=openapi.TYPE_ARRAY,
+                            items=openapi.Schema(type=openapi.TYPE_NUMBER),
+                        ),
+                        "longitudes": openapi.Schema(
+                            type=openapi.TYPE_ARRAY,
+                            items=openapi.Schema(type=openapi.TYPE_NUMBER),
+                        ),
+                        "timestamps": openapi.Schema(
+                            type=openapi.TYPE_ARRAY,
+                            items=openapi.Schema(type=openapi.TYPE_INTEGER),
+                        ),
+                        "encoded_data": openapi.Schema(type=openapi.TYPE_STRING),
+                        "battery": openapi.Schema(type=openapi.TYPE_INTEGER),
+                    },
+                    required=["device_id"],
+                ),
+            ),
+        },
+        required=["devices"],
+    ),
+    responses={
+        "201": openapi.Response(
+            description="Success response",
+            examples={
+                "application/json": {
+                    "status": "ok",
+                    "results": [
+                        {
+                            "status": "ok",
+                            "device_id": "<device id>",
+                            "location_count": 3,
+                        },
+                        {
+                            "status": "error",
+                            "device_id": "<device id>",
+                            "error": "No such device ID",
+                        },
+                    ],
+                }
+            },
+        ),
+        "400": openapi.Response(
+            description="Validation Error",
+            examples={"application/json": ["<error message>"]},
+        ),
+    },
+)
+@api_POST_view
+@throttle_classes([PostDataThrottle])
+def locations_bulk_api_gw(request):
+    secret_provided = request.data.get("secret")
+    devices_data = request.data.get("devices")
+    if not isinstance(devices_data, list):
+        raise ValidationError("Missing devices parameter")
+    if len(devices_data) > MAX_BULK_LOCATIONS_DEVICES:
+        raise ValidationError(
+            f"Too many devices, maximum is {MAX_BULK_LOCATIONS_DEVICES}"
+        )
+    is_trusted = (
+        request.user.is_authenticated
+        or secret_provided in settings.POST_LOCATION_SECRETS
+    )
+
+    results = []
+    locations_per_device = {}
+    battery_per_device = {}
+    for device_data in devices_data:
+        device_id = None
+        try:
+            if not isinstance(device_data, dict):
+                raise ValidationError("Invalid data format")
+            device_id = device_data.get("device_id")
+            if not device_id or not isinstance(device_id, str):
+                raise ValidationError("Missing device_id parameter")
+            if not is_trusted and re.match(r"^[0-9]+$", device_id):
+                raise ValidationError("Authentication Failed")
+            loc_array = parse_locations(device_data)
+        except ValidationError as e:
+            results.append(
+                {"status": "error", "device_id": device_id, "error": e.detail[0]}
+            )
+            continue
+        results.append(
+            {"status": "ok", "device_id": device_id, "location_count": len(loc_array)}
+        )
+        locations_per_device.setdefault(device_id, []).extend(loc_array)
+        battery_level = parse_battery_level(device_data.get("battery"))
+        if battery_level is not None:
+            battery_per_device[device_id] = battery_level
+
+    devices = Device.objects.filter(aid__in=locations_per_device.keys()).in_bulk(
+        field_name="aid"
+    )
+    device_user_agent = request.session.user_agent[:200]
+    modification_date = now()
+    for device_id, loc_array in locations_per_device.items():
+        device = devices.get(device_id)
+        if not device:
+            continue
+        device.user_agent = device_user_agent
+        if device_id in battery_per_device:
+            device.battery_level = battery_per_device[device_id]
+        device.modification_date = modification_date
+        if len(loc_array) > 0:
+            device.add_locations(loc_array, save=False)
+    Device.objects.bulk_update(
+        devices.values(),
+        [
+            "modification_date",
+            "user_agent",
+            "battery_level",
+            "locations_encoded",
+            "_last_location_datetime",
+            "_last_location_latitude",
+            "_last_location_longitude",
+            "_location_count",
+        ],
+    )
+    for result in results:
+        if result["status"] == "ok" and result["device_id"] not in devices:
+            del result["location_count"]
+            result["status"] = "error"
+            result["error"] = "No such device ID"
+    return Response(
+        {"status": "ok", "results": results},
+        status=status.HTTP_201_CREATED,
+    )
+
+
 class DataRenderer(renderers.BaseRenderer):
     media_type = "application/download"
     format = "raw"
@@ -2,12 +2,14 @@ import base64
 from io import BytesIO
 
 import arrow
+from background_task.models import Task
 from django.core.cache import cache
 from django.core.files import File
 from rest_framework.test import APIClient
 
 from routechoices.api.tests import EssentialApiBase
 from routechoices.core.models import Club, Event, EventSet, Map
+from routechoices.lib.thumbnails import read_thumbnail, thumbnail_object_name
 
 
 class ClubViewsTestCase(EssentialApiBase):
@@ -43,9 +45,11 @@ class ClubViewsTestCase(EssentialApiBase):
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertIsNone(response.headers.get("X-Cache-Hit"))
+        # The variant stored by the first request is then served by nginx
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.headers["X-Cache-Hit"], "1")
+        self.assertTrue(response.headers["X-Accel-Redirect"].startswith("/s3/"))
 
         url = self.reverse_and_check(
             "club_banner",
@@ -57,9 +61,11 @@ class ClubViewsTestCase(EssentialApiBase):
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertIsNone(response.headers.get("X-Cache-Hit"))
+        # The variant stored by the first request is then served by nginx
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.headers["X-Cache-Hit"], "1")
+        self.assertTrue(response.headers["X-Accel-Redirect"].startswith("/s3/"))
 
         url = self.reverse_and_check(
             "club_thumbnail",
@@ -70,6 +76,15 @@ class ClubViewsTestCase(EssentialApiBase):
         )
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
+        # Thumbnails rendered on request are stored for the other workers
+        self.club.refresh_from_db()
+        cache_key = self.club.thumbnail_cache_key("image/jpeg")
+        self.assertEqual(
+            read_thumbnail(
+                thumbnail_object_name("clubs", self.club.aid, cache_key, "image/jpeg")
+            ),
+            b"".join(response.streaming_content),
+        )
 
         url = self.reverse_and_check(
             "club_favicon",
@@ -81,15 +96,19 @@ class ClubViewsTestCase(EssentialApiBase):
         )
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
+        response = client.get(f"{url}{self.club.logo_last_mod}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response.headers["Cache-Control"])
 
         # test range response
         url = self.reverse_and_check(
-            "club_banner",
-            "/banner",
+            "club_thumbnail",
+            "/thumbnail",
             host="clubs",
             host_kwargs={"club_slug": "kiilat"},
             prefix="kiilat",
         )
+        size = len(b"".join(client.get(url).streaming_content))
 
         response = client.get(url, HTTP_RANGE="bytes=0-10")
         self.assertEqual(response.status_code, 206)
@@ -98,7 +117,7 @@ class ClubViewsTestCase(EssentialApiBase):
             data += d
         self.assertEqual(len(data), 11)
         self.assertEqual(response.headers["Content-Length"], "11")
-        self.assertEqual(response.headers["Content-Range"], "bytes 0-10/286")
+        self.assertEqual(response.headers["Content-Range"], f"bytes 0-10/{size}")
 
         response = client.get(url, HTTP_RANGE="bytes=10-20")
         self.assertEqual(response.status_code, 206)
@@ -108,7 +127,7 @@ class ClubViewsTestCase(EssentialApiBase):
         self.assertEqual(len(data2), 11)
         self.assertNotEqual(data, data2)
         self.assertEqual(response.headers["Content-Length"], "11")
-        self.assertEqual(response.headers["Content-Range"], "bytes 10-20/286")
+        self.assertEqual(response.headers["Content-Range"], f"bytes 10-20/{size}")
 
     def test_event_set_page_loads(self):
         s = EventSet.objects.create(
@@ -279,6 +298,23 @@ class ClubViewsTestCase(EssentialApiBase):
         response = client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_event_thumbnails_scheduled_at_start(self):
+        start_date = arrow.now().shift(hours=1).datetime
+        event = Event.objects.create(
+            name="Kiila Cup 1",
+            slug="kiila-cup-1",
+            club=self.club,
+            start_date=start_date,
+            end_date=arrow.now().shift(hours=2).datetime,
+        )
+        # Saving it again reschedules the task
+        event.save()
+        tasks = Task.objects.filter(
+            task_name="routechoices.core.bg_tasks.precompute_started_event_thumbnails"
+        )
+        self.assertEqual(tasks.count(), 1)
+        self.assertEqual(tasks.get().run_at, start_date)
+
     def test_event_pages_loads(self):
         client = APIClient(HTTP_HOST="kiilat.routechoices.dev")
         e = Event.objects.create(
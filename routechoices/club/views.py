@@ -1,7 +1,3 @@
-from io import BytesIO
-
-import cv2
-import numpy as np
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.sitemaps.views import (
@@ -9,7 +5,6 @@ from django.contrib.sitemaps.views import (
     _get_latest_lastmod,
     x_robots_tag,
 )
-from django.core.cache import cache
 from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
@@ -18,9 +13,9 @@ from django.utils.http import http_date
 from django.utils.timezone import now
 from django.views.decorators.cache import cache_page
 from django_hosts.resolvers import reverse
-from PIL import Image
 from rest_framework import status
 
+from routechoices.api.views import serve_from_s3
 from routechoices.club import feeds
 from routechoices.core.models import PRIVACY_PRIVATE, Club, Event, EventSet
 from routechoices.lib.helpers import (
@@ -29,7 +24,12 @@ from routechoices.lib.helpers import (
     safe64encodedsha,
     set_content_disposition,
 )
-from routechoices.lib.s3 import get_s3_client
+from routechoices.lib.image_variants import (
+    LOGO_ICONS,
+    has_variant,
+    store_variant,
+    variant_name,
+)
 from routechoices.lib.streaming_response import StreamingHttpRangeResponse
 from routechoices.site.forms import CompetitorUploadGPXForm, RegisterForm
 
@@ -70,45 +70,28 @@ def serve_image_from_s3(
     request, image_field, output_filename, default_mime="image/png", img_mode=None
 ):
     mime = get_best_image_mime(request, default_mime)
-    cache_key = f"s3:image:{image_field.name}:{mime}"
+    filename = f"{output_filename}.{mime[6:]}"
 
-    headers = {}
-    image = None
-    if cache.has_key(cache_key):
-        image = cache.get(cache_key)
-        headers["X-Cache-Hit"] = 1
-    else:
-        file_path = image_field.name
-        s3_buffer = BytesIO()
-        out_buffer = BytesIO()
-        s3_client = get_s3_client()
-        s3_client.download_fileobj(settings.AWS_S3_BUCKET, file_path, s3_buffer)
-        nparr = np.fromstring(s3_buffer.getvalue(), np.uint8)
-        cv2_image = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-        color_corrected_img = cv2.cvtColor(np.array(cv2_image), cv2.COLOR_BGR2RGBA)
-        pil_image = Image.fromarray(color_corrected_img)
-        if img_mode and pil_image.mode != img_mode:
-            pil_image = pil_image.convert("RGB")
-
-        pil_image.save(
-            out_buffer,
-            mime[6:].upper(),
-            optimize=True,
-            quality=(40 if mime in ("image/avif", "image/jxl") else 80),
+    # Variants are generated on upload, nginx serves them from the bucket
+    if has_variant(image_field, mime):
+        return serve_from_s3(
+            settings.AWS_S3_BUCKET,
+            request,
+            variant_name(image_field.name, mime),
+            filename=filename,
+            mime=mime,
+            headers={"X-Cache-Hit": 1},
+            dl=False,
         )
-        image = out_buffer.getvalue()
-        cache.set(cache_key, image, 31 * 24 * 3600)
 
+    image = store_variant(image_field, mime, img_mode)
     resp = StreamingHttpRangeResponse(
         request,
         image,
         content_type=mime,
-        headers=headers,
     )
     resp["ETag"] = f'W/"{safe64encodedsha(image)}"'
-    resp["Content-Disposition"] = set_content_disposition(
-        f"{output_filename}.{mime[6:]}", dl=False
-    )
+    resp["Content-Disposition"] = set_content_disposition(filename, dl=False)
     return resp
 
 
@@ -143,18 +126,19 @@ def club_favicon(request, icon_name, **kwargs):
     club = get_object_or_404(Club, slug__iexact=club_slug)
     if club.domain and not request.use_cname:
         return redirect(f"{club.nice_url}{icon_name}")
-    icon_info = {
-        "favicon.ico": {"size": 32, "format": "ICO", "mime": "image/x-icon"},
-        "apple-touch-icon.png": {"size": 180, "format": "PNG", "mime": "image/png"},
-        "icon-192.png": {"size": 192, "format": "PNG", "mime": "image/png"},
-        "icon-512.png": {"size": 512, "format": "PNG", "mime": "image/png"},
-    }.get(icon_name)
+    icon_info = LOGO_ICONS.get(icon_name)
+    headers = {}
     if not club.logo:
         with open(f"{settings.BASE_DIR}/static_assets/{icon_name}", "rb") as fp:
             data = fp.read()
     else:
         data = club.logo_scaled(icon_info["size"], icon_info["format"])
-    return StreamingHttpRangeResponse(request, data, content_type=icon_info["mime"])
+        # URLs of the icons are versioned with the logo hash
+        if request.GET.get("v") == club.logo_hash:
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return StreamingHttpRangeResponse(
+        request, data, content_type=icon_info["mime"], headers=headers
+    )
 
 
 def club_logo(request, **kwargs):
@@ -1,6 +1,13 @@
+import cv2
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoreConfig(AppConfig):
     name = "routechoices.core"
     verbose_name = "Routechoices"
+
+    def ready(self):
+        # Tiles are rendered by many workers at once, OpenCV own thread pool
+        # in each of them would oversubscribe the cores
+        cv2.setNumThreads(settings.TILES_RENDER_CV2_THREADS)
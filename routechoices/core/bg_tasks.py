@@ -1,8 +1,16 @@
+import logging
 import re
+import time
 import urllib.parse
+from datetime import timedelta
 
 from background_task import background
+from django.conf import settings
+from django.utils.timezone import now
 
+from routechoices.core.models import Club, Event, Map
+from routechoices.lib.map_processing import MapImageTooLarge
+from routechoices.lib.map_tiles import evict_public_tiles
 from routechoices.lib.third_party_downloader import (
     GpsSeurantaNet,
     Livelox,
@@ -12,6 +20,8 @@ from routechoices.lib.third_party_downloader import (
     Tractrac,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class EventImportError(Exception):
     pass
@@ -83,3 +93,91 @@ def import_single_event_from_livelox(event_id):
     solution = Livelox()
     event = solution.import_event(event_id)
     return event
+
+
+@background(schedule=0)
+def render_map_tiles_pyramid(map_aid):
+    raster_map = Map.objects.filter(aid=map_aid).first()
+    if not raster_map or not raster_map.image:
+        return
+    raster_map.render_tiles_pyramid()
+
+
+@background(schedule=0)
+def evict_public_map_tiles():
+    evict_public_tiles(settings.TILES_PUBLIC_MAX_BYTES)
+
+
+@background(schedule=0)
+def process_map_upload(map_aid):
+    raster_map = Map.objects.filter(aid=map_aid).first()
+    if not raster_map or not raster_map.upload:
+        return
+    try:
+        raster_map.apply_upload()
+    except MapImageTooLarge as e:
+        raster_map.set_processing(0, str(e))
+    except Exception:
+        logger.exception("Could not process the image of map %s", map_aid)
+        raster_map.set_processing(0, "An error occured while processing the image.")
+
+
+@background(schedule=0)
+def precompute_club_thumbnails(club_aid):
+    club = Club.objects.filter(aid=club_aid).first()
+    if not club:
+        return
+    club.precompute_thumbnails()
+    # Thumbnails of the events show the club logo
+    events = club.events.filter(
+        end_date__gte=now() - timedelta(days=settings.THUMBNAILS_PRECOMPUTE_DAYS)
+    ).select_related("club", "map")
+    for event in events:
+        event.precompute_thumbnails()
+
+
+@background(schedule=0)
+def generate_club_image_variants(club_aid):
+    club = Club.objects.filter(aid=club_aid).first()
+    if not club:
+        return
+    club.generate_image_variants()
+
+
+@background(schedule=0)
+def precompute_event_thumbnails(event_aid):
+    event = Event.objects.select_related("club", "map").filter(aid=event_aid).first()
+    if not event:
+        return
+    event.precompute_thumbnails()
+
+
+@background(schedule=0)
+def precompute_started_event_thumbnails(event_aid):
+    """Scheduled at the start of an event, when its map thumbnails are shown"""
+    precompute_event_thumbnails.now(event_aid)
+
+
+@background(schedule=0)
+def warm_events_tiles():
+    """
+    Warm the tiles cache of the maps of the events starting in the next hours
+    and of the live ones, the soonest first, within a CPU time budget
+    """
+    if not getattr(settings, "CACHE_TILES", False):
+        return {}
+    cpu_deadline = time.process_time() + settings.TILES_WARM_CPU_SECONDS
+    events = (
+        Event.objects.filter(
+            start_date__lte=now() + timedelta(hours=settings.TILES_WARM_HOURS_AHEAD),
+            end_date__gte=now(),
+        )
+        .exclude(map__isnull=True)
+        .select_related("map")
+        .order_by("start_date")
+    )
+    report = {}
+    for event in events:
+        report[event.aid] = event.warm_tiles(settings.TILES_WARM_MIMES, cpu_deadline)
+        logger.info("Event %s tiles warmed at %.1f%%", event.aid, report[event.aid])
+    return report
@@ -0,0 +1,50 @@
+import math
+import random
+import time
+
+import gps_data_codec
+from django.core.management.base import BaseCommand
+
+from routechoices.api.views import parse_locations
+
+
+def generate_track(nb_points):
+    t = int(time.time()) - nb_points
+    lat, lon = 60.12345, 20.12345
+    locations = []
+    for i in range(nb_points):
+        angle = random.uniform(0, 2 * math.pi)
+        lat += 0.00002 * math.cos(angle)
+        lon += 0.00004 * math.sin(angle)
+        locations.append((t + i, round(lat, 5), round(lon, 5)))
+    return locations
+
+
+class Command(BaseCommand):
+    help = "Benchmark the parsing of the locations posted by the trackers apps."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        locations = generate_track(options["points"])
+        times, lats, lons = zip(*locations)
+        payloads = {
+            "comma separated": {
+                "latitudes": ",".join(str(x) for x in lats),
+                "longitudes": ",".join(str(x) for x in lons),
+                "timestamps": ",".join(str(x) for x in times),
+            },
+            "encoded": {"encoded_data": gps_data_codec.encode(locations)},
+        }
+        for name, payload in payloads.items():
+            size = sum(len(value) for value in payload.values())
+            start = time.perf_counter()
+            for _ in range(options["repeat"]):
+                parse_locations(payload)
+            duration = (time.perf_counter() - start) / options["repeat"]
+            self.stdout.write(
+                f"{name}: {size} bytes, {duration * 1e3:.3f}ms per upload of "
+                f"{len(locations)} points"
+            )
@@ -0,0 +1,118 @@
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.map_tiles import (
+    TILE_SIZE,
+    build_mip_chain,
+    encode_tile,
+    tile_bounds,
+    tiles_covering,
+    warp_tile_from_mip_chain,
+)
+
+GLOBAL_MERCATOR = GlobalMercator()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the rendering of a full viewport of tiles of a synthetic map, "
+        "tile by tile and by metatiles."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--map-width", type=int, default=8000)
+        parser.add_argument("--map-height", type=int, default=6000)
+        parser.add_argument("--viewport-width", type=int, default=1920)
+        parser.add_argument("--viewport-height", type=int, default=1080)
+        parser.add_argument("--zoom", type=int, action="append", dest="zooms")
+        parser.add_argument("--metatile-size", type=int, default=4)
+        parser.add_argument("--mime", default="image/webp")
+
+    def handle(self, *args, **options):
+        width, height = options["map_width"], options["map_height"]
+        noise = np.random.default_rng(0).integers(
+            0, 255, (height // 10, width // 10, 3), dtype=np.uint8
+        )
+        img = cv2.cvtColor(cv2.resize(noise, (width, height)), cv2.COLOR_BGR2BGRA)
+        mip_chain = build_mip_chain(img)
+
+        # 1 pixel is 1.5 meter on the ground
+        min_x, max_y = GLOBAL_MERCATOR.latlon_to_meters(
+            {"lat": 60.2, "lon": 24.9}
+        ).values()
+        max_x, min_y = min_x + width * 3, max_y - height * 3
+        corners_xy = ((min_x, max_y), (max_x, max_y), (max_x, min_y), (min_x, min_y))
+
+        def render(output_width, output_height, bounds):
+            return warp_tile_from_mip_chain(
+                mip_chain.__getitem__,
+                len(mip_chain),
+                width,
+                height,
+                corners_xy,
+                output_width,
+                output_height,
+                *bounds,
+            )
+
+        nb_cols = -(-options["viewport_width"] // TILE_SIZE)
+        nb_rows = -(-options["viewport_height"] // TILE_SIZE)
+        size = options["metatile_size"]
+        mime = options["mime"]
+        for tile_z in options["zooms"] or [14, 15, 16, 17]:
+            tiles_x, tiles_y = tiles_covering(corners_xy, tile_z)
+            center_x = (tiles_x.start + tiles_x.stop) // 2
+            center_y = (tiles_y.start + tiles_y.stop) // 2
+            viewport = [
+                (x, y)
+                for x in range(
+                    center_x - nb_cols // 2, center_x - nb_cols // 2 + nb_cols
+                )
+                for y in range(
+                    center_y - nb_rows // 2, center_y - nb_rows // 2 + nb_rows
+                )
+            ]
+
+            start = time.perf_counter()
+            for tile_x, tile_y in viewport:
+                encode_tile(
+                    render(TILE_SIZE, TILE_SIZE, tile_bounds(tile_x, tile_y, tile_z)),
+                    mime,
+                )
+            single_duration = time.perf_counter() - start
+
+            start = time.perf_counter()
+            nb_encoded = 0
+            for meta_x, meta_y in {(x // size, y // size) for x, y in viewport}:
+                meta_x, meta_y = meta_x * size, meta_y * size
+                meta_min_x, _, _, meta_max_y = tile_bounds(meta_x, meta_y, tile_z)
+                _, meta_max_x, meta_min_y, _ = tile_bounds(
+                    meta_x + size - 1, meta_y + size - 1, tile_z
+                )
+                metatile_img = render(
+                    TILE_SIZE * size,
+                    TILE_SIZE * size,
+                    (meta_min_x, meta_max_x, meta_min_y, meta_max_y),
+                )
+                for i in range(size):
+                    for j in range(size):
+                        encode_tile(
+                            metatile_img[
+                                j * TILE_SIZE : (j + 1) * TILE_SIZE,
+                                i * TILE_SIZE : (i + 1) * TILE_SIZE,
+                            ],
+                            mime,
+                        )
+                        nb_encoded += 1
+            metatile_duration = time.perf_counter() - start
+
+            self.stdout.write(
+                f"z{tile_z}: {len(viewport)} tiles viewport, "
+                f"single tiles {single_duration * 1e3:.0f}ms, "
+                f"{size}x{size} metatiles {metatile_duration * 1e3:.0f}ms "
+                f"({nb_encoded} tiles encoded)"
+            )
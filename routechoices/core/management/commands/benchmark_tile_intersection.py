@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.contrib.gis.geos import LinearRing, Polygon
+from django.core.management.base import BaseCommand
+
+from routechoices.lib.map_geometry import get_map_geometry
+from routechoices.lib.map_tiles import tile_bounds, tiles_covering
+
+
+def geos_intersects(corners_xy, min_x, max_x, min_y, max_y):
+    tile_bounds_poly = Polygon(
+        LinearRing(
+            (min_x, min_y),
+            (min_x, max_y),
+            (max_x, max_y),
+            (max_x, min_y),
+            (min_x, min_y),
+        )
+    )
+    tl, tr, br, bl = corners_xy
+    map_bounds_poly = Polygon(LinearRing(tl, bl, br, tr, tl))
+    return tile_bounds_poly.prepared.intersects(map_bounds_poly)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the tile and map intersection test, GEOS against NumPy SAT."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tiles", type=int, default=20000)
+        parser.add_argument(
+            "--corners",
+            default=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        geometry = get_map_geometry(options["corners"], 4000, 3000)
+        corners_xy = geometry.corners_xy
+        # Tiles around the map at all zooms, most of them not intersecting it
+        tiles = []
+        for tile_z in range(8, 19):
+            tiles_x, tiles_y = tiles_covering(corners_xy, tile_z)
+            for _ in range(options["tiles"] // 11):
+                tiles.append(
+                    tile_bounds(
+                        random.randint(tiles_x.start - 2, tiles_x.stop + 1),
+                        random.randint(tiles_y.start - 2, tiles_y.stop + 1),
+                        tile_z,
+                    )
+                )
+
+        start = time.perf_counter()
+        geos_results = [geos_intersects(corners_xy, *bounds) for bounds in tiles]
+        geos_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sat_results = [geometry.intersects_with_bbox(*bounds) for bounds in tiles]
+        sat_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch_results = geometry.intersects_with_bboxes(tiles).tolist()
+        batch_duration = time.perf_counter() - start
+
+        nb_tiles = len(tiles)
+        self.stdout.write(
+            f"{nb_tiles} tiles, {sum(geos_results)} intersecting\n"
+            f"GEOS: {geos_duration / nb_tiles * 1e6:.2f}us per tile\n"
+            f"SAT: {sat_duration / nb_tiles * 1e6:.2f}us per tile\n"
+            f"SAT batch: {batch_duration / nb_tiles * 1e6:.3f}us per tile\n"
+            f"Mismatches: {sum(a != b for a, b in zip(geos_results, sat_results))} "
+            f"single, {sum(a != b for a, b in zip(geos_results, batch_results))} "
+            "batch"
+        )
@@ -0,0 +1,300 @@
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import time
+import traceback
+from io import BytesIO
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from routechoices.core.models import Map
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.helpers import git_master_hash
+from routechoices.lib.map_originals import (
+    delete_original,
+    mark_checked,
+    original_path,
+    write_etag,
+)
+from routechoices.lib.map_tiles import (
+    TILE_EXTENSIONS,
+    raster_dir,
+    tile_bounds,
+    tiles_covering,
+)
+from routechoices.lib.tile_cache import get_tile_cache
+
+GLOBAL_MERCATOR = GlobalMercator()
+MAP_FORMATS = ("jpeg", "png", "webp", "gif")
+
+
+def synthetic_map_data(width, height, seed, img_format="jpeg"):
+    noise = np.random.default_rng(seed).integers(
+        0, 255, (max(1, height // 10), max(1, width // 10), 3), dtype=np.uint8
+    )
+    img = cv2.resize(noise, (width, height))
+    if img_format == "gif":
+        # OpenCV does not encode GIF
+        buffer = BytesIO()
+        Image.fromarray(img).quantize(256).save(buffer, "GIF")
+        return buffer.getvalue()
+    _, buffer = cv2.imencode(f".{img_format}", img)
+    return buffer.tobytes()
+
+
+def synthetic_map_corners(width, height, rotation, meters_per_pixel=1.5):
+    """Corners of a map centered in Helsinki rotated by rotation degrees"""
+    center = GLOBAL_MERCATOR.latlon_to_meters({"lat": 60.2, "lon": 24.9})
+    half_width = width * meters_per_pixel / 2
+    half_height = height * meters_per_pixel / 2
+    angle = -math.radians(rotation)
+    coordinates = []
+    for dx, dy in (
+        (-half_width, half_height),
+        (half_width, half_height),
+        (half_width, -half_height),
+        (-half_width, -half_height),
+    ):
+        latlon = GLOBAL_MERCATOR.meters_to_latlon(
+            {
+                "x": center["x"] + dx * math.cos(angle) + dy * math.sin(angle),
+                "y": center["y"] - dx * math.sin(angle) + dy * math.cos(angle),
+            }
+        )
+        coordinates += [round(latlon["lat"], 5), round(latlon["lon"], 5)]
+    return ",".join(str(x) for x in coordinates)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as fp:
+        resident_pages = int(fp.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        "count": len(durations),
+        "p50_ms": round(np.percentile(durations, 50) * 1e3, 3),
+        "p95_ms": round(np.percentile(durations, 95) * 1e3, 3),
+        "max_ms": round(durations[-1] * 1e3, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark Map.create_tile on synthetic maps of several sizes, image "
+        "formats and rotations, for each zoom, output format and cache state, "
+        "each map in its own process, and print the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--map-size", action="append", dest="map_sizes", help="eg: 4000x3000"
+        )
+        parser.add_argument("--rotation", type=float, action="append", dest="rotations")
+        parser.add_argument(
+            "--format", action="append", dest="formats", choices=MAP_FORMATS
+        )
+        parser.add_argument("--mime", action="append", dest="mimes")
+        parser.add_argument("--tile-size", type=int, action="append", dest="tile_sizes")
+        parser.add_argument("--zooms", type=int, default=4)
+        parser.add_argument("--tiles-per-zoom", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output")
+
+    def handle(self, *args, **options):
+        map_sizes = [
+            tuple(int(x) for x in size.split("x"))
+            for size in options["map_sizes"] or ["1000x800", "4000x3000", "8000x6000"]
+        ]
+        mimes = options["mimes"] or list(TILE_EXTENSIONS.keys())
+        tile_sizes = options["tile_sizes"] or [256]
+        report = {
+            "meta": {
+                "revision": git_master_hash(),
+                "python": platform.python_version(),
+                "opencv": cv2.__version__,
+                "timestamp": int(time.time()),
+            },
+            "maps": [],
+            "results": [],
+        }
+        for width, height in map_sizes:
+            for rotation in options["rotations"] or [0, 30]:
+                for img_format in options["formats"] or MAP_FORMATS:
+                    map_report = self.run_in_subprocess(
+                        width, height, rotation, img_format, mimes, tile_sizes, options
+                    )
+                    report["maps"] += map_report["maps"]
+                    report["results"] += map_report["results"]
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fp:
+                fp.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_in_subprocess(self, *args):
+        """
+        Benchmark a map in a forked process so that its peak RSS is its own,
+        not the largest of all the maps benchmarked before
+        """
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=self.benchmark_map_process, args=(sender, *args)
+        )
+        process.start()
+        sender.close()
+        while not receiver.poll(1):
+            if not process.is_alive():
+                raise CommandError(
+                    f"Benchmark process exited with code {process.exitcode}"
+                )
+        map_report = receiver.recv()
+        process.join()
+        if isinstance(map_report, str):
+            raise CommandError(map_report)
+        return map_report
+
+    def benchmark_map_process(self, sender, *args):
+        map_report = {"maps": [], "results": []}
+        try:
+            self.benchmark_map(map_report, *args)
+        except Exception:
+            sender.send(traceback.format_exc())
+        else:
+            sender.send(map_report)
+        sender.close()
+
+    def benchmark_map(
+        self, report, width, height, rotation, img_format, mimes, tile_sizes, options
+    ):
+        baseline_rss = current_rss_mb()
+        rng = random.Random(
+            f"{options['seed']}:{width}x{height}:{rotation}:{img_format}"
+        )
+        raster_map = Map(
+            name="Benchmark",
+            corners_coordinates=synthetic_map_corners(width, height, rotation),
+            width=width,
+            height=height,
+        )
+        raster_map.image.name = f"benchmark/{raster_map.aid}.{img_format}"
+        # Map.data reads the image from its local copy, not revalidated against
+        # the storage until MAP_ORIGINALS_REVALIDATE_SECONDS elapsed
+        os.makedirs(settings.MAP_ORIGINALS_ROOT, exist_ok=True)
+        data_path = original_path(raster_map.image.name)
+        with open(data_path, "wb") as fp:
+            fp.write(synthetic_map_data(width, height, options["seed"], img_format))
+            write_etag(fp, "benchmark")
+        mark_checked(data_path)
+        map_name = f"{width}x{height}"
+        geometry = raster_map.geometry
+        max_zoom = geometry.max_zoom
+        try:
+            zooms = list(range(max_zoom - options["zooms"] + 2, max_zoom + 2))
+            tiles = {}
+            for tile_z in zooms:
+                tiles_x, tiles_y = tiles_covering(geometry.corners_xy, tile_z)
+                candidates = [
+                    tile_bounds(x, y, tile_z) for x in tiles_x for y in tiles_y
+                ]
+                candidates = [
+                    bounds
+                    for bounds, intersects in zip(
+                        candidates, geometry.intersects_with_bboxes(candidates)
+                    )
+                    if intersects
+                ]
+                tiles[tile_z] = rng.sample(
+                    candidates, min(options["tiles_per_zoom"], len(candidates))
+                )
+
+            # Decoding the image and building its mip chain, once per map
+            start = time.perf_counter()
+            raster_map.create_tile(
+                tile_sizes[0], tile_sizes[0], mimes[0], *tiles[zooms[0]][0]
+            )
+            cold_start = time.perf_counter() - start
+            get_tile_cache().delete_map(raster_map.aid)
+
+            for img_mime in mimes:
+                for tile_size in tile_sizes:
+                    for tile_z in zooms:
+                        self.benchmark_tiles(
+                            report,
+                            raster_map,
+                            tiles[tile_z],
+                            img_mime,
+                            tile_size,
+                            {
+                                "map": map_name,
+                                "format": img_format,
+                                "rotation": rotation,
+                                "mime": img_mime,
+                                "tile_size": tile_size,
+                                "zoom": tile_z,
+                            },
+                        )
+            report["maps"].append(
+                {
+                    "map": map_name,
+                    "format": img_format,
+                    "rotation": rotation,
+                    "max_zoom": max_zoom,
+                    "cold_start_ms": round(cold_start * 1e3, 3),
+                    "peak_rss_mb": round(peak_rss_mb(), 1),
+                    # Memory used on top of the one inherited from the command
+                    "peak_rss_delta_mb": round(peak_rss_mb() - baseline_rss, 1),
+                }
+            )
+        finally:
+            get_tile_cache().delete_map(raster_map.aid)
+            shutil.rmtree(
+                raster_dir(raster_map.aid, raster_map.image.name), ignore_errors=True
+            )
+            delete_original(raster_map.image.name)
+
+    def benchmark_tiles(self, report, raster_map, tiles, img_mime, tile_size, labels):
+        tile_cache = get_tile_cache()
+        # Same tiles moved left of the map are blank
+        map_min_x = raster_map.geometry.corners_aabb[0]
+        blank_tiles = [
+            (map_min_x - 2 * (max_x - min_x), map_min_x - (max_x - min_x), min_y, max_y)
+            for min_x, max_x, min_y, max_y in tiles
+        ]
+        scenarios = (
+            ("render", tiles, None),
+            ("warm_memory", tiles, None),
+            ("warm_disk", tiles, lambda: tile_cache.memory.delete_map(raster_map.aid)),
+            ("blank", blank_tiles, None),
+        )
+        for scenario, scenario_tiles, setup in scenarios:
+            if setup:
+                setup()
+            durations = []
+            for bounds in scenario_tiles:
+                start = time.perf_counter()
+                raster_map.create_tile(tile_size, tile_size, img_mime, *bounds)
+                durations.append(time.perf_counter() - start)
+            if durations:
+                report["results"].append(
+                    {**labels, "scenario": scenario, **summarize(durations)}
+                )
@@ -0,0 +1,187 @@
+import os.path
+import time
+from struct import unpack
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from routechoices.lib.helpers import safe64decode
+from routechoices.lib.tcp_protocols.tmt250 import TMT250Decoder, TMT250FrameReader
+
+
+def load_streams(file_path, streams):
+    with open(file_path, "r", encoding="utf-8") as fp:
+        while line := fp.readline():
+            if ", TMT250 DATA, " not in line:
+                continue
+            try:
+                aid = line.split(", ", 3)[2]
+                data = safe64decode(line.rsplit(": ", 1)[1].strip())
+            except Exception:
+                continue
+            streams[aid] = streams.get(aid, b"") + data
+
+
+class LegacyTMT250Decoder:
+    """Per record decoder used before the frame reader, as a baseline"""
+
+    def __init__(self):
+        self.packet = {}
+        self.battery_level = None
+        self.alarm_triggered = False
+
+    def decode_alv(self, data):
+        self.packet["zeroes"] = unpack(">i", data[:4])[0]
+        if self.packet["zeroes"] != 0:
+            raise Exception("zeroes should be 0")
+        self.packet["length"] = unpack(">i", data[4:8])[0]
+        self.packet["codec"] = data[8]
+        if self.packet["codec"] != 8:
+            raise Exception("codec should be 8")
+        self.packet["num_data"] = data[9]
+        self.extract_records(data)
+        return self.packet
+
+    def extract_records(self, buffer, pointer=10):
+        remaining_data = self.packet["num_data"]
+        self.packet["records"] = []
+        self.alarm_triggered = False
+        while remaining_data > 0:
+            timestamp = unpack(">Q", buffer[pointer : pointer + 8])[0] / 1e3
+            lon = unpack(">i", buffer[pointer + 9 : pointer + 13])[0] / 1e7
+            lat = unpack(">i", buffer[pointer + 13 : pointer + 17])[0] / 1e7
+            n1 = buffer[pointer + 26]
+            pointer += 27
+            for i in range(n1):
+                avl_id = buffer[pointer + i * 2]
+                if avl_id == 113:
+                    self.battery_level = buffer[pointer + 1 + i * 2]
+                if avl_id == 236:
+                    self.alarm_triggered = buffer[pointer + 1 + i * 2]
+            pointer += n1 * 2
+
+            n2 = buffer[pointer]
+            pointer += 1 + 3 * n2
+
+            n4 = buffer[pointer]
+            pointer += 1 + 5 * n4
+
+            n8 = buffer[pointer]
+            pointer += 1 + 9 * n8
+            self.packet["records"].append(
+                {
+                    "timestamp": timestamp,
+                    "latlon": [lat, lon],
+                }
+            )
+            remaining_data -= 1
+        return pointer
+
+
+def split_frames(stream):
+    """Return the frames of a stream, as the connections used to receive them"""
+    reader = TMT250FrameReader()
+    frames = []
+    pointer = 0
+    while pointer < len(stream):
+        view = reader.write_view()
+        data_len = min(len(view), len(stream) - pointer)
+        view[:data_len] = stream[pointer : pointer + data_len]
+        pointer += data_len
+        reader.commit(data_len)
+        try:
+            frames += [bytes(frame) for frame in reader.frames()]
+        except Exception:
+            break
+    return frames
+
+
+class Command(BaseCommand):
+    help = "Benchmark the Teltonika decoder on frames recorded in TCP server logs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            action="append",
+            dest="files",
+            help="Log file to read data from, defaults to logs/tcp.log*",
+        )
+        parser.add_argument("--repeat", type=int, default=10)
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1024,
+            help="Size of the simulated socket reads",
+        )
+
+    def handle(self, *args, **options):
+        files = options["files"]
+        if not files:
+            files = [
+                os.path.join(settings.BASE_DIR, "logs", f"tcp.log{suffix}")
+                for suffix in ["", *[f".{i}" for i in range(1, 6)]]
+            ]
+        streams = {}
+        for file_path in files:
+            if os.path.exists(file_path):
+                load_streams(file_path, streams)
+        if not streams:
+            raise CommandError("No TMT250 data found")
+        chunk_size = options["chunk_size"]
+
+        # Baseline: the legacy decoder on each frame copied out of the stream
+        frames = [
+            frame for stream in streams.values() for frame in split_frames(stream)
+        ]
+        nb_baseline_records = nb_baseline_errors = 0
+        start = time.perf_counter()
+        for _ in range(options["repeat"]):
+            for frame in frames:
+                try:
+                    records = LegacyTMT250Decoder().decode_alv(frame)["records"]
+                except Exception:
+                    nb_baseline_errors += 1
+                else:
+                    nb_baseline_records += len(records)
+        baseline_duration = time.perf_counter() - start
+        self.stdout.write(
+            f"baseline: {len(frames) * options['repeat']} frames "
+            f"({nb_baseline_records} records, {nb_baseline_errors} errors) "
+            f"decoded in {baseline_duration:.3f}s: "
+            f"{len(frames) * options['repeat'] / baseline_duration:.0f} frames/s, "
+            f"{nb_baseline_records / baseline_duration:.0f} records/s"
+        )
+
+        nb_frames = nb_records = nb_errors = 0
+        start = time.perf_counter()
+        for _ in range(options["repeat"]):
+            for stream in streams.values():
+                reader = TMT250FrameReader()
+                decoder = TMT250Decoder()
+                pointer = 0
+                while pointer < len(stream):
+                    view = reader.write_view()
+                    data_len = min(len(view), chunk_size, len(stream) - pointer)
+                    view[:data_len] = stream[pointer : pointer + data_len]
+                    pointer += data_len
+                    reader.commit(data_len)
+                    try:
+                        for frame in reader.frames():
+                            nb_frames += 1
+                            try:
+                                records = decoder.decode_alv(frame)["records"]
+                            except Exception:
+                                nb_errors += 1
+                            else:
+                                nb_records += len(records)
+                    except Exception:
+                        # Unrecoverable framing error, skip this connection
+                        nb_errors += 1
+                        break
+        duration = time.perf_counter() - start
+        self.stdout.write(
+            f"current: {nb_frames} frames ({nb_records} records, {nb_errors} errors) "
+            f"decoded in {duration:.3f}s: {nb_frames / duration:.0f} frames/s, "
+            f"{nb_records / duration:.0f} records/s"
+        )
+        self.stdout.write(f"speedup: {baseline_duration / duration:.2f}x")
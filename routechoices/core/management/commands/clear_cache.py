@@ -1,9 +1,12 @@
 from django.core.cache import cache
 from django.core.management.base import BaseCommand
 
+from routechoices.lib.tile_cache import get_tile_cache
+
 
 class Command(BaseCommand):
     help = "Clear cache"
 
     def handle(self, *args, **options):
         cache.clear()
+        get_tile_cache().clear()
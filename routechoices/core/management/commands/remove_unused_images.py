@@ -28,8 +28,19 @@ class Command(BaseCommand):
                 key = obj["Key"]
                 yield key
 
+    def is_used(self, image_name):
+        if image_name in self.image_paths:
+            return True
+        # Variants in other formats and scaled icons of logos are named after
+        # their original image, as <name>.<ext> and <name>_<size>.<ext>
+        base_name = image_name.rsplit(".", 1)[0]
+        return (
+            base_name in self.image_paths
+            or base_name.rsplit("_", 1)[0] in self.image_paths
+        )
+
     def process_image_file(self, image_name, force):
-        if image_name not in self.image_paths:
+        if not self.is_used(image_name):
             self.n_image_removed += 1
             self.stdout.write(f"File {image_name} is unused")
             if force:
@@ -41,6 +52,9 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         force = options["force"]
         self.image_paths = set(Map.objects.values_list("image", flat=True))
+        self.image_paths.update(
+            set(Map.objects.exclude(upload="").values_list("upload", flat=True))
+        )
         self.image_paths.update(
             set(
                 Club.objects.all()
@@ -61,7 +75,7 @@ class Command(BaseCommand):
         self.n_image_removed = 0
         self.n_image_keeped = 0
         self.s3 = get_s3_client()
-        for directory in ("maps", "logos", "banners"):
+        for directory in ("maps", "map-uploads", "logos", "banners"):
             for filename in self.scan_directory(directory):
                 self.process_image_file(filename, force)
 
@@ -20,7 +20,7 @@ def sigterm_handler(_signo, _stack_frame):
 
 
 class Command(BaseCommand):
-    help = "Run a TCP server for GPS trackers."
+    help = "Run a TCP (and UDP) server for GPS trackers."
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -38,6 +38,18 @@ class Command(BaseCommand):
         parser.add_argument(
             "--tmt250-port", nargs="?", type=int, help="Teltonika Handler Port"
         )
+        parser.add_argument(
+            "--tmt250-udp-port",
+            nargs="?",
+            type=int,
+            help="Teltonika UDP Handler Port",
+        )
+        parser.add_argument(
+            "--queclink-udp-port",
+            nargs="?",
+            type=int,
+            help="Queclink UDP Handler Port",
+        )
         parser.add_argument(
             "--tracktape-port", nargs="?", type=int, help="Tracktape Handler Port"
         )
@@ -56,6 +68,12 @@ class Command(BaseCommand):
         if options.get("tmt250_port"):
             tmt250_server = tmt250.TMT250Server()
             tmt250_server.listen(options["tmt250_port"])
+        if options.get("tmt250_udp_port"):
+            tmt250_udp_server = tmt250.TMT250UDPServer()
+            tmt250_udp_server.listen(options["tmt250_udp_port"])
+        if options.get("queclink_udp_port"):
+            queclink_udp_server = queclink.QueclinkUDPServer()
+            queclink_udp_server.listen(options["queclink_udp_port"])
         if options.get("tracktape_port"):
             tracktape_server = tracktape.TrackTapeServer()
             tracktape_server.listen(options["tracktape_port"])
@@ -74,6 +92,10 @@ class Command(BaseCommand):
                 queclink_server.stop()
             if options.get("tmt250_port"):
                 tmt250_server.stop()
+            if options.get("tmt250_udp_port"):
+                tmt250_udp_server.stop()
+            if options.get("queclink_udp_port"):
+                queclink_udp_server.stop()
             if options.get("tracktape_port"):
                 tracktape_server.stop()
             if options.get("xexun_port"):
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from routechoices.lib.tile_cache import get_tile_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the hit rates of the tile cache tiers, inspect or prune the tiles "
+        "of maps and delete the expired tiles from S3."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--map", dest="map_aids", action="append", default=[])
+        parser.add_argument("--prune", action="store_true", default=False)
+        parser.add_argument("--expire-s3", action="store_true", default=False)
+        parser.add_argument("--reset-stats", action="store_true", default=False)
+
+    def handle(self, *args, **options):
+        tile_cache = get_tile_cache()
+        for map_aid in options["map_aids"]:
+            if options["prune"]:
+                deleted = tile_cache.delete_map(map_aid)
+                self.stdout.write(
+                    f"Map {map_aid}: "
+                    + ", ".join(
+                        f"{count} {tier} tiles deleted"
+                        for tier, count in deleted.items()
+                    )
+                )
+                continue
+            line = f"Map {map_aid}: {tile_cache.disk.map_count(map_aid)} disk tiles"
+            if tile_cache.s3:
+                objects = tile_cache.s3.map_objects(map_aid)
+                size = sum(obj["Size"] for obj in objects)
+                line += f", {len(objects)} s3 tiles ({size / 2**20:.1f}MB)"
+            self.stdout.write(line)
+
+        if options["expire_s3"] and tile_cache.s3:
+            self.stdout.write(
+                f"{tile_cache.s3.delete_expired()} expired s3 tiles deleted"
+            )
+
+        if options["map_aids"] or options["expire_s3"]:
+            return
+
+        self.stdout.write(
+            f"Disk: {tile_cache.disk.cache.volume() / 2**20:.1f}MB used, "
+            f"{len(tile_cache.disk.cache)} tiles"
+        )
+        for tier, stats in tile_cache.stats().items():
+            hit_rate = (
+                f"{stats['hit_rate'] * 100:.1f}%"
+                if stats["hit_rate"] is not None
+                else "-"
+            )
+            self.stdout.write(
+                f"{tier}: {stats['hits']} hits, {stats['misses']} misses, "
+                f"hit rate {hit_rate}"
+            )
+        if options["reset_stats"]:
+            tile_cache.reset_stats()
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from routechoices.lib.map_tiles import render_stats
+
+
+class Command(BaseCommand):
+    help = "Show the state of the tile render slots shared by the workers."
+
+    def handle(self, *args, **options):
+        stats = render_stats()
+        self.stdout.write(
+            f"{stats['active']}/{stats['concurrency']} renders running, "
+            f"{stats['queued']} queued, {stats['rejected']} rejected"
+        )
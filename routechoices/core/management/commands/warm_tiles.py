@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from routechoices.core.bg_tasks import warm_events_tiles
+
+
+class Command(BaseCommand):
+    help = (
+        "Warm the tiles cache of the upcoming and live events and show the "
+        "percentage of their tiles cached, or schedule it to run periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--schedule", action="store_true", default=False)
+
+    def handle(self, *args, **options):
+        if options["schedule"]:
+            warm_events_tiles(
+                repeat=settings.TILES_WARM_INTERVAL, remove_existing_tasks=True
+            )
+            self.stdout.write(
+                f"Tiles warming scheduled every {settings.TILES_WARM_INTERVAL}s"
+            )
+            return
+        for event_aid, warmed in warm_events_tiles.now().items():
+            self.stdout.write(f"Event {event_aid}: {warmed:.1f}% tiles warmed")
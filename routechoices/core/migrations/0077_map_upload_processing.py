@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+import routechoices.core.models
+import routechoices.lib.storages
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0076_caseinsensitivestorage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="map",
+            name="upload",
+            field=models.FileField(
+                blank=True,
+                editable=False,
+                max_length=255,
+                storage=routechoices.lib.storages.OverwriteImageStorage(
+                    aws_s3_bucket_name="routechoices"
+                ),
+                upload_to=routechoices.core.models.map_staging_path,
+            ),
+        ),
+        migrations.AddField(
+            model_name="map",
+            name="processing_progress",
+            field=models.PositiveSmallIntegerField(
+                blank=True, editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="map",
+            name="processing_error",
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
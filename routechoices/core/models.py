@@ -4,9 +4,11 @@ import logging
 import math
 import os.path
 import re
+import tempfile
 import time
 from datetime import timedelta
 from decimal import Decimal
+from functools import partial
 from io import BytesIO
 from operator import itemgetter
 from urllib.parse import urlparse
@@ -21,17 +23,17 @@ import numpy as np
 from allauth.account.models import EmailAddress
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.gis.geos import LinearRing, Polygon
 from django.core.cache import cache
 from django.core.exceptions import BadRequest, PermissionDenied, ValidationError
 from django.core.files.base import ContentFile, File
 from django.core.mail import EmailMessage
 from django.core.paginator import Paginator
+from django.core.signing import Signer
 from django.core.validators import MaxValueValidator, MinValueValidator, validate_slug
 from django.db import models
 from django.db.models import F, Min, Q
 from django.db.models.functions import ExtractMonth, ExtractYear, Upper
-from django.db.models.signals import post_delete, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.http.response import Http404
 from django.shortcuts import get_object_or_404
@@ -39,30 +41,65 @@ from django.template.loader import render_to_string
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django_hosts.resolvers import reverse
-from PIL import Image, ImageDraw
+from PIL import Image
 from pillow_heif import register_avif_opener
 
 from routechoices.lib import plausible
 from routechoices.lib.globalmaptiles import GlobalMercator
 from routechoices.lib.helpers import (
-    adjugate_matrix,
-    avg_angles,
     delete_domain,
     distance_latlon,
-    distance_xy,
     epoch_to_datetime,
-    general_2d_projection,
     get_current_site,
-    project,
     random_device_id,
     random_key,
     safe64encodedsha,
+    short_random_key,
     short_random_slug,
     shortsafe64encodedsha,
     time_base32,
 )
+from routechoices.lib.image_variants import (
+    LOGO_ICONS,
+    generate_variants,
+    scaled_variant_name,
+)
 from routechoices.lib.jxl import register_jxl_opener
+from routechoices.lib.map_geometry import get_map_geometry
+from routechoices.lib.map_originals import delete_original, load_original
+from routechoices.lib.map_processing import open_map_image, strip_map_image
+from routechoices.lib.map_tiles import (
+    FRONTEND_TILE_SIZE,
+    TILE_EXTENSIONS,
+    TILE_SIZE,
+    TileRenderBusy,
+    build_mip_chain,
+    cache_lock,
+    decode_map_image,
+    delete_public_tiles,
+    delete_pyramids,
+    encode_tile,
+    frontend_tiles_plan,
+    has_pyramid,
+    load_raster,
+    mip_chain_length,
+    read_pyramid_tile,
+    read_pyramid_tile_image,
+    render_pyramid,
+    render_slot,
+    store_rasters,
+    tile_bounds,
+    warp_tile_from_mip_chain,
+)
 from routechoices.lib.storages import OverwriteImageStorage
+from routechoices.lib.thumbnails import (
+    THUMBNAIL_MIMES,
+    delete_thumbnails,
+    get_thumbnail,
+    precompute_thumbnails,
+    thumbnail_object_name,
+)
+from routechoices.lib.tile_cache import get_tile_cache
 from routechoices.lib.validators import (
     validate_corners_coordinates,
     validate_domain_name,
@@ -83,29 +120,11 @@ logger = logging.getLogger(__name__)
 GLOBAL_MERCATOR = GlobalMercator()
 EVENT_CACHE_INTERVAL = 5
 
-WEBP_MAX_SIZE = 16383
-
 LOCATION_TIMESTAMP_INDEX = 0
 LOCATION_LATITUDE_INDEX = 1
 LOCATION_LONGITUDE_INDEX = 2
 
 
-class Point:
-    def __init__(self, x, y=None):
-        if isinstance(x, tuple):
-            self.x = x[0]
-            self.y = x[1]
-        elif isinstance(x, dict):
-            self.x = x.get("x")
-            self.y = x.get("y")
-        else:
-            self.x = x
-            self.y = y
-
-    def __repr__(self):
-        return f"x: {self.x}, y:{self.y}"
-
-
 def logo_upload_path(instance=None, file_name=None):
     tmp_path = ["logos"]
     time_hash = time_base32()
@@ -303,10 +322,23 @@ Follow our events live or replay them later.
             path = f"{path}"
         return f"{self.url_protocol}:{path}"
 
+    @property
+    def logo_hash(self):
+        if not self.logo:
+            return ""
+        return shortsafe64encodedsha(self.logo.name)[:8]
+
     def logo_scaled(self, width, ext="PNG"):
-        logo = None
         if not self.logo:
             return None
+        cache_key = f"club:{self.aid}:logo:{self.logo_hash}:{width}:{ext}"
+        return get_thumbnail(
+            cache_key,
+            scaled_variant_name(self.logo.name, width, ext),
+            partial(self.render_logo_scaled, width, ext),
+        )
+
+    def render_logo_scaled(self, width, ext):
         with self.logo.open("rb") as fp:
             logo_b = fp.read()
         logo = Image.open(BytesIO(logo_b))
@@ -322,7 +354,8 @@ Follow our events live or replay them later.
 
     @property
     def logo_last_mod(self):
-        return f"?v={int(self.modification_date.timestamp())}"
+        """Changes with the logo only, so its icons can be cached forever"""
+        return f"?v={self.logo_hash}"
 
     @property
     def logo_url(self):
@@ -332,21 +365,49 @@ Follow our events live or replay them later.
     def banner_url(self):
         return f"{self.nice_url}banner?v={safe64encodedsha(self.banner.name)}"
 
-    def thumbnail(self, mime="image/jpeg"):
+    def generate_image_variants(self):
+        """Store the logo and banner in every format served to the browsers"""
+        count = 0
+        if self.logo:
+            count += generate_variants(self.logo, "image/png")
+            for icon in LOGO_ICONS.values():
+                self.logo_scaled(icon["size"], icon["format"])
+        if self.banner:
+            count += generate_variants(self.banner, "image/jpeg", "RGB")
+        return count
+
+    def thumbnail_cache_key(self, mime):
         cache_key = f"club:{self.aid}:thumbnail:{self.modification_date}:{mime}"
         if not self.banner:
             cache_key = f"{cache_key}:blank"
-            cached = cache.get(cache_key)
-            if cached:
-                return cached
+        return cache_key
+
+    def thumbnail(self, mime="image/jpeg"):
+        cache_key = self.thumbnail_cache_key(mime)
+        return get_thumbnail(
+            cache_key,
+            thumbnail_object_name("clubs", self.aid, cache_key, mime),
+            partial(self.render_thumbnail, mime),
+        )
+
+    def precompute_thumbnails(self):
+        renders = []
+        for mime in THUMBNAIL_MIMES:
+            cache_key = self.thumbnail_cache_key(mime)
+            renders.append(
+                (
+                    cache_key,
+                    thumbnail_object_name("clubs", self.aid, cache_key, mime),
+                    partial(self.render_thumbnail, mime),
+                )
+            )
+        return precompute_thumbnails("clubs", self.aid, renders)
+
+    def render_thumbnail(self, mime):
+        if not self.banner:
             img = Image.new("RGB", (1200, 630), "WHITE")
         else:
-            banner = self.banner
-
-            cached = cache.get(cache_key)
-            if cached:
-                return cached
-            orig = banner.open("rb").read()
+            orig = self.banner.open("rb").read()
             img = Image.open(BytesIO(orig)).convert("RGBA")
             white_bg_img = Image.new("RGBA", img.size, "WHITE")
             white_bg_img.paste(img, (0, 0), img)
@@ -368,9 +429,7 @@ Follow our events live or replay them later.
             optimize=True,
             quality=(40 if mime in ("image/webp", "image/avif", "image/jxl") else 80),
         )
-        data_out = buffer.getvalue()
-        cache.set(cache_key, data_out, 31 * 24 * 3600)
-        return data_out
+        return buffer.getvalue()
 
     def validate_unique(self, exclude=None):
         super().validate_unique(exclude)
@@ -408,9 +467,15 @@ def map_upload_path(instance=None, file_name=None):
     return os.path.join(*tmp_path)
 
 
+def map_staging_path(instance=None, file_name=None):
+    # Outside of the served prefixes, the upload keeps its metadata
+    return os.path.join("map-uploads", f"{instance.aid}_{time_base32()}")
+
+
 NOT_CACHED_TILE = 0
 CACHED_TILE = 1
 CACHED_BLANK_TILE = 2
+PYRAMID_TILE = 3
 
 
 class Map(models.Model):
@@ -432,6 +497,20 @@ class Map(models.Model):
         width_field="width",
         storage=OverwriteImageStorage(aws_s3_bucket_name=settings.AWS_S3_BUCKET),
     )
+    # Uploaded image waiting to be processed into the image
+    upload = models.FileField(
+        upload_to=map_staging_path,
+        max_length=255,
+        blank=True,
+        editable=False,
+        storage=OverwriteImageStorage(aws_s3_bucket_name=settings.AWS_S3_BUCKET),
+    )
+    processing_progress = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    processing_error = models.CharField(max_length=255, blank=True, editable=False)
     height = models.PositiveIntegerField(null=True, blank=True, editable=False)
     width = models.PositiveIntegerField(
         null=True,
@@ -460,17 +539,8 @@ class Map(models.Model):
 
     @property
     def data(self):
-        cache_key = f"map:{self.image.name}:data"
-        cached = cache.get(cache_key)
-        if cached:
-            return cached
-        with self.image.open("rb") as fp:
-            data = fp.read()
-        try:
-            cache.set(cache_key, data, 3600)
-        except Exception:
-            pass
-        return data
+        """Read only memoryview of the image, mapped from its local copy"""
+        return load_original(self.image.storage, self.image.name)
 
     @property
     def corners_coordinates_short(self):
@@ -482,7 +552,7 @@ class Map(models.Model):
     @property
     def kmz(self):
         doc_img = self.data
-        mime_type = magic.from_buffer(doc_img, mime=True)
+        mime_type = magic.from_buffer(bytes(doc_img[:2048]), mime=True)
         ext = mime_type[6:]
 
         doc_kml = render_to_string(
@@ -514,7 +584,7 @@ class Map(models.Model):
     @property
     def data_uri(self):
         data = self.data
-        mime_type = magic.from_buffer(data, mime=True)
+        mime_type = magic.from_buffer(bytes(data[:2048]), mime=True)
         return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
 
     @data_uri.setter
@@ -541,41 +611,25 @@ class Map(models.Model):
     def size(self):
         return {"width": self.width, "height": self.height}
 
+    @property
+    def geometry(self):
+        return get_map_geometry(self.corners_coordinates, self.width, self.height)
+
     @property
     def min_lon(self):
-        return min(
-            self.bound["topLeft"]["lon"],
-            self.bound["bottomLeft"]["lon"],
-            self.bound["bottomRight"]["lon"],
-            self.bound["topRight"]["lon"],
-        )
+        return self.geometry.min_lon
 
     @property
     def max_lon(self):
-        return max(
-            self.bound["topLeft"]["lon"],
-            self.bound["bottomLeft"]["lon"],
-            self.bound["bottomRight"]["lon"],
-            self.bound["topRight"]["lon"],
-        )
+        return self.geometry.max_lon
 
     @property
     def min_lat(self):
-        return min(
-            self.bound["topLeft"]["lat"],
-            self.bound["bottomLeft"]["lat"],
-            self.bound["bottomRight"]["lat"],
-            self.bound["topRight"]["lat"],
-        )
+        return self.geometry.min_lat
 
     @property
     def max_lat(self):
-        return max(
-            self.bound["topLeft"]["lat"],
-            self.bound["bottomLeft"]["lat"],
-            self.bound["bottomRight"]["lat"],
-            self.bound["topRight"]["lat"],
-        )
+        return self.geometry.max_lat
 
     @property
     def max_xy(self):
@@ -591,38 +645,23 @@ class Map(models.Model):
 
     @property
     def alignment_points(self):
-        a1 = Point(0, 0)
-        b1 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bound["topLeft"]))
-        a2 = Point(0, self.height)
-        b2 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bound["bottomLeft"]))
-        a3 = Point(self.width, 0)
-        b3 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bound["topRight"]))
-        a4 = Point(self.width, self.height)
-        b4 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bound["bottomRight"]))
-        return a1, a2, a3, a4, b1, b2, b3, b4
+        return self.geometry.alignment_points
 
     @property
     def matrix_3d(self):
-        m = general_2d_projection(*self.alignment_points)
-        if not m[8]:
-            return
-        for i in range(9):
-            m[i] = m[i] / m[8]
-        return m
+        return self.geometry.matrix_3d
 
     @property
     def matrix_3d_inverse(self):
-        return adjugate_matrix(self.matrix_3d)
+        return self.geometry.matrix_3d_inverse
 
     @property
     def map_xy_to_spherical_mercator(self):
-        if not self.matrix_3d:
-            return lambda x, y: (0, 0)
-        return lambda x, y: project(self.matrix_3d, x, y)
+        return self.geometry.map_xy_to_spherical_mercator
 
     @property
     def spherical_mercator_to_map_xy(self):
-        return lambda x, y: project(self.matrix_3d_inverse, x, y)
+        return self.geometry.spherical_mercator_to_map_xy
 
     def wsg84_to_map_xy(self, lat, lon, round_values=False):
         world_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": lat, "lon": lon})
@@ -632,62 +671,24 @@ class Map(models.Model):
         return map_xy
 
     def map_xy_to_wsg84(self, x, y):
-        mx, my = self.map_xy_to_spherical_mercator(x, y)
-        return GLOBAL_MERCATOR.meters_to_latlon({"x": mx, "y": my})
+        return self.geometry.map_xy_to_wsg84(x, y)
 
     @property
     def resolution(self):
         """Return map image resolution in pixels/meters"""
-        ll_a = self.map_xy_to_wsg84(0, 0)
-        ll_b = self.map_xy_to_wsg84(self.width, 0)
-        ll_c = self.map_xy_to_wsg84(self.width, self.height)
-        ll_d = self.map_xy_to_wsg84(0, self.height)
-        resolution = (
-            distance_xy(0, 0, 0, self.height)
-            + distance_xy(0, self.height, self.width, self.height)
-            + distance_xy(self.width, self.height, self.width, 0)
-            + distance_xy(self.width, 0, 0, 0)
-        ) / (
-            distance_latlon(ll_a, ll_b)
-            + distance_latlon(ll_b, ll_c)
-            + distance_latlon(ll_c, ll_d)
-            + distance_latlon(ll_d, ll_a)
-        )
-        return resolution
+        return self.geometry.resolution
 
     @property
     def center(self):
-        return self.map_xy_to_wsg84(self.width / 2, self.height / 2)
+        return self.geometry.center
 
     @property
     def max_zoom(self):
-        center_latitude = self.center["lat"]
-        meters_per_pixel_at_zoom_18 = (
-            40_075_016.686 * math.cos(center_latitude * math.pi / 180) / (2 ** (18 + 8))
-        )
-        r = self.resolution / meters_per_pixel_at_zoom_18
-        return math.floor(math.log2(r)) + 18
+        return self.geometry.max_zoom
 
     @property
     def rotation(self):
-        tl = self.map_xy_to_spherical_mercator(0, 0)
-        tr = self.map_xy_to_spherical_mercator(self.width, 0)
-        br = self.map_xy_to_spherical_mercator(self.width, self.height)
-        bl = self.map_xy_to_spherical_mercator(0, self.height)
-
-        rot_vert_left = (
-            (math.atan2(tl[1] - bl[1], tl[0] - bl[0]) - math.pi / 2) * 180 / math.pi
-        )
-        rot_vert_right = (
-            (math.atan2(tr[1] - br[1], tr[0] - br[0]) - math.pi / 2) * 180 / math.pi
-        )
-        rot_vert = (avg_angles(rot_vert_left, rot_vert_right)) % 360
-
-        rot_hori_top = (math.atan2(tr[1] - tl[1], tr[0] - tl[0])) * 180 / math.pi
-        rot_hori_bottom = (math.atan2(br[1] - bl[1], br[0] - bl[0])) * 180 / math.pi
-        rot_hori = avg_angles(rot_hori_top, rot_hori_bottom) % 360
-
-        return round(avg_angles(rot_vert, rot_hori), 2)
+        return self.geometry.rotation
 
     @property
     def north_declination(self):
@@ -699,10 +700,12 @@ class Map(models.Model):
     def tile_cache_key(
         self, output_width, output_height, img_mime, min_lon, max_lon, min_lat, max_lat
     ):
+        # Bounds are rounded to the centimeter, Leaflet computes them with
+        # float noise that would make the same tile miss the cache
         return (
             f"map:{self.aid}:{self.hash}:tile:"
             f"{output_width}x{output_height}:"
-            f"{min_lon},{max_lon},{min_lat},{max_lat}:"
+            f"{min_lon:.2f},{max_lon:.2f},{min_lat:.2f},{max_lat:.2f}:"
             f"{img_mime}"
         )
 
@@ -715,9 +718,13 @@ class Map(models.Model):
         max_x,
         min_y,
         max_y,
+        tile_zxy=None,
     ):
         """
         Coordinates must be given in spherical mercator X Y
+
+        When the tile slippy coordinates are given, the tile is transcoded
+        from the pre-rendered pyramid if it exists there
         """
         cache_key = self.tile_cache_key(
             output_width, output_height, img_mime, min_x, max_x, min_y, max_y
@@ -726,7 +733,7 @@ class Map(models.Model):
         cached = None
         if use_cache:
             try:
-                cached = cache.get(cache_key)
+                cached = get_tile_cache().get(cache_key, self.aid)
             except Exception:
                 pass
             else:
@@ -737,13 +744,15 @@ class Map(models.Model):
             blank_cache_key = f"tile:blank:{output_width}x{output_height}:{img_mime}"
             if use_cache:
                 try:
-                    cached = cache.get(blank_cache_key)
+                    cached = get_tile_cache().get(blank_cache_key)
                 except Exception:
                     pass
                 else:
                     if cached:
                         try:
-                            cache.set(cache_key, cached, 3600 * 24 * 30)
+                            get_tile_cache().set(
+                                cache_key, cached, self.aid, blank=True
+                            )
                         except Exception:
                             pass
                         return cached, CACHED_BLANK_TILE
@@ -781,153 +790,380 @@ class Map(models.Model):
                 data_out = BytesIO(buffer).getvalue()
             if use_cache:
                 try:
-                    cache.set(cache_key, data_out, 3600 * 24 * 30)
-                    cache.set(blank_cache_key, data_out, 3600 * 24 * 30)
+                    get_tile_cache().set(cache_key, data_out, self.aid, blank=True)
+                    get_tile_cache().set(blank_cache_key, data_out, blank=True)
                 except Exception:
                     pass
             return data_out, NOT_CACHED_TILE
 
-        img_alpha = None
+        tile_img = None
+        if tile_zxy and (output_width, output_height) == (TILE_SIZE, TILE_SIZE):
+            tile_img = read_pyramid_tile_image(self.aid, self.hash, *tile_zxy)
+
+        metatile_size = getattr(settings, "TILES_METATILE_SIZE", 1)
+        if (
+            tile_img is None
+            and use_cache
+            and tile_zxy
+            and (output_width, output_height) == (TILE_SIZE, TILE_SIZE)
+            and metatile_size > 1
+        ):
+            tile = self.create_metatile(img_mime, *tile_zxy, metatile_size)
+            if tile is not None:
+                return tile
+
+        if tile_img is not None:
+            data_out = encode_tile(tile_img, img_mime)
+        elif use_cache:
+            # Concurrent requests of the same tile wait for the first one
+            with cache_lock(f"{cache_key}:lock") as acquired:
+                if acquired:
+                    try:
+                        cached = get_tile_cache().get(cache_key, self.aid)
+                    except Exception:
+                        pass
+                    else:
+                        if cached:
+                            return cached, CACHED_TILE
+                data_out = self.render_tile(
+                    output_width,
+                    output_height,
+                    img_mime,
+                    min_x,
+                    max_x,
+                    min_y,
+                    max_y,
+                    use_cache=use_cache,
+                )
+        else:
+            data_out = self.render_tile(
+                output_width,
+                output_height,
+                img_mime,
+                min_x,
+                max_x,
+                min_y,
+                max_y,
+                use_cache=use_cache,
+            )
+
         if use_cache:
             try:
-                img_alpha = cache.get(f"img_data_{self.image.name}_raw")
+                get_tile_cache().set(cache_key, data_out, self.aid)
             except Exception:
                 pass
+        return data_out, NOT_CACHED_TILE
 
-        if img_alpha is None:
-            orig = self.data
-            orig_mime_type = magic.from_buffer(orig, mime=True)
-            if orig_mime_type == "image/gif":
-                img = Image.open(BytesIO(orig)).convert("RGBA")
-                img_alpha = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGRA)
-            else:
-                img_nparr = np.fromstring(orig, np.uint8)
-                img = cv2.imdecode(img_nparr, cv2.IMREAD_UNCHANGED)
-                img_alpha = cv2.cvtColor(np.array(img), cv2.COLOR_BGR2BGRA)
-
-            if use_cache and not cache.has_key(f"img_data_{self.image.name}_raw"):
-                cache.set(f"img_data_{self.image.name}_raw", img_alpha, 3600 * 24 * 30)
-
-        tl = self.map_xy_to_spherical_mercator(0, 0)
-        tr = self.map_xy_to_spherical_mercator(self.width, 0)
-        br = self.map_xy_to_spherical_mercator(self.width, self.height)
-        bl = self.map_xy_to_spherical_mercator(0, self.height)
+    def render_tile(
+        self,
+        output_width,
+        output_height,
+        img_mime,
+        min_x,
+        max_x,
+        min_y,
+        max_y,
+        use_cache=True,
+    ):
+        with render_slot():
+            tile_img = warp_tile_from_mip_chain(
+                partial(self.get_mip_level, use_cache=use_cache),
+                mip_chain_length(self.width, self.height),
+                self.width,
+                self.height,
+                self.corners_xy,
+                output_width,
+                output_height,
+                min_x,
+                max_x,
+                min_y,
+                max_y,
+            )
+            return encode_tile(tile_img, img_mime)
 
-        p1 = np.float32(
-            [
-                [0, 0],
-                [self.width, 0],
-                [self.width, self.height],
-                [0, self.height],
-            ]
+    def create_metatile(self, img_mime, tile_z, tile_x, tile_y, metatile_size):
+        """
+        Render the block of metatile_size x metatile_size tiles containing the
+        given tile in a single warp, cache all its tiles and return the one
+        asked for with its cache status, concurrent requests of the same block
+        wait for it
+        """
+        metatile_size = min(metatile_size, 2**tile_z)
+        meta_x = tile_x // metatile_size * metatile_size
+        meta_y = tile_y // metatile_size * metatile_size
+        cache_key = self.tile_cache_key(
+            TILE_SIZE, TILE_SIZE, img_mime, *tile_bounds(tile_x, tile_y, tile_z)
+        )
+        lock_key = (
+            f"tile:lock:{self.aid}:{self.hash}:{img_mime}:{metatile_size}:"
+            f"{tile_z}:{meta_x}:{meta_y}"
         )
+        with cache_lock(lock_key) as acquired:
+            if not acquired:
+                return None
+            # The block may have been rendered while waiting for the lock
+            try:
+                cached = get_tile_cache().get(cache_key, self.aid)
+            except Exception:
+                pass
+            else:
+                if cached:
+                    return cached, CACHED_TILE
 
-        scale = 1
-        while True:
-            r_w = (max_x - min_x) / output_width / scale
-            r_h = (max_y - min_y) / output_height / scale
-
-            p2 = np.float32(
-                [
-                    [(tl[0] - min_x) / r_w, (max_y - tl[1]) / r_h],
-                    [(tr[0] - min_x) / r_w, (max_y - tr[1]) / r_h],
-                    [(br[0] - min_x) / r_w, (max_y - br[1]) / r_h],
-                    [(bl[0] - min_x) / r_w, (max_y - bl[1]) / r_h],
-                ]
-            )
-            coeffs = cv2.getPerspectiveTransform(p1, p2)
-            if (
-                scale < 2
-                and max(
-                    abs(coeffs[0][0]),
-                    abs(coeffs[0][1]),
-                    abs(coeffs[1][0]),
-                    abs(coeffs[1][1]),
+            with render_slot():
+                data_out = self.render_metatile(
+                    img_mime, tile_z, tile_x, tile_y, meta_x, meta_y, metatile_size
                 )
-                < 0.5
-            ):
-                scale *= 2
-            else:
-                break
+            return data_out, NOT_CACHED_TILE
 
-        tile_img = cv2.warpPerspective(
-            img_alpha,
-            coeffs,
-            (int(output_width * scale), int(output_height * scale)),
-            flags=cv2.INTER_AREA,
-            borderMode=cv2.BORDER_CONSTANT,
-            borderValue=(255, 255, 255, 0),
+    def render_metatile(
+        self, img_mime, tile_z, tile_x, tile_y, meta_x, meta_y, metatile_size
+    ):
+        min_x, _, _, max_y = tile_bounds(meta_x, meta_y, tile_z)
+        _, max_x, min_y, _ = tile_bounds(
+            meta_x + metatile_size - 1, meta_y + metatile_size - 1, tile_z
         )
-        if scale > 1:
-            tile_img = cv2.resize(
-                tile_img, (output_width, output_height), interpolation=cv2.INTER_AREA
-            )
-        extra_args = []
-        if img_mime in ("image/avif", "image/jxl"):
-            color_converted = cv2.cvtColor(tile_img, cv2.COLOR_BGRA2RGBA)
-            pil_image = Image.fromarray(color_converted)
-            buffer = BytesIO()
-            pil_image.save(buffer, img_mime[6:].upper(), optimize=True, quality=40)
-            data_out = buffer.getvalue()
-        else:
-            if img_mime == "image/webp":
-                extra_args = [int(cv2.IMWRITE_WEBP_QUALITY), 40]
-            elif img_mime == "image/jpeg":
-                extra_args = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-            _, buffer = cv2.imencode(f".{img_mime[6:]}", tile_img, extra_args)
-            data_out = BytesIO(buffer).getvalue()
+        metatile_img = warp_tile_from_mip_chain(
+            self.get_mip_level,
+            mip_chain_length(self.width, self.height),
+            self.width,
+            self.height,
+            self.corners_xy,
+            TILE_SIZE * metatile_size,
+            TILE_SIZE * metatile_size,
+            min_x,
+            max_x,
+            min_y,
+            max_y,
+        )
+        data_out = None
+        for i in range(metatile_size):
+            for j in range(metatile_size):
+                bounds = tile_bounds(meta_x + i, meta_y + j, tile_z)
+                is_asked_tile = (meta_x + i, meta_y + j) == (tile_x, tile_y)
+                if not is_asked_tile and not self.intersects_with_tile(*bounds):
+                    continue
+                sub_tile_data = encode_tile(
+                    metatile_img[
+                        j * TILE_SIZE : (j + 1) * TILE_SIZE,
+                        i * TILE_SIZE : (i + 1) * TILE_SIZE,
+                    ],
+                    img_mime,
+                )
+                if is_asked_tile:
+                    data_out = sub_tile_data
+                try:
+                    get_tile_cache().set(
+                        self.tile_cache_key(TILE_SIZE, TILE_SIZE, img_mime, *bounds),
+                        sub_tile_data,
+                        self.aid,
+                    )
+                except Exception:
+                    pass
+        return data_out
+
+    def get_mip_level(self, level, use_cache=True):
+        """
+        Return the level of the mip chain of the map image, the full image
+        being level 0 and each following level half the size of the previous
+        """
+        if use_cache:
+            img_alpha = load_raster(self.aid, self.image.name, level)
+            if img_alpha is not None:
+                return img_alpha
 
+        levels = build_mip_chain(decode_map_image(self.data))
         if use_cache:
             try:
-                cache.set(cache_key, data_out, 3600 * 24 * 30)
-            except Exception:
+                store_rasters(self.aid, self.image.name, levels)
+            except OSError:
                 pass
-        return data_out, NOT_CACHED_TILE
+        return levels[min(level, len(levels) - 1)]
 
-    def intersects_with_tile(self, min_x, max_x, min_y, max_y):
-        tile_bounds_poly = Polygon(
-            LinearRing(
-                (min_x, min_y),
-                (min_x, max_y),
-                (max_x, max_y),
-                (max_x, min_y),
-                (min_x, min_y),
-            )
+    @property
+    def corners_xy(self):
+        return self.geometry.corners_xy
+
+    def warm_tiles(self, img_mimes, cpu_deadline):
+        """
+        Render the tiles the event page loads first until the process CPU time
+        reaches cpu_deadline, return how many of them are cached out of all
+        """
+        plan = frontend_tiles_plan(
+            self.corners_xy,
+            self.max_zoom,
+            settings.TILES_WARM_VIEWPORTS,
+            settings.TILES_WARM_EXTRA_ZOOMS,
         )
-        map_bounds_poly = Polygon(
-            LinearRing(
-                self.map_xy_to_spherical_mercator(0, 0),
-                self.map_xy_to_spherical_mercator(0, self.height),
-                self.map_xy_to_spherical_mercator(self.width, self.height),
-                self.map_xy_to_spherical_mercator(self.width, 0),
-                self.map_xy_to_spherical_mercator(0, 0),
+        warmed = 0
+        rendering = True
+        for img_mime in img_mimes:
+            for _, bounds in plan:
+                rendering = rendering and time.process_time() < cpu_deadline
+                if rendering:
+                    try:
+                        self.create_tile(
+                            FRONTEND_TILE_SIZE, FRONTEND_TILE_SIZE, img_mime, *bounds
+                        )
+                    except TileRenderBusy:
+                        # Live requests need the render slots more
+                        rendering = False
+                    else:
+                        warmed += 1
+                        continue
+                cache_key = self.tile_cache_key(
+                    FRONTEND_TILE_SIZE, FRONTEND_TILE_SIZE, img_mime, *bounds
+                )
+                try:
+                    if get_tile_cache().get(cache_key, self.aid) is not None:
+                        warmed += 1
+                except Exception:
+                    pass
+        return warmed, len(plan) * len(img_mimes)
+
+    def render_tiles_pyramid(self, processes=None):
+        if has_pyramid(self.aid, self.hash):
+            return 0
+        # Decode the image once in the raster store for the worker processes
+        self.get_mip_level(0)
+        return render_pyramid(
+            self.aid,
+            self.hash,
+            self.image.name,
+            self.corners_xy,
+            self.width,
+            self.height,
+            self.max_zoom,
+            processes=processes,
+        )
+
+    def get_pyramid_tile(self, tile_z, tile_x, tile_y, img_mime):
+        """Return a tile from the pre-rendered pyramid of the map if it exists"""
+        return read_pyramid_tile(self.aid, self.hash, tile_z, tile_x, tile_y, img_mime)
+
+    @property
+    def tiles_signature(self):
+        return Signer(salt="routechoices.tiles").signature(f"{self.aid}:{self.hash}")
+
+    def get_tiles_url(self, private=False, img_mime="image/webp"):
+        """
+        Return the URL template of the tiles of this version of the map, as the
+        map hash is part of it they never change and can be cached forever
+        """
+        path = f"maps/{self.aid}/{self.hash}"
+        if private:
+            path = f"private/{self.tiles_signature}/{self.aid}/{self.hash}"
+        return (
+            f"{reverse('tile_service', host='tiles')}{path}/"
+            f"{{z}}/{{x}}/{{y}}.{TILE_EXTENSIONS[img_mime]}"
+        )
+
+    def has_public_events(self):
+        """Whether the map is shown in a started event that is not private"""
+        return (
+            Event.objects.filter(
+                Q(map_id=self.id) | Q(map_assignations__map_id=self.id),
+                start_date__lt=now(),
             )
+            .exclude(privacy=PRIVACY_PRIVATE)
+            .exists()
         )
-        tile_bounds_poly_prep = tile_bounds_poly.prepared
-        return tile_bounds_poly_prep.intersects(map_bounds_poly)
-
-    def strip_exif(self):
-        if self.image.closed:
-            self.image.open()
-        with Image.open(self.image.file) as image:
-            rgba_img = image.convert("RGBA")
-            img_ext = "WEBP"
-            if rgba_img.size[0] > WEBP_MAX_SIZE or rgba_img.size[1] > WEBP_MAX_SIZE:
-                img_ext = "PNG"
-            out_buffer = BytesIO()
-            params = {
-                "dpi": (72, 72),
-            }
-            if img_ext == "WEBP":
-                params["quality"] = 80
-            rgba_img.save(out_buffer, img_ext, optimize=True, **params)
-            f_new = File(out_buffer, name=self.image.name)
+
+    def intersects_with_tile(self, min_x, max_x, min_y, max_y):
+        return self.geometry.intersects_with_bbox(min_x, max_x, min_y, max_y)
+
+    def strip_exif(self, progress=None):
+        source = self.upload or self.image
+        if source.closed:
+            source.open()
+        with tempfile.TemporaryFile() as out_fp:
+            strip_map_image(source.file, out_fp, progress)
+            out_fp.seek(0)
             self.image.save(
                 "filename",
-                f_new,
+                File(out_fp, name=self.image.name or "filename"),
                 save=False,
             )
-        self.image.close()
+        source.close()
+
+    @property
+    def processing(self):
+        """Progress of the processing of the uploaded image, None once done"""
+        if self.processing_progress is None:
+            return None
+        return {
+            "progress": self.processing_progress,
+            "error": self.processing_error or None,
+        }
+
+    def set_processing(self, progress, error=None):
+        progress = int(progress * 100)
+        if progress == self.processing_progress and not error:
+            return
+        self.processing_progress = progress
+        self.processing_error = error or ""
+        # Not a save, the image is not ready and the receivers must not run.
+        # Nothing is written once another image was uploaded.
+        Map.objects.filter(id=self.id, upload=self.upload.name).update(
+            processing_progress=self.processing_progress,
+            processing_error=self.processing_error,
+        )
+
+    def stage_upload(self, uploaded_file):
+        """Store an uploaded image under a private name until it is processed"""
+        # A previous upload still pending may be read by its task, it is
+        # left to remove_unused_images
+        if self.upload and self.processing_error:
+            self.delete_upload()
+        self.upload.save("upload", uploaded_file, save=False)
+        self.processing_progress = 0
+        self.processing_error = ""
+
+    def delete_upload(self):
+        try:
+            self.upload.storage.delete(self.upload.name)
+        except Exception:
+            pass
+        self.upload = ""
+
+    def process_upload(self):
+        """Strip the uploaded image of its metadata outside of the request"""
+        from routechoices.core.bg_tasks import process_map_upload
+
+        process_map_upload(self.aid, remove_existing_tasks=True)
+
+    def apply_upload(self):
+        """
+        Replace the image by the processed upload, then delete the upload.
+        Only the fields of the image are written, and only if no other image
+        was uploaded meanwhile, the edits of the map made in the meantime are
+        kept. Return whether the image was replaced.
+        """
+        upload_name = self.upload.name
+        self.strip_exif(progress=self.set_processing)
+        updated = Map.objects.filter(id=self.id, upload=upload_name).update(
+            image=self.image.name,
+            width=self.width,
+            height=self.height,
+            upload="",
+            processing_progress=None,
+            processing_error="",
+        )
+        if not updated:
+            # The task of the newer upload replaces the image
+            try:
+                self.image.storage.delete(self.image.name)
+            except Exception:
+                pass
+            return False
+        try:
+            self.upload.storage.delete(upload_name)
+        except Exception:
+            pass
+        self.refresh_from_db()
+        # Run the receivers of the new image, tiles and thumbnails
+        self.save(update_fields=["modification_date"])
+        return True
 
     @property
     def hash(self):
@@ -937,46 +1173,28 @@ class Map(models.Model):
 
     @property
     def bound(self):
-        coords = [float(x) for x in self.corners_coordinates.split(",")]
-        return {
-            "topLeft": {"lat": coords[0], "lon": coords[1]},
-            "topRight": {"lat": coords[2], "lon": coords[3]},
-            "bottomRight": {"lat": coords[4], "lon": coords[5]},
-            "bottomLeft": {"lat": coords[6], "lon": coords[7]},
-        }
+        return self.geometry.bound
 
     @classmethod
     def from_points(cls, seg, waypoints):
         new_map = cls()
 
-        min_lat = 90
-        max_lat = -90
-        min_lon = 180
-        max_lon = -180
-
-        line_color = (0xF5, 0x2F, 0xE4, 160)
+        # BGRA
+        line_color = (0xE4, 0x2F, 0xF5, 160)
+        white = (255, 255, 255, 200)
 
-        all_segs = seg
+        all_segs = [np.asarray(pts, dtype=np.float64) for pts in seg]
         if waypoints:
-            all_segs = seg + [
-                waypoints,
-            ]
-
-        for pts in all_segs:
-            lats_lons = list(zip(*pts))
-            lats = lats_lons[0]
-            lons = lats_lons[1]
-            min_lat = min(min_lat, min(lats))
-            max_lat = max(max_lat, max(lats))
-            min_lon = min(min_lon, min(lons))
-            max_lon = max(max_lon, max(lons))
+            all_segs.append(np.asarray(waypoints, dtype=np.float64))
+        all_pts = np.concatenate(all_segs)
+        min_lat, min_lon = all_pts.min(axis=0)
+        max_lat, max_lon = all_pts.max(axis=0)
 
         tl_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": max_lat, "lon": min_lon})
         tr_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": max_lat, "lon": max_lon})
         br_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": min_lat, "lon": max_lon})
         bl_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": min_lat, "lon": min_lon})
 
-        res_scale = 4
         MAX_SIZE = 4000
         offset = 100
         width = tr_xy["x"] - tl_xy["x"]
@@ -1007,59 +1225,59 @@ class Map(models.Model):
         new_map.corners_coordinates = ",".join(
             f"{round(c['lat'], 5)},{round(c['lon'], 5)}" for c in corners
         )
-
-        im = Image.new(
-            "RGBA",
-            (int(width * res_scale), int(height * res_scale)),
-            (255, 255, 255, 0),
-        )
-        new_map.width = int(width * res_scale)
-        new_map.height = int(height * res_scale)
-        draw = ImageDraw.Draw(im)
-        for pts in seg:
-            map_pts = [
-                new_map.wsg84_to_map_xy(pt[0], pt[1], round_values=True) for pt in pts
-            ]
-            draw.line(map_pts, (255, 255, 255, 200), 22 * res_scale, joint="curve")
-            draw.line(map_pts, line_color, 16 * res_scale, joint="curve")
-        for pt in waypoints:
-            map_pt = new_map.wsg84_to_map_xy(pt[0], pt[1], round_values=True)
-            widths = [66, 63, 11, 8]
-            thicknesses = [22, 16, 22, 16]
-            fills = [
-                (0, 0, 0, 0),
-                None,
-                None,
-                line_color,
-            ]
-            colors = [
-                (255, 255, 255, 200),
-                line_color,
-                (255, 255, 255, 200),
-                line_color,
-            ]
-
-            for i, w in enumerate(widths):
-                wr = w * res_scale
-                draw.ellipse(
-                    (
-                        map_pt[0] - wr,
-                        map_pt[1] - wr,
-                        map_pt[0] + wr,
-                        map_pt[1] + wr,
-                    ),
-                    outline=colors[i],
-                    fill=fills[i],
-                    width=int(thicknesses[i] * res_scale),
+        new_map.width = int(width)
+        new_map.height = int(height)
+        geometry = new_map.geometry
+
+        # Drawn at the output size with anti-aliasing, the coordinates having
+        # 4 bits of sub-pixel precision
+        shift = 4
+
+        def to_canvas(pts):
+            xs, ys = geometry.wsg84_to_map_xy_array(pts[:, 0], pts[:, 1])
+            return np.round(np.column_stack((xs, ys)) * 2**shift).astype(np.int32)
+
+        img = np.zeros((new_map.height, new_map.width, 4), dtype=np.uint8)
+        img[:, :, :3] = 255
+        for pts in all_segs[: len(seg)]:
+            canvas_pts = [to_canvas(pts)]
+            cv2.polylines(img, canvas_pts, False, white, 22, cv2.LINE_AA, shift)
+            cv2.polylines(img, canvas_pts, False, line_color, 16, cv2.LINE_AA, shift)
+
+        def draw_circle(center, radius, thickness, color, fill=None):
+            # Outlines are drawn inside the circle, as with PIL
+            if fill is not None or thickness >= radius:
+                cv2.circle(
+                    img,
+                    center,
+                    radius * 2**shift,
+                    color if fill is None else fill,
+                    -1,
+                    cv2.LINE_AA,
+                    shift,
                 )
+            if thickness < radius:
+                cv2.circle(
+                    img,
+                    center,
+                    int((radius - thickness / 2) * 2**shift),
+                    color,
+                    thickness,
+                    cv2.LINE_AA,
+                    shift,
+                )
+
+        if waypoints:
+            for center in to_canvas(all_segs[-1]).tolist():
+                draw_circle(center, 66, 22, white, fill=(255, 255, 255, 0))
+                draw_circle(center, 63, 16, line_color)
+                draw_circle(center, 11, 22, white)
+                draw_circle(center, 8, 16, line_color, fill=line_color)
 
-        im = im.resize((int(width), int(height)), resample=Image.Resampling.BICUBIC)
-        out_buffer = BytesIO()
-        im.save(out_buffer, "WEBP", dpi=(72, 72), optimize=True, quality=80)
-        f_new = File(out_buffer)
+        _, buffer = cv2.imencode(".webp", img, [int(cv2.IMWRITE_WEBP_QUALITY), 80])
         new_map.image.save(
             "filename",
-            f_new,
+            ContentFile(buffer.tobytes()),
             save=False,
         )
         return new_map
@@ -1464,6 +1682,9 @@ class Event(models.Model):
     def save(self, *args, **kwargs):
         self.invalidate_cache()
         super().save(*args, **kwargs)
+        Device.invalidate_competitors_windows(
+            self.competitors.values_list("device__aid", flat=True)
+        )
 
     def check_user_permission(self, user):
         if self.privacy == PRIVACY_PRIVATE and (
@@ -1577,6 +1798,9 @@ class Event(models.Model):
             assignation = event.map_assignations.all()[map_index - 1]
             raster_map = assignation.map
             title = assignation.title
+        # The image of a new map is only set once its upload is processed
+        if not raster_map.image:
+            raise Http404
         return event, raster_map, title
 
     @classmethod
@@ -1862,32 +2086,126 @@ class Event(models.Model):
             cache.delete(cache_key)
             cache_key = f"event:{self.aid}:data:{cache_ts - 1}:{cache_suffix}"
             cache.delete(cache_key)
+        cache.delete(f"event:{self.aid}:routes:version")
+
+    def warm_tiles(self, img_mimes, cpu_deadline):
+        """
+        Warm the tiles cache of the maps of the event until the process CPU
+        time reaches cpu_deadline, return the percentage of their tiles cached
+        """
+        warmed = total = 0
+        maps = [self.map] + [
+            assignation.map
+            for assignation in self.map_assignations.select_related("map")
+        ]
+        for raster_map in maps:
+            if not raster_map or not raster_map.image:
+                continue
+            # Maps fully warmed recently are only checked again once in a while
+            report_key = f"map:{raster_map.aid}:{raster_map.hash}:tiles_warmed"
+            report = cache.get(report_key)
+            if not report or report[0] < report[1]:
+                report = raster_map.warm_tiles(img_mimes, cpu_deadline)
+                cache.set(report_key, report, 3600)
+            warmed += report[0]
+            total += report[1]
+        return 100 * warmed / total if total else 100
+
+    @property
+    def routes_version(self):
+        """Random token replaced whenever the tracks of the event change"""
+        version_key = f"event:{self.aid}:routes:version"
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, short_random_key(), None)
+            version = cache.get(version_key)
+        return version
+
+    def routes_tracks(self, zoom):
+        """Tracks of the competitors projected and simplified for a zoom level"""
+        from routechoices.lib.route_tiles import (
+            ROUTE_TILES_MAX_ZOOM,
+            project_tracks,
+            simplify_tracks,
+        )
+
+        zoom = min(zoom, ROUTE_TILES_MAX_ZOOM)
+        cache_key = f"event:{self.aid}:routes:{self.routes_version}:{zoom}"
+        try:
+            tracks = cache.get(cache_key)
+        except Exception:
+            tracks = None
+        if tracks is not None:
+            return tracks
+        full_key = f"event:{self.aid}:routes:{self.routes_version}:full"
+        try:
+            projected = cache.get(full_key)
+        except Exception:
+            projected = None
+        if projected is None:
+            locations = []
+            for competitor, from_date, end_date in self.iterate_competitors():
+                if competitor.device_id:
+                    locs, _ = competitor.device.get_locations_between_dates(
+                        from_date, end_date
+                    )
+                    locations.append((competitor.aid, locs))
+            projected = project_tracks(locations)
+            try:
+                cache.set(full_key, projected, 7 * 24 * 3600)
+            except Exception:
+                pass
+        tracks = simplify_tracks(projected, zoom)
+        try:
+            cache.set(cache_key, tracks, 7 * 24 * 3600)
+        except Exception:
+            pass
+        return tracks
 
     @property
     def has_notice(self):
         return hasattr(self, "notice")
 
-    def thumbnail(self, display_logo, mime="image/jpeg"):
+    def thumbnail_cache_key(self, display_logo, mime):
         if self.start_date > now() or not self.map:
-            cache_key = (
+            return (
                 f"map:{self.aid}:blank:thumbnail:{display_logo}"
                 f":{self.club.modification_date}:{mime}"
             )
-            cached = cache.get(cache_key)
-            if cached:
-                return cached
+        return (
+            f"map:{self.aid}:{self.map.hash}:thumbnail:{display_logo}"
+            f":{self.club.modification_date}:{mime}"
+        )
+
+    def thumbnail(self, display_logo, mime="image/jpeg"):
+        cache_key = self.thumbnail_cache_key(display_logo, mime)
+        return get_thumbnail(
+            cache_key,
+            thumbnail_object_name("events", self.aid, cache_key, mime),
+            partial(self.render_thumbnail, display_logo, mime),
+        )
+
+    def precompute_thumbnails(self):
+        renders = []
+        for display_logo in (True, False):
+            for mime in THUMBNAIL_MIMES:
+                cache_key = self.thumbnail_cache_key(display_logo, mime)
+                renders.append(
+                    (
+                        cache_key,
+                        thumbnail_object_name("events", self.aid, cache_key, mime),
+                        partial(self.render_thumbnail, display_logo, mime),
+                    )
+                )
+        return precompute_thumbnails("events", self.aid, renders)
+
+    def render_thumbnail(self, display_logo, mime):
+        if self.start_date > now() or not self.map:
             img = Image.new("RGB", (1200, 630), "WHITE")
         else:
             raster_map = self.map
-            cache_key = (
-                f"map:{self.aid}:{raster_map.hash}:thumbnail:{display_logo}"
-                f":{self.club.modification_date}:{mime}"
-            )
-            cached = cache.get(cache_key)
-            if cached:
-                return cached
             orig = raster_map.data
-            img = Image.open(BytesIO(orig)).convert("RGBA")
+            img = open_map_image(BytesIO(orig)).convert("RGBA")
             white_bg_img = Image.new("RGBA", img.size, "WHITE")
             white_bg_img.paste(img, (0, 0), img)
             img = white_bg_img.convert("RGB")
@@ -1934,9 +2252,7 @@ class Event(models.Model):
             optimize=True,
             quality=(40 if mime in ("image/webp", "image/avif", "image/jxl") else 80),
         )
-        data_out = buffer.getvalue()
-        cache.set(cache_key, data_out, 31 * 24 * 3600)
-        return data_out
+        return buffer.getvalue()
 
 
 class Notice(models.Model):
@@ -1965,6 +2281,171 @@ class MapAssignation(models.Model):
         ordering = ["id"]
 
 
+def schedule_tiles_pyramids(maps):
+    from routechoices.core.bg_tasks import render_map_tiles_pyramid
+
+    for raster_map in maps:
+        if raster_map and raster_map.image:
+            render_map_tiles_pyramid(raster_map.aid, remove_existing_tasks=True)
+
+
+@receiver(post_save, sender=Map)
+def render_map_tiles_on_save(sender, instance, **kwargs):
+    schedule_tiles_pyramids([instance])
+
+
+@receiver(post_save, sender=Event)
+def render_event_maps_tiles_on_save(sender, instance, **kwargs):
+    maps = [instance.map] + [
+        assignation.map
+        for assignation in instance.map_assignations.select_related("map")
+    ]
+    schedule_tiles_pyramids(maps)
+    delete_unpublished_tiles(
+        [raster_map.id for raster_map in maps if raster_map]
+        + [getattr(instance, "_previous_map_id", None)]
+    )
+
+
+@receiver(post_save, sender=MapAssignation)
+def render_assigned_map_tiles_on_save(sender, instance, **kwargs):
+    schedule_tiles_pyramids([instance.map])
+    delete_unpublished_tiles([getattr(instance, "_previous_map_id", None)])
+
+
+def delete_unpublished_tiles(map_ids):
+    # Tiles written for nginx are served to anyone knowing their URLs, they are
+    # removed once their map is not shown in any public event
+    for raster_map in Map.objects.filter(id__in=[x for x in map_ids if x]):
+        if not raster_map.has_public_events():
+            delete_public_tiles(raster_map.aid)
+
+
+@receiver(pre_save, sender=Event)
+@receiver(pre_save, sender=MapAssignation)
+def remember_previous_map(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_map_id = (
+            sender.objects.filter(pk=instance.pk)
+            .values_list("map_id", flat=True)
+            .first()
+        )
+
+
+@receiver(pre_delete, sender=Event)
+def remember_event_maps(sender, instance, **kwargs):
+    # The assignations are deleted before the event
+    instance._map_ids = [instance.map_id] + list(
+        instance.map_assignations.values_list("map_id", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Event)
+def delete_event_unpublished_tiles(sender, instance, **kwargs):
+    delete_unpublished_tiles(getattr(instance, "_map_ids", [instance.map_id]))
+
+
+@receiver(post_delete, sender=MapAssignation)
+def delete_assignation_unpublished_tiles(sender, instance, **kwargs):
+    delete_unpublished_tiles([instance.map_id])
+
+
+def invalidate_wms_capabilities(event_aids):
+    from routechoices.wms.capabilities import invalidate_capabilities
+
+    invalidate_capabilities(event_aids)
+
+
+@receiver([post_save, post_delete], sender=Event)
+def invalidate_event_wms_capabilities(sender, instance, **kwargs):
+    invalidate_wms_capabilities([instance.aid])
+
+
+@receiver([post_save, post_delete], sender=MapAssignation)
+def invalidate_assignation_wms_capabilities(sender, instance, **kwargs):
+    invalidate_wms_capabilities(
+        Event.objects.filter(id=instance.event_id).values_list("aid", flat=True)
+    )
+
+
+@receiver([post_save, pre_delete], sender=Map)
+def invalidate_map_wms_capabilities(sender, instance, **kwargs):
+    from routechoices.wms.capabilities import map_event_aids
+
+    invalidate_wms_capabilities(map_event_aids(instance))
+
+
+@receiver(post_save, sender=Club)
+def invalidate_club_wms_capabilities(sender, instance, **kwargs):
+    invalidate_wms_capabilities(instance.events.values_list("aid", flat=True))
+
+
+def schedule_events_thumbnails(event_aids):
+    from routechoices.core.bg_tasks import precompute_event_thumbnails
+
+    for event_aid in event_aids:
+        precompute_event_thumbnails(event_aid, remove_existing_tasks=True)
+
+
+@receiver(post_save, sender=Club)
+def precompute_club_thumbnails_on_save(sender, instance, **kwargs):
+    from routechoices.core.bg_tasks import precompute_club_thumbnails
+
+    precompute_club_thumbnails(instance.aid, remove_existing_tasks=True)
+
+
+@receiver(post_save, sender=Club)
+def generate_club_image_variants_on_save(sender, instance, **kwargs):
+    from routechoices.core.bg_tasks import generate_club_image_variants
+
+    if instance.logo or instance.banner:
+        generate_club_image_variants(instance.aid, remove_existing_tasks=True)
+
+
+@receiver(post_save, sender=Event)
+def precompute_event_thumbnails_on_save(sender, instance, **kwargs):
+    from routechoices.core.bg_tasks import precompute_started_event_thumbnails
+
+    schedule_events_thumbnails([instance.aid])
+    # Blank thumbnails are shown until the event starts
+    if instance.start_date > now():
+        precompute_started_event_thumbnails(
+            instance.aid,
+            schedule=instance.start_date,
+            remove_existing_tasks=True,
+        )
+
+
+@receiver(post_save, sender=Map)
+def precompute_map_events_thumbnails_on_save(sender, instance, **kwargs):
+    # The image of a new map is only set once its upload is processed
+    if not instance.image:
+        return
+    schedule_events_thumbnails(
+        Event.objects.filter(map_id=instance.id).values_list("aid", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Club)
+def delete_club_thumbnails(sender, instance, **kwargs):
+    delete_thumbnails("clubs", instance.aid)
+
+
+@receiver(post_delete, sender=Event)
+def delete_event_thumbnails(sender, instance, **kwargs):
+    delete_thumbnails("events", instance.aid)
+
+
+@receiver(post_delete, sender=Map)
+def delete_map_files(sender, instance, **kwargs):
+    delete_pyramids(instance.aid)
+    delete_public_tiles(instance.aid)
+    if instance.image.name:
+        delete_original(instance.image.name)
+    if instance.upload.name:
+        instance.delete_upload()
+
+
 class Device(models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     modification_date = models.DateTimeField(auto_now=True)
@@ -2189,6 +2670,11 @@ class Device(models.Model):
             self.save()
 
         new_pts = list(sorted(new_pts, key=itemgetter(LOCATION_TIMESTAMP_INDEX)))
+        if not self.has_ended_competitors_between_timestamps(
+            new_pts[0][LOCATION_TIMESTAMP_INDEX],
+            new_pts[-1][LOCATION_TIMESTAMP_INDEX],
+        ):
+            return
         archived_events_affected = self.get_events_between_dates(
             epoch_to_datetime(new_pts[0][LOCATION_TIMESTAMP_INDEX]),
             epoch_to_datetime(new_pts[-1][LOCATION_TIMESTAMP_INDEX]),
@@ -2295,6 +2781,41 @@ class Device(models.Model):
             qs = qs.filter(event__end_date__lt=now())
         return {c.event for c in qs}
 
+    @staticmethod
+    def competitors_windows_cache_key(device_aid):
+        return f"device:{device_aid}:competitors_windows"
+
+    @classmethod
+    def invalidate_competitors_windows(cls, device_aids):
+        cache.delete_many(
+            [
+                cls.competitors_windows_cache_key(device_aid)
+                for device_aid in device_aids
+                if device_aid
+            ]
+        )
+
+    def get_competitors_windows(self):
+        """Start and end timestamps of the competitors using this device"""
+        cache_key = self.competitors_windows_cache_key(self.aid)
+        windows = cache.get(cache_key)
+        if windows is None:
+            windows = [
+                ((start_time or event_start).timestamp(), event_end.timestamp())
+                for start_time, event_start, event_end in self.competitor_set.values_list(
+                    "start_time", "event__start_date", "event__end_date"
+                )
+            ]
+            cache.set(cache_key, windows, 24 * 3600)
+        return windows
+
+    def has_ended_competitors_between_timestamps(self, from_ts, to_ts):
+        now_ts = time.time()
+        return any(
+            start_ts <= to_ts and from_ts <= end_ts < now_ts
+            for start_ts, end_ts in self.get_competitors_windows()
+        )
+
     def get_last_competitor(self, load_event=False):
         qs = self.competitor_set.order_by("-start_time")
         if load_event:
@@ -2474,6 +2995,12 @@ class Competitor(models.Model):
                     for event_then in events_at_start:
                         event_then.invalidate_cache()
         super().save(*args, **kwargs)
+        Device.invalidate_competitors_windows(
+            [
+                self.device.aid if self.device else None,
+                old_device.aid if current_self and old_device else None,
+            ]
+        )
         if current_self:
             if old_event != new_event:
                 old_event.invalidate_cache()
@@ -2554,6 +3081,7 @@ class Competitor(models.Model):
 def invalidate_competitor_event_cache(sender, instance, **kwargs):
     instance.event.invalidate_cache()
     if instance.device:
+        Device.invalidate_competitors_windows([instance.device.aid])
         start_time = instance.start_time
         if not start_time:
             start_time = instance.event.start_date
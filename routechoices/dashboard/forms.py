@@ -20,7 +20,6 @@ from django.forms import (
 from PIL import Image
 
 from routechoices.core.models import (
-    WEBP_MAX_SIZE,
     Club,
     Competitor,
     Device,
@@ -31,6 +30,7 @@ from routechoices.core.models import (
     Notice,
 )
 from routechoices.lib.helpers import check_cname_record, get_aware_datetime
+from routechoices.lib.map_processing import MapImageTooLarge, check_map_image
 from routechoices.lib.validators import validate_domain_name, validate_nice_slug
 
 
@@ -241,15 +241,18 @@ class DeviceForm(Form):
 
 
 class MapForm(ModelForm):
+    # Not the model field, the upload is staged until it is processed
+    image = FileField(help_text="Image of map as a PNG, JPEG, GIF, WEBP, or PDF file")
+    field_order = ["name", "image", "corners_coordinates"]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields["image"].help_text = (
-            "Image of map as a PNG, JPEG, GIF, WEBP, or PDF file"
-        )
+        if self.instance.image:
+            self.initial["image"] = self.instance.image
 
     class Meta:
         model = Map
-        fields = ["name", "image", "corners_coordinates"]
+        fields = ["name", "corners_coordinates"]
 
     def clean_corners_coordinates(self):
         cc = self.cleaned_data["corners_coordinates"]
@@ -265,21 +268,17 @@ class MapForm(ModelForm):
         f_orig = self.cleaned_data["image"]
         if "image" not in self.changed_data:
             return f_orig
-        fn = f_orig.name
-        with Image.open(f_orig.file) as image:
-            rgba_img = image.convert("RGBA")
-            format = "WEBP"
-            if rgba_img.size[0] > WEBP_MAX_SIZE or rgba_img.size[1] > WEBP_MAX_SIZE:
-                format = "PNG"
-            out_buffer = BytesIO()
-            params = {
-                "dpi": (72, 72),
-            }
-            if format == "WEBP":
-                params["quality"] = 80
-            rgba_img.save(out_buffer, format, optimize=True, **params)
-            f_new = File(out_buffer, name=fn)
-            return f_new
+        # The image is stripped of its metadata by a background task
+        try:
+            check_map_image(f_orig.file)
+        except MapImageTooLarge as e:
+            raise ValidationError(str(e))
+        except Exception:
+            raise ValidationError(
+                "Upload a valid image. The file you uploaded was either not an "
+                "image or a corrupted image."
+            )
+        return f_orig
 
 
 class EventSetForm(ModelForm):
@@ -12,6 +12,7 @@ from PIL import Image
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
+from routechoices.core.bg_tasks import process_map_upload
 from routechoices.core.models import (
     Club,
     Competitor,
@@ -388,6 +389,20 @@ class TestDashboard(EssentialDashboardBase):
         self.assertEqual(res.status_code, status.HTTP_302_FOUND)
 
         raster_map.refresh_from_db()
+        self.assertEqual(raster_map.processing, {"progress": 0, "error": None})
+        # The upload is staged, the previous image is served until processed
+        self.assertTrue(raster_map.upload.name.startswith("map-uploads/"))
+        self.assertEqual(raster_map.mime_type, "image/png")
+        upload_name = raster_map.upload.name
+        # Edits made while the upload is processed are kept
+        Map.objects.filter(id=raster_map.id).update(name="Renamed")
+        process_map_upload.now(raster_map.aid)
+        raster_map.refresh_from_db()
+        self.assertEqual(raster_map.name, "Renamed")
+        self.assertIsNone(raster_map.processing)
+        self.assertFalse(raster_map.upload)
+        self.assertFalse(raster_map.upload.storage.exists(upload_name))
+        self.assertEqual(raster_map.mime_type, "image/webp")
         url = raster_map.image.url
         res = self.client.get(url)
 
@@ -403,6 +418,30 @@ class TestDashboard(EssentialDashboardBase):
         self.assertEqual(res.status_code, status.HTTP_302_FOUND)
         self.assertFalse(Map.objects.filter(id=raster_map.id).exists())
 
+    def test_map_from_gpx(self):
+        url = self.reverse_and_check(
+            "dashboard:map_upload_gpx_view",
+            "/dashboard/maps/upload-gpx",
+        )
+        gpx_file = SimpleUploadedFile(
+            "route.gpx",
+            b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="Test">
+<wpt lat="61.44" lon="24.20"></wpt>
+<trk><trkseg>
+<trkpt lat="61.45" lon="24.19"></trkpt>
+<trkpt lat="61.44" lon="24.21"></trkpt>
+<trkpt lat="61.43" lon="24.20"></trkpt>
+</trkseg></trk>
+</gpx>""",
+            content_type="application/gpx+xml",
+        )
+        res = self.client.post(url, {"gpx_file": gpx_file})
+        self.assertEqual(res.status_code, status.HTTP_302_FOUND)
+        raster_map = Map.objects.get(club=self.club)
+        self.assertEqual(raster_map.mime_type, "image/webp")
+        self.assertEqual((raster_map.width, raster_map.height), (2112, 4200))
+
     def test_edit_event_sets(self):
         # Create event set
         url = self.reverse_and_check(
@@ -1,10 +1,10 @@
 import math
-import os
+import posixpath
 import shutil
 import tempfile
 import zipfile
 from copy import deepcopy
-from io import BytesIO, StringIO
+from io import StringIO
 
 import gpxpy
 from allauth.account import app_settings as allauth_settings
@@ -35,7 +35,6 @@ from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.timezone import now
 from hijack.views import ReleaseUserView
 from kagi.views.backup_codes import BackupCodesView
-from PIL import Image
 from user_sessions.views import SessionDeleteOtherView
 
 from invitations.forms import InviteForm
@@ -74,6 +73,7 @@ from routechoices.lib.helpers import (
     short_random_key,
 )
 from routechoices.lib.kmz import extract_ground_overlay_info
+from routechoices.lib.map_processing import MapImageTooLarge, check_map_image
 from routechoices.lib.streaming_response import StreamingHttpRangeResponse
 
 DEFAULT_PAGE_SIZE = 25
@@ -513,7 +513,14 @@ def map_list_view(request):
     paginator = Paginator(map_list, DEFAULT_PAGE_SIZE)
     page = request.GET.get("page")
     maps = paginator.get_page(page)
-    return render(request, "dashboard/map_list.html", {"club": club, "maps": maps})
+    processing = any(
+        raster_map.processing and not raster_map.processing_error for raster_map in maps
+    )
+    return render(
+        request,
+        "dashboard/map_list.html",
+        {"club": club, "maps": maps, "processing": processing},
+    )
 
 
 @login_required
@@ -527,7 +534,9 @@ def map_create_view(request):
         form.instance.club = club
         # check whether it's valid:
         if form.is_valid():
-            form.save()
+            form.instance.stage_upload(form.cleaned_data["image"])
+            raster_map = form.save()
+            raster_map.process_upload()
             messages.success(request, "Map created successfully")
             return redirect("dashboard:map_list_view")
     else:
@@ -556,7 +565,16 @@ def map_edit_view(request, map_id):
         form.instance.club = club
         # check whether it's valid:
         if form.is_valid():
-            form.save()
+            # Only the edited fields are written, the processing task may
+            # replace the image meanwhile
+            update_fields = ["name", "club", "corners_coordinates", "modification_date"]
+            image_changed = "image" in form.changed_data
+            if image_changed:
+                form.instance.stage_upload(form.cleaned_data["image"])
+                update_fields += ["upload", "processing_progress", "processing_error"]
+            form.instance.save(update_fields=update_fields)
+            if image_changed:
+                form.instance.process_upload()
             messages.success(request, "Changes saved successfully")
             return redirect("dashboard:map_list_view")
     else:
@@ -727,73 +745,80 @@ def map_kmz_upload_view(request):
             file = form.cleaned_data["file"]
             error = None
             kml = None
-            is_kml = False
-            dest = None
+            zf = None
             if file.name.lower().endswith(".kmz"):
+                # Members are read from the archive as needed, not extracted
                 try:
-                    dest = tempfile.mkdtemp("_kmz")
                     zf = zipfile.ZipFile(file)
-                    zf.extractall(dest)
-                    if os.path.exists(os.path.join(dest, "Doc.kml")):
+                    names = zf.namelist()
+                    if "Doc.kml" in names:
                         doc_file = "Doc.kml"
-                    elif os.path.exists(os.path.join(dest, "doc.kml")):
+                    elif "doc.kml" in names:
                         doc_file = "doc.kml"
                     else:
                         raise Exception("No valid doc.kml file")
-                    with open(os.path.join(dest, doc_file), "r", encoding="utf-8") as f:
-                        kml = f.read().encode("utf8")
+                    kml = zf.read(doc_file)
                 except Exception:
                     error = "An error occured while extracting the map from this file."
             elif file.name.lower().endswith(".kml"):
                 kml = file.read()
-                is_kml = True
             if kml:
                 try:
                     overlays = extract_ground_overlay_info(kml)
                     for data in overlays:
                         name, image_path, corners_coords = data
-                        file_data = None
                         if not name:
                             name = "Untitled"
+                        file_data = tempfile.TemporaryFile()
                         if image_path.startswith("http://") or image_path.startswith(
                             "https://"
                         ):
-                            r = requests.get(image_path, timeout=10)
+                            r = requests.get(image_path, timeout=10, stream=True)
                             if r.status_code != 200:
                                 raise Exception("Could not reach image source")
-                            file_data = BytesIO(r.content)
-                        elif not is_kml:
-                            image_path = os.path.abspath(os.path.join(dest, image_path))
-                            if not image_path.startswith(dest):
+                            size = 0
+                            for chunk in r.iter_content(chunk_size=65536):
+                                size += len(chunk)
+                                if size > settings.MAP_IMPORT_MAX_BYTES:
+                                    r.close()
+                                    raise MapImageTooLarge("Image file is too large.")
+                                file_data.write(chunk)
+                        elif zf:
+                            image_path = posixpath.normpath(image_path)
+                            if image_path.startswith(("/", "../")):
                                 raise Exception("Fishy KMZ")
-                            file_data = open(image_path, "rb")
+                            if (
+                                zf.getinfo(image_path).file_size
+                                > settings.MAP_IMPORT_MAX_BYTES
+                            ):
+                                raise MapImageTooLarge("Image file is too large.")
+                            with zf.open(image_path) as member:
+                                shutil.copyfileobj(member, file_data)
                         else:
                             raise Exception("Fishy KMZ")
-                        if file_data:
-                            image_file = File(file_data)
-                            new_map = Map(
-                                name=name,
-                                club=club,
-                                corners_coordinates=corners_coords,
-                            )
-                            new_map.image.save("file", image_file, save=False)
-                            new_maps.append(new_map)
+                        check_map_image(file_data)
+                        new_map = Map(
+                            name=name,
+                            club=club,
+                            corners_coordinates=corners_coords,
+                        )
+                        new_map.stage_upload(File(file_data, name="file"))
+                        file_data.close()
+                        new_maps.append(new_map)
+                except MapImageTooLarge as e:
+                    error = str(e)
                 except Exception:
                     error = (
                         "An error occured while extracting the map(s) from this file."
                     )
-            if dest:
-                shutil.rmtree(dest, ignore_errors=True)
             if error:
+                for new_map in new_maps:
+                    new_map.delete_upload()
                 messages.error(request, error)
             elif new_maps:
                 for new_map in new_maps:
-                    try:
-                        new_map.strip_exif()
-                    except Image.DecompressionBombError:
-                        error = "Image is too large, try to use lower resolution."
-                    else:
-                        new_map.save()
+                    new_map.save()
+                    new_map.process_upload()
                 messages.success(
                     request,
                     (
@@ -932,7 +957,8 @@ def event_list_view(request):
 def event_create_view(request):
     club = request.club
 
-    map_list = Map.objects.filter(club=club)
+    # Maps are shown in events once their uploaded image is processed
+    map_list = Map.objects.filter(club=club).exclude(image="")
     event_set_list = EventSet.objects.filter(club=club)
 
     if request.method == "POST":
@@ -1042,7 +1068,8 @@ def event_edit_view(request, event_id):
         aid=event_id,
     )
 
-    map_list = Map.objects.filter(club=club)
+    # Maps are shown in events once their uploaded image is processed
+    map_list = Map.objects.filter(club=club).exclude(image="")
     event_set_list = EventSet.objects.filter(club=club)
 
     use_competitor_formset = (
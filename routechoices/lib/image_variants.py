@@ -0,0 +1,100 @@
+import logging
+from io import BytesIO
+
+import cv2
+import numpy as np
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Formats negotiated with the browsers, on top of the default one of an image
+VARIANT_MIMES = ("image/webp", "image/avif", "image/jxl")
+# Stored variants are checked again once in a while, a deleted one is then
+# stored again by the next request instead of being redirected to
+VARIANT_CACHE_TIMEOUT = 3600
+# Icons of the club sites scaled from their logo
+LOGO_ICONS = {
+    "favicon.ico": {"size": 32, "format": "ICO", "mime": "image/x-icon"},
+    "apple-touch-icon.png": {"size": 180, "format": "PNG", "mime": "image/png"},
+    "icon-192.png": {"size": 192, "format": "PNG", "mime": "image/png"},
+    "icon-512.png": {"size": 512, "format": "PNG", "mime": "image/png"},
+}
+
+
+def variant_name(name, mime):
+    """Variants are stored next to the original image"""
+    return f"{name}.{mime[6:]}"
+
+
+def scaled_variant_name(name, size, ext):
+    return f"{name}_{size}.{ext.lower()}"
+
+
+def variant_mimes(default_mime):
+    return (default_mime,) + tuple(m for m in VARIANT_MIMES if m != default_mime)
+
+
+def encode_variant(data, mime, img_mode=None):
+    nparr = np.frombuffer(data, np.uint8)
+    cv2_image = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+    color_corrected_img = cv2.cvtColor(np.array(cv2_image), cv2.COLOR_BGR2RGBA)
+    pil_image = Image.fromarray(color_corrected_img)
+    if img_mode and pil_image.mode != img_mode:
+        pil_image = pil_image.convert("RGB")
+    out_buffer = BytesIO()
+    pil_image.save(
+        out_buffer,
+        mime[6:].upper(),
+        optimize=True,
+        quality=(40 if mime in ("image/avif", "image/jxl") else 80),
+    )
+    return out_buffer.getvalue()
+
+
+def has_variant(image_field, mime):
+    cache_key = f"s3:image:{image_field.name}:{mime}:stored"
+    stored = cache.get(cache_key)
+    if stored is None:
+        stored = image_field.storage.exists(variant_name(image_field.name, mime))
+        try:
+            cache.set(cache_key, stored, VARIANT_CACHE_TIMEOUT)
+        except Exception:
+            pass
+    return stored
+
+
+def store_variant(image_field, mime, img_mode=None, data=None):
+    """Encode the image in the given format, store it and return its content"""
+    if data is None:
+        with image_field.storage.open(image_field.name) as fp:
+            data = fp.read()
+    variant = encode_variant(data, mime, img_mode)
+    image_field.storage.save(variant_name(image_field.name, mime), ContentFile(variant))
+    try:
+        cache.set(
+            f"s3:image:{image_field.name}:{mime}:stored", True, VARIANT_CACHE_TIMEOUT
+        )
+    except Exception:
+        pass
+    return variant
+
+
+def generate_variants(image_field, default_mime, img_mode=None):
+    """Store the variants of an image not stored yet, return how many were"""
+    data = None
+    count = 0
+    for mime in variant_mimes(default_mime):
+        if has_variant(image_field, mime):
+            continue
+        if data is None:
+            with image_field.storage.open(image_field.name) as fp:
+                data = fp.read()
+        try:
+            store_variant(image_field, mime, img_mode, data)
+        except Exception:
+            logger.exception("Could not store %s variant of %s", mime, image_field.name)
+            continue
+        count += 1
+    return count
@@ -0,0 +1,276 @@
+import math
+from functools import cached_property, lru_cache
+
+import numpy as np
+
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.helpers import (
+    adjugate_matrix,
+    avg_angles,
+    distance_latlon,
+    distance_xy,
+    general_2d_projection,
+    project,
+)
+
+GLOBAL_MERCATOR = GlobalMercator()
+
+
+class Point:
+    def __init__(self, x, y=None):
+        if isinstance(x, tuple):
+            self.x = x[0]
+            self.y = x[1]
+        elif isinstance(x, dict):
+            self.x = x.get("x")
+            self.y = x.get("y")
+        else:
+            self.x = x
+            self.y = y
+
+    def __repr__(self):
+        return f"x: {self.x}, y:{self.y}"
+
+
+def latlon_to_meters_array(lats, lons):
+    """Vectorized GlobalMercator.latlon_to_meters"""
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    xs = lons * GLOBAL_MERCATOR.originShift / 180.0
+    ys = (
+        np.log(np.tan((90 + lats) * math.pi / 360.0))
+        * GLOBAL_MERCATOR.originShift
+        / math.pi
+    )
+    return xs, ys
+
+
+def project_array(m, xs, ys):
+    """Vectorized helpers.project"""
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    w = m[6] * xs + m[7] * ys + m[8]
+    w = np.where(w == 0, 0.000000001, w)
+    return (m[0] * xs + m[1] * ys + m[2]) / w, (m[3] * xs + m[4] * ys + m[5]) / w
+
+
+def quad_separating_axes(corners_xy):
+    """
+    Return the normals of the edges of a quad and the intervals of the
+    projections of the quad on them
+    """
+    corners = np.array(corners_xy, dtype=np.float64)
+    edges = np.roll(corners, -1, axis=0) - corners
+    normals = np.stack([-edges[:, 1], edges[:, 0]], axis=1)
+    projections = corners @ normals.T
+    return normals, projections.min(axis=0), projections.max(axis=0)
+
+
+def quad_intersects_bboxes(corners_xy, bboxes):
+    """
+    Separating axis test of a convex quad against bounding boxes given as rows
+    of min_x, max_x, min_y, max_y, returns an array of booleans
+    """
+    corners = np.array(corners_xy, dtype=np.float64)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    intersects = (
+        (bboxes[:, 1] >= corners[:, 0].min())
+        & (bboxes[:, 0] <= corners[:, 0].max())
+        & (bboxes[:, 3] >= corners[:, 1].min())
+        & (bboxes[:, 2] <= corners[:, 1].max())
+    )
+    centers = (
+        np.stack([bboxes[:, 0] + bboxes[:, 1], bboxes[:, 2] + bboxes[:, 3]], axis=1) / 2
+    )
+    half_sizes = (
+        np.stack([bboxes[:, 1] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 2]], axis=1) / 2
+    )
+    normals, quad_min, quad_max = quad_separating_axes(corners)
+    projected_centers = centers @ normals.T
+    projected_radius = half_sizes @ np.abs(normals).T
+    intersects &= (
+        (projected_centers + projected_radius >= quad_min)
+        & (projected_centers - projected_radius <= quad_max)
+    ).all(axis=1)
+    return intersects
+
+
+class MapGeometry:
+    """
+    Projections between the pixels of a map image and the world, computed once
+    per corners coordinates and image size, use get_map_geometry to build one
+    """
+
+    def __init__(self, corners_coordinates, width, height):
+        coords = tuple(float(x) for x in corners_coordinates.split(","))
+        self.width = width
+        self.height = height
+        self.top_left = {"lat": coords[0], "lon": coords[1]}
+        self.top_right = {"lat": coords[2], "lon": coords[3]}
+        self.bottom_right = {"lat": coords[4], "lon": coords[5]}
+        self.bottom_left = {"lat": coords[6], "lon": coords[7]}
+        lats = coords[0::2]
+        lons = coords[1::2]
+        self.min_lat, self.max_lat = min(lats), max(lats)
+        self.min_lon, self.max_lon = min(lons), max(lons)
+
+        m = general_2d_projection(*self.alignment_points)
+        if m[8]:
+            self.matrix_3d = tuple(x / m[8] for x in m)
+            self.matrix_3d_inverse = tuple(adjugate_matrix(self.matrix_3d))
+        else:
+            self.matrix_3d = None
+            self.matrix_3d_inverse = None
+
+    @property
+    def bound(self):
+        return {
+            "topLeft": dict(self.top_left),
+            "topRight": dict(self.top_right),
+            "bottomRight": dict(self.bottom_right),
+            "bottomLeft": dict(self.bottom_left),
+        }
+
+    @property
+    def alignment_points(self):
+        a1 = Point(0, 0)
+        b1 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.top_left))
+        a2 = Point(0, self.height)
+        b2 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bottom_left))
+        a3 = Point(self.width, 0)
+        b3 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.top_right))
+        a4 = Point(self.width, self.height)
+        b4 = Point(GLOBAL_MERCATOR.latlon_to_meters(self.bottom_right))
+        return a1, a2, a3, a4, b1, b2, b3, b4
+
+    def map_xy_to_spherical_mercator(self, x, y):
+        if not self.matrix_3d:
+            return 0, 0
+        return project(self.matrix_3d, x, y)
+
+    def spherical_mercator_to_map_xy(self, x, y):
+        return project(self.matrix_3d_inverse, x, y)
+
+    def map_xy_to_spherical_mercator_array(self, xs, ys):
+        if not self.matrix_3d:
+            return np.zeros(np.shape(xs)), np.zeros(np.shape(ys))
+        return project_array(self.matrix_3d, xs, ys)
+
+    def spherical_mercator_to_map_xy_array(self, xs, ys):
+        return project_array(self.matrix_3d_inverse, xs, ys)
+
+    def wsg84_to_map_xy_array(self, lats, lons):
+        return self.spherical_mercator_to_map_xy_array(
+            *latlon_to_meters_array(lats, lons)
+        )
+
+    def map_xy_to_wsg84(self, x, y):
+        mx, my = self.map_xy_to_spherical_mercator(x, y)
+        return GLOBAL_MERCATOR.meters_to_latlon({"x": mx, "y": my})
+
+    @cached_property
+    def corners_xy(self):
+        return (
+            self.map_xy_to_spherical_mercator(0, 0),
+            self.map_xy_to_spherical_mercator(self.width, 0),
+            self.map_xy_to_spherical_mercator(self.width, self.height),
+            self.map_xy_to_spherical_mercator(0, self.height),
+        )
+
+    @cached_property
+    def corners_aabb(self):
+        xs = [corner[0] for corner in self.corners_xy]
+        ys = [corner[1] for corner in self.corners_xy]
+        return min(xs), max(xs), min(ys), max(ys)
+
+    @cached_property
+    def separating_axes(self):
+        normals, quad_min, quad_max = quad_separating_axes(self.corners_xy)
+        return tuple(
+            (float(nx), float(ny), float(axis_min), float(axis_max))
+            for (nx, ny), axis_min, axis_max in zip(normals, quad_min, quad_max)
+        )
+
+    def intersects_with_bbox(self, min_x, max_x, min_y, max_y):
+        """Whether a spherical mercator bounding box intersects with the map"""
+        corners_min_x, corners_max_x, corners_min_y, corners_max_y = self.corners_aabb
+        if (
+            max_x < corners_min_x
+            or min_x > corners_max_x
+            or max_y < corners_min_y
+            or min_y > corners_max_y
+        ):
+            return False
+        # Plain floats beat NumPy on a single box, see quad_intersects_bboxes
+        center_x = (min_x + max_x) / 2
+        center_y = (min_y + max_y) / 2
+        half_width = (max_x - min_x) / 2
+        half_height = (max_y - min_y) / 2
+        for nx, ny, axis_min, axis_max in self.separating_axes:
+            projected_center = nx * center_x + ny * center_y
+            projected_radius = abs(nx) * half_width + abs(ny) * half_height
+            if (
+                projected_center + projected_radius < axis_min
+                or projected_center - projected_radius > axis_max
+            ):
+                return False
+        return True
+
+    def intersects_with_bboxes(self, bboxes):
+        return quad_intersects_bboxes(self.corners_xy, bboxes)
+
+    @cached_property
+    def resolution(self):
+        """Return map image resolution in pixels/meters"""
+        ll_a = self.map_xy_to_wsg84(0, 0)
+        ll_b = self.map_xy_to_wsg84(self.width, 0)
+        ll_c = self.map_xy_to_wsg84(self.width, self.height)
+        ll_d = self.map_xy_to_wsg84(0, self.height)
+        resolution = (
+            distance_xy(0, 0, 0, self.height)
+            + distance_xy(0, self.height, self.width, self.height)
+            + distance_xy(self.width, self.height, self.width, 0)
+            + distance_xy(self.width, 0, 0, 0)
+        ) / (
+            distance_latlon(ll_a, ll_b)
+            + distance_latlon(ll_b, ll_c)
+            + distance_latlon(ll_c, ll_d)
+            + distance_latlon(ll_d, ll_a)
+        )
+        return resolution
+
+    @cached_property
+    def center(self):
+        return self.map_xy_to_wsg84(self.width / 2, self.height / 2)
+
+    @cached_property
+    def max_zoom(self):
+        center_latitude = self.center["lat"]
+        meters_per_pixel_at_zoom_18 = (
+            40_075_016.686 * math.cos(center_latitude * math.pi / 180) / (2 ** (18 + 8))
+        )
+        r = self.resolution / meters_per_pixel_at_zoom_18
+        return math.floor(math.log2(r)) + 18
+
+    @cached_property
+    def rotation(self):
+        tl, tr, br, bl = self.corners_xy
+
+        rot_vert_left = (
+            (math.atan2(tl[1] - bl[1], tl[0] - bl[0]) - math.pi / 2) * 180 / math.pi
+        )
+        rot_vert_right = (
+            (math.atan2(tr[1] - br[1], tr[0] - br[0]) - math.pi / 2) * 180 / math.pi
+        )
+        rot_vert = (avg_angles(rot_vert_left, rot_vert_right)) % 360
+
+        rot_hori_top = (math.atan2(tr[1] - tl[1], tr[0] - tl[0])) * 180 / math.pi
+        rot_hori_bottom = (math.atan2(br[1] - bl[1], br[0] - bl[0])) * 180 / math.pi
+        rot_hori = avg_angles(rot_hori_top, rot_hori_bottom) % 360
+
+        return round(avg_angles(rot_vert, rot_hori), 2)
+
+
+@lru_cache(maxsize=1024)
+def get_map_geometry(corners_coordinates, width, height):
+    return MapGeometry(corners_coordinates, width, height)
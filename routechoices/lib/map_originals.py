@@ -0,0 +1,166 @@
+import mmap
+import os
+import os.path
+import struct
+import time
+
+from django.conf import settings
+
+from routechoices.lib.helpers import safe64encodedsha, short_random_key
+
+# A local copy is the image followed by its ETag and the length of the ETag,
+# both are replaced at once
+ETAG_LENGTH = struct.Struct(">H")
+
+
+def original_path(image_name):
+    return os.path.join(settings.MAP_ORIGINALS_ROOT, safe64encodedsha(image_name))
+
+
+def checked_path(path):
+    """The modification time of this file is the last revalidation of a copy"""
+    return f"{path}.checked"
+
+
+def mark_checked(path):
+    try:
+        with open(checked_path(path), "a"):
+            pass
+        os.utime(checked_path(path))
+    except OSError:
+        pass
+
+
+def write_etag(fp, etag):
+    """Append the ETag to a local copy once its image is written"""
+    etag = etag.encode()
+    fp.write(etag)
+    fp.write(ETAG_LENGTH.pack(len(etag)))
+
+
+def map_file(path):
+    """
+    Return the ETag of a local copy and a read only memoryview of its image,
+    memory mapped from the file
+    """
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size < ETAG_LENGTH.size:
+            raise OSError(f"Truncated copy {path}")
+        # The mapping stays valid after the file is closed or unlinked
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    (etag_length,) = ETAG_LENGTH.unpack(data[-ETAG_LENGTH.size :])
+    etag_start = len(data) - ETAG_LENGTH.size - etag_length
+    if etag_start < 0:
+        raise OSError(f"Truncated copy {path}")
+    etag = bytes(data[etag_start : -ETAG_LENGTH.size]).decode("ascii", "replace")
+    return etag, data[:etag_start]
+
+
+def is_stale(path, etag, storage, image_name):
+    """
+    Compare the ETag of the local copy with the one on the storage, at most
+    once every MAP_ORIGINALS_REVALIDATE_SECONDS
+    """
+    try:
+        checked_at = os.path.getmtime(checked_path(path))
+    except OSError:
+        checked_at = 0
+    if checked_at >= time.time() - settings.MAP_ORIGINALS_REVALIDATE_SECONDS:
+        return False
+    try:
+        current_etag = storage.etag(image_name)
+    except FileNotFoundError:
+        return True
+    except Exception:
+        # Keep serving the local copy while the storage is unreachable
+        return False
+    if current_etag != etag:
+        return True
+    mark_checked(path)
+    return False
+
+
+def store_original(storage, image_name):
+    """Download a map image from the storage into the local store"""
+    path = original_path(image_name)
+    os.makedirs(settings.MAP_ORIGINALS_ROOT, exist_ok=True)
+    tmp_path = os.path.join(settings.MAP_ORIGINALS_ROOT, f".{short_random_key()}")
+    try:
+        with open(tmp_path, "wb") as fp:
+            etag = storage.download(image_name, fp)
+            write_etag(fp, etag)
+        os.replace(tmp_path, path)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    mark_checked(path)
+    return path
+
+
+def load_original(storage, image_name):
+    """
+    Return the content of a map image as a memoryview of its local copy,
+    downloading it when it is missing or was changed on the storage
+    """
+    path = original_path(image_name)
+    data = None
+    try:
+        etag, data = map_file(path)
+    except OSError:
+        pass
+    if data is not None and is_stale(path, etag, storage, image_name):
+        data = None
+    if data is None:
+        _, data = map_file(store_original(storage, image_name))
+        evict_originals(settings.MAP_ORIGINALS_MAX_BYTES)
+        return data
+    # The modification time of a copy is its last access time for eviction,
+    # only refresh it once in a while to avoid a write on every read
+    try:
+        if os.path.getmtime(path) < time.time() - 60:
+            os.utime(path)
+    except OSError:
+        pass
+    return data
+
+
+def delete_original(image_name):
+    path = original_path(image_name)
+    for file_path in (path, checked_path(path)):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+
+def evict_originals(max_bytes):
+    """Delete the least recently used copies until the store fits in max_bytes"""
+    originals = []
+    total_size = 0
+    with os.scandir(settings.MAP_ORIGINALS_ROOT) as it:
+        for entry in it:
+            if entry.name.startswith(".") or entry.name.endswith(".checked"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            originals.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    originals.sort()
+    for _, size, path in originals:
+        if total_size <= max_bytes:
+            break
+        # Workers having the file mapped keep a valid mapping after the unlink
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        try:
+            os.remove(checked_path(path))
+        except OSError:
+            pass
+    return total_size
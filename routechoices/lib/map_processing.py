@@ -0,0 +1,120 @@
+import struct
+import threading
+import zlib
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Rows of the image converted and compressed at once
+STRIP_HEIGHT = 256
+# 72 dpi in pixels per meter
+PNG_72_DPI = 2835
+WEBP_MAX_SIZE = 16383
+# Pillow stores decoded RGB and RGBA images with 4 bytes per pixel
+DECODED_PIXEL_BYTES = 4
+
+_open_lock = threading.Lock()
+
+
+class MapImageTooLarge(Exception):
+    pass
+
+
+def open_map_image(fp):
+    """
+    Open a map image without the decompression bomb check of Pillow, which
+    is process wide, map images are checked against the map limits instead
+    """
+    with _open_lock:
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(fp)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def check_map_image(fp):
+    """
+    Return the size of a map image read from its header only, raise
+    MapImageTooLarge if it has more than MAP_MAX_PIXELS pixels or can not be
+    decoded within MAP_PROCESSING_MAX_BYTES
+    """
+    fp.seek(0)
+    with open_map_image(fp) as image:
+        width, height = image.size
+    fp.seek(0)
+    if (
+        width * height > settings.MAP_MAX_PIXELS
+        or width * height * DECODED_PIXEL_BYTES > settings.MAP_PROCESSING_MAX_BYTES
+    ):
+        raise MapImageTooLarge(
+            f"Image is too large ({width}x{height} pixels), "
+            "try to use lower resolution."
+        )
+    return width, height
+
+
+def png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def write_png_strips(image, out_fp, progress=None):
+    """
+    Write an image as a RGBA PNG converting and compressing it by strips of
+    rows. Pillow decodes the whole source on the first strip, only the
+    converted copy and the compression buffers are bounded by the strip size.
+    """
+    width, height = image.size
+    out_fp.write(PNG_SIGNATURE)
+    out_fp.write(
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    )
+    out_fp.write(png_chunk(b"pHYs", struct.pack(">IIB", PNG_72_DPI, PNG_72_DPI, 1)))
+    compressor = zlib.compressobj(6)
+    for top in range(0, height, STRIP_HEIGHT):
+        bottom = min(height, top + STRIP_HEIGHT)
+        strip = np.asarray(image.crop((0, top, width, bottom)).convert("RGBA"))
+        strip = strip.reshape(bottom - top, 4 * width)
+        # Each row starts with its filter type, Sub stores the difference with
+        # the pixel on the left which compresses the flat areas of maps well
+        rows = np.empty((bottom - top, 4 * width + 1), dtype=np.uint8)
+        rows[:, 0] = 1
+        rows[:, 1:5] = strip[:, :4]
+        np.subtract(strip[:, 4:], strip[:, :-4], out=rows[:, 5:])
+        data = compressor.compress(rows.tobytes())
+        if data:
+            out_fp.write(png_chunk(b"IDAT", data))
+        if progress:
+            progress(bottom / height)
+    out_fp.write(png_chunk(b"IDAT", compressor.flush()))
+    out_fp.write(png_chunk(b"IEND", b""))
+    return "PNG"
+
+
+def strip_map_image(in_fp, out_fp, progress=None):
+    """
+    Re-encode a map image without its metadata, as WebP when it is small
+    enough to be encoded at once, else as a PNG written strip by strip.
+    Return the format used.
+    """
+    width, height = check_map_image(in_fp)
+    with open_map_image(in_fp) as image:
+        if (
+            width * height > settings.MAP_WEBP_MAX_PIXELS
+            or max(width, height) > WEBP_MAX_SIZE
+        ):
+            return write_png_strips(image, out_fp, progress)
+        image.convert("RGBA").save(
+            out_fp, "WEBP", optimize=True, dpi=(72, 72), quality=80
+        )
+    if progress:
+        progress(1)
+    return "WEBP"
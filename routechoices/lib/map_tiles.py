@@ -0,0 +1,742 @@
+import json
+import math
+import os
+import os.path
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+
+import cv2
+import magic
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image
+
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.helpers import short_random_key, shortsafe64encodedsha
+from routechoices.lib.map_geometry import quad_intersects_bboxes
+from routechoices.lib.map_processing import open_map_image
+from routechoices.lib.slippy_tiles import tile_xy_to_north_west_latlon
+
+GLOBAL_MERCATOR = GlobalMercator()
+TILE_SIZE = 256
+# Size of the WMS tiles of the event page map layers
+FRONTEND_TILE_SIZE = 512
+PYRAMID_INFO_FILE = "pyramid.json"
+
+TILE_EXTENSIONS = {
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/jpeg": "jpeg",
+    "image/avif": "avif",
+    "image/jxl": "jxl",
+}
+
+TILE_MIMES = {ext: mime for mime, ext in TILE_EXTENSIONS.items()}
+
+
+def decode_map_image(data):
+    """Decode a map image file content to a BGRA array"""
+    mime_type = magic.from_buffer(bytes(data[:2048]), mime=True)
+    if mime_type == "image/gif":
+        img = open_map_image(BytesIO(data)).convert("RGBA")
+        return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGRA)
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    return cv2.cvtColor(np.array(img), cv2.COLOR_BGR2BGRA)
+
+
+def build_mip_chain(img_alpha):
+    """
+    Return the map image followed by its successive halvings, down to the
+    level where it fits in a tile
+    """
+    levels = [img_alpha]
+    while max(levels[-1].shape[:2]) > 2 * TILE_SIZE and min(levels[-1].shape[:2]) > 1:
+        height, width = levels[-1].shape[:2]
+        levels.append(
+            cv2.resize(
+                levels[-1],
+                ((width + 1) // 2, (height + 1) // 2),
+                interpolation=cv2.INTER_AREA,
+            )
+        )
+    return levels
+
+
+def mip_chain_length(width, height):
+    """Return the number of levels of the mip chain of an image of given size"""
+    nb_levels = 1
+    while max(width, height) > 2 * TILE_SIZE and min(width, height) > 1:
+        width, height = (width + 1) // 2, (height + 1) // 2
+        nb_levels += 1
+    return nb_levels
+
+
+def raster_dir(map_aid, image_name):
+    return os.path.join(
+        settings.RASTER_STORE_ROOT,
+        f"{map_aid}_{shortsafe64encodedsha(image_name)[:8]}",
+    )
+
+
+def load_raster(map_aid, image_name, level):
+    """
+    Return a memory mapped level of the decoded mip chain of a map image, or
+    None if it is not in the raster store
+    """
+    path = os.path.join(raster_dir(map_aid, image_name), f"{level}.npy")
+    try:
+        img_alpha = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    # The modification time of a raster is its last access time for eviction,
+    # only refresh it once in a while to avoid a write on every tile
+    try:
+        if os.path.getmtime(path) < time.time() - 60:
+            os.utime(path)
+    except OSError:
+        pass
+    return img_alpha
+
+
+def store_rasters(map_aid, image_name, levels):
+    """Persist the decoded mip chain of a map image in the raster store"""
+    root = raster_dir(map_aid, image_name)
+    os.makedirs(root, exist_ok=True)
+    for i, img_alpha in enumerate(levels):
+        tmp_path = os.path.join(root, f".{i}_{short_random_key()}.npy")
+        np.save(tmp_path, img_alpha)
+        os.replace(tmp_path, os.path.join(root, f"{i}.npy"))
+    evict_rasters(settings.RASTER_STORE_MAX_BYTES)
+
+
+def evict_rasters(max_bytes):
+    """Delete the least recently used rasters until the store fits in max_bytes"""
+    rasters = []
+    total_size = 0
+    with os.scandir(settings.RASTER_STORE_ROOT) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            with os.scandir(entry.path) as files:
+                for file in files:
+                    try:
+                        stat = file.stat()
+                    except OSError:
+                        continue
+                    rasters.append((stat.st_mtime, stat.st_size, file.path))
+                    total_size += stat.st_size
+    rasters.sort()
+    for _, size, path in rasters:
+        if total_size <= max_bytes:
+            break
+        # Workers having the file mapped keep a valid mapping after the unlink
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    return total_size
+
+
+def _tile_transform(
+    width, height, corners_xy, output_width, output_height, min_x, max_x, min_y, max_y
+):
+    tl, tr, br, bl = corners_xy
+    r_w = (max_x - min_x) / output_width
+    r_h = (max_y - min_y) / output_height
+    p1 = np.float32(
+        [
+            [0, 0],
+            [width, 0],
+            [width, height],
+            [0, height],
+        ]
+    )
+    p2 = np.float32(
+        [
+            [(tl[0] - min_x) / r_w, (max_y - tl[1]) / r_h],
+            [(tr[0] - min_x) / r_w, (max_y - tr[1]) / r_h],
+            [(br[0] - min_x) / r_w, (max_y - br[1]) / r_h],
+            [(bl[0] - min_x) / r_w, (max_y - bl[1]) / r_h],
+        ]
+    )
+    return cv2.getPerspectiveTransform(p1, p2)
+
+
+def _transform_scale(coeffs):
+    return max(
+        abs(coeffs[0][0]),
+        abs(coeffs[0][1]),
+        abs(coeffs[1][0]),
+        abs(coeffs[1][1]),
+    )
+
+
+def mip_level_for_tile(
+    width,
+    height,
+    corners_xy,
+    output_width,
+    output_height,
+    min_x,
+    max_x,
+    min_y,
+    max_y,
+    nb_levels,
+):
+    """
+    Return the index of the mip chain level to warp a tile from, the one
+    closest to the tile scale without being smaller than it
+    """
+    coeffs = _tile_transform(
+        width,
+        height,
+        corners_xy,
+        output_width,
+        output_height,
+        min_x,
+        max_x,
+        min_y,
+        max_y,
+    )
+    scale = _transform_scale(coeffs)
+    if scale >= 0.5 or scale <= 0:
+        return 0
+    return min(nb_levels - 1, math.floor(math.log2(1 / scale)))
+
+
+def warp_tile(
+    img_alpha,
+    corners_xy,
+    output_width,
+    output_height,
+    min_x,
+    max_x,
+    min_y,
+    max_y,
+):
+    """
+    Project a BGRA map image on a tile
+
+    corners_xy are the spherical mercator coordinates of the map image
+    top left, top right, bottom right and bottom left corners
+    """
+    height, width = img_alpha.shape[:2]
+    scale = 1
+    while True:
+        coeffs = _tile_transform(
+            width,
+            height,
+            corners_xy,
+            output_width * scale,
+            output_height * scale,
+            min_x,
+            max_x,
+            min_y,
+            max_y,
+        )
+        if scale < 2 and _transform_scale(coeffs) < 0.5:
+            scale *= 2
+        else:
+            break
+
+    tile_img = cv2.warpPerspective(
+        img_alpha,
+        coeffs,
+        (int(output_width * scale), int(output_height * scale)),
+        flags=cv2.INTER_AREA,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(255, 255, 255, 0),
+    )
+    if scale > 1:
+        tile_img = cv2.resize(
+            tile_img, (output_width, output_height), interpolation=cv2.INTER_AREA
+        )
+    return tile_img
+
+
+def warp_tile_from_mip_chain(
+    get_level,
+    nb_levels,
+    width,
+    height,
+    corners_xy,
+    output_width,
+    output_height,
+    min_x,
+    max_x,
+    min_y,
+    max_y,
+):
+    """
+    Project a map image on a tile, using the level of its mip chain closest
+    to the tile scale, get_level(i) must return the level i of the chain
+    """
+    level = mip_level_for_tile(
+        width,
+        height,
+        corners_xy,
+        output_width,
+        output_height,
+        min_x,
+        max_x,
+        min_y,
+        max_y,
+        nb_levels,
+    )
+    return warp_tile(
+        get_level(level),
+        corners_xy,
+        output_width,
+        output_height,
+        min_x,
+        max_x,
+        min_y,
+        max_y,
+    )
+
+
+def encode_tile(tile_img, img_mime):
+    """Encode a BGRA tile array to the given image format"""
+    if img_mime in ("image/avif", "image/jxl"):
+        color_converted = cv2.cvtColor(tile_img, cv2.COLOR_BGRA2RGBA)
+        pil_image = Image.fromarray(color_converted)
+        buffer = BytesIO()
+        pil_image.save(buffer, img_mime[6:].upper(), optimize=True, quality=40)
+        return buffer.getvalue()
+    extra_args = []
+    if img_mime == "image/webp":
+        extra_args = [int(cv2.IMWRITE_WEBP_QUALITY), 40]
+    elif img_mime == "image/jpeg":
+        extra_args = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+    _, buffer = cv2.imencode(f".{img_mime[6:]}", tile_img, extra_args)
+    return BytesIO(buffer).getvalue()
+
+
+@contextmanager
+def cache_lock(key, timeout=30, wait=10):
+    """
+    Lock shared by all the workers through the cache, yields whether it was
+    acquired before wait seconds
+    """
+    deadline = time.time() + wait
+    acquired = cache.add(key, 1, timeout)
+    while not acquired and time.time() < deadline:
+        time.sleep(0.05)
+        acquired = cache.add(key, 1, timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
+
+
+class TileRenderBusy(Exception):
+    """Raised when no tile render slot frees up in time"""
+
+    def __init__(self, retry_after):
+        super().__init__("All tile render slots are busy")
+        self.retry_after = retry_after
+
+
+RENDER_SLOT_KEY = "tile:render:slot:{}"
+RENDER_QUEUE_KEY = "tile:render:queue"
+RENDER_REJECTED_KEY = "tile:render:rejected"
+
+
+def incr_render_counter(key, delta):
+    try:
+        cache.add(key, 0, None)
+        cache.incr(key, delta)
+    except Exception:
+        pass
+
+
+def render_stats():
+    """Return the state of the tile render slots shared by the workers"""
+    slots = [
+        RENDER_SLOT_KEY.format(i) for i in range(settings.TILES_RENDER_CONCURRENCY)
+    ]
+    return {
+        "concurrency": len(slots),
+        "active": len(cache.get_many(slots)),
+        "queued": cache.get(RENDER_QUEUE_KEY, 0),
+        "rejected": cache.get(RENDER_REJECTED_KEY, 0),
+    }
+
+
+@contextmanager
+def render_slot():
+    """
+    Hold one of the TILES_RENDER_CONCURRENCY tile render slots shared by all
+    the workers, raise TileRenderBusy if none frees up before
+    TILES_RENDER_QUEUE_TIMEOUT seconds
+    """
+    concurrency = settings.TILES_RENDER_CONCURRENCY
+    if not concurrency:
+        yield
+        return
+    slot_key = None
+    deadline = time.time() + settings.TILES_RENDER_QUEUE_TIMEOUT
+    incr_render_counter(RENDER_QUEUE_KEY, 1)
+    try:
+        while slot_key is None:
+            # Start from a random slot to spread the contention
+            first_slot = random.randrange(concurrency)
+            for i in range(concurrency):
+                key = RENDER_SLOT_KEY.format((first_slot + i) % concurrency)
+                if cache.add(key, 1, 60):
+                    slot_key = key
+                    break
+            else:
+                if time.time() >= deadline:
+                    incr_render_counter(RENDER_REJECTED_KEY, 1)
+                    raise TileRenderBusy(settings.TILES_RENDER_RETRY_AFTER)
+                time.sleep(0.02)
+    finally:
+        incr_render_counter(RENDER_QUEUE_KEY, -1)
+    try:
+        yield
+    finally:
+        cache.delete(slot_key)
+
+
+def tile_bounds(tile_x, tile_y, tile_z):
+    """Return spherical mercator min_x, max_x, min_y, max_y of a slippy tile"""
+    max_lat, min_lon = tile_xy_to_north_west_latlon(tile_x, tile_y, tile_z)
+    min_lat, max_lon = tile_xy_to_north_west_latlon(tile_x + 1, tile_y + 1, tile_z)
+    min_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": min_lat, "lon": min_lon})
+    max_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": max_lat, "lon": max_lon})
+    return min_xy["x"], max_xy["x"], min_xy["y"], max_xy["y"]
+
+
+def tiles_covering(corners_xy, tile_z):
+    """Return the ranges of slippy tiles x and y indexes covering the corners"""
+    origin = GLOBAL_MERCATOR.originShift
+    tile_meters = 2 * origin / 2**tile_z
+    xs = [c[0] for c in corners_xy]
+    ys = [c[1] for c in corners_xy]
+    last_tile = 2**tile_z - 1
+    min_tx = max(0, math.floor((min(xs) + origin) / tile_meters))
+    max_tx = min(last_tile, math.floor((max(xs) + origin) / tile_meters))
+    min_ty = max(0, math.floor((origin - max(ys)) / tile_meters))
+    max_ty = min(last_tile, math.floor((origin - min(ys)) / tile_meters))
+    return range(min_tx, max_tx + 1), range(min_ty, max_ty + 1)
+
+
+def fit_zoom(corners_xy, viewport_width, viewport_height):
+    """Return the zoom at which Leaflet fitBounds shows the corners in a viewport"""
+    xs = [c[0] for c in corners_xy]
+    ys = [c[1] for c in corners_xy]
+    meters_per_pixel_at_zoom_0 = 2 * GLOBAL_MERCATOR.originShift / TILE_SIZE
+    scale = meters_per_pixel_at_zoom_0 * min(
+        viewport_width / max(max(xs) - min(xs), 1e-9),
+        viewport_height / max(max(ys) - min(ys), 1e-9),
+    )
+    return max(0, math.floor(math.log2(scale)))
+
+
+def frontend_tiles_plan(corners_xy, max_zoom, viewports, extra_zooms):
+    """
+    Return the zooms and bounds of the WMS tiles the event page loads first,
+    from the zoom fitting the map in the smallest viewport to extra_zooms
+    above the one fitting it in the largest, the most central tiles first
+
+    Leaflet asks FRONTEND_TILE_SIZE tiles, at a zoom they cover the slippy
+    tiles of the zoom below, and not above the max native zoom of the map
+    """
+    fit_zooms = [fit_zoom(corners_xy, *viewport) for viewport in viewports]
+    max_plan_zoom = min(max(fit_zooms) + extra_zooms, max_zoom)
+    center_x = sum(c[0] for c in corners_xy) / 4
+    center_y = sum(c[1] for c in corners_xy) / 4
+    plan = []
+    for zoom in range(max(1, min(fit_zooms)), max_plan_zoom + 1):
+        tiles_x, tiles_y = tiles_covering(corners_xy, zoom - 1)
+        bboxes = [tile_bounds(x, y, zoom - 1) for x in tiles_x for y in tiles_y]
+        bboxes = [
+            bounds
+            for bounds, intersects in zip(
+                bboxes, quad_intersects_bboxes(corners_xy, bboxes)
+            )
+            if intersects
+        ]
+        bboxes.sort(
+            key=lambda b: ((b[0] + b[1]) / 2 - center_x) ** 2
+            + ((b[2] + b[3]) / 2 - center_y) ** 2
+        )
+        plan += [(zoom, bounds) for bounds in bboxes]
+    return plan
+
+
+def pyramid_dir(map_aid, map_hash):
+    return os.path.join(settings.TILES_PYRAMID_ROOT, map_aid, map_hash)
+
+
+def has_pyramid(map_aid, map_hash):
+    return os.path.exists(
+        os.path.join(pyramid_dir(map_aid, map_hash), PYRAMID_INFO_FILE)
+    )
+
+
+def delete_pyramids(map_aid):
+    shutil.rmtree(
+        os.path.join(settings.TILES_PYRAMID_ROOT, map_aid), ignore_errors=True
+    )
+
+
+def pyramid_tile_path(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime):
+    return os.path.join(
+        pyramid_dir(map_aid, map_hash),
+        str(tile_z),
+        str(tile_x),
+        f"{tile_y}.{TILE_EXTENSIONS[img_mime]}",
+    )
+
+
+def read_pyramid_tile(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime):
+    """Return a tile of a pre-rendered pyramid, or None if it does not exist"""
+    if img_mime not in settings.TILES_PYRAMID_MIMES:
+        return None
+    path = pyramid_tile_path(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime)
+    try:
+        with open(path, "rb") as fp:
+            return fp.read()
+    except OSError:
+        return None
+
+
+def public_tile_path(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime):
+    return os.path.join(
+        settings.TILES_PUBLIC_ROOT,
+        "maps",
+        map_aid,
+        map_hash,
+        str(tile_z),
+        str(tile_x),
+        f"{tile_y}.{TILE_EXTENSIONS[img_mime]}",
+    )
+
+
+def store_public_tile(
+    map_aid, map_hash, tile_z, tile_x, tile_y, img_mime, data=None, src_path=None
+):
+    """
+    Write a tile of a public map where nginx serves it from without reaching
+    Django, either from its content or by linking an existing file
+    """
+    path = public_tile_path(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime)
+    tmp_path = f"{path}.{short_random_key()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if src_path:
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                shutil.copyfile(src_path, tmp_path)
+        else:
+            with open(tmp_path, "wb") as fp:
+                fp.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def delete_public_tiles(map_aid):
+    shutil.rmtree(
+        os.path.join(settings.TILES_PUBLIC_ROOT, "maps", map_aid), ignore_errors=True
+    )
+
+
+def evict_public_tiles(max_bytes):
+    """
+    Delete the tiles of the least recently used map versions until the public
+    tiles fit in max_bytes. As nginx serves them, their use is only known from
+    their access times.
+    """
+    versions = []
+    total_size = 0
+    maps_root = os.path.join(settings.TILES_PUBLIC_ROOT, "maps")
+    if not os.path.isdir(maps_root):
+        return 0
+    for map_aid in os.listdir(maps_root):
+        map_root = os.path.join(maps_root, map_aid)
+        if not os.path.isdir(map_root):
+            continue
+        for map_hash in os.listdir(map_root):
+            version_root = os.path.join(map_root, map_hash)
+            size = 0
+            last_used = 0
+            for dir_path, _, file_names in os.walk(version_root):
+                for file_name in file_names:
+                    try:
+                        stat = os.stat(os.path.join(dir_path, file_name))
+                    except OSError:
+                        continue
+                    # Small tiles use more disk blocks than their size
+                    size += stat.st_blocks * 512
+                    last_used = max(last_used, stat.st_atime, stat.st_mtime)
+            versions.append((last_used, size, version_root))
+            total_size += size
+    versions.sort()
+    for _, size, version_root in versions:
+        if total_size <= max_bytes:
+            break
+        shutil.rmtree(version_root, ignore_errors=True)
+        total_size -= size
+        try:
+            os.rmdir(os.path.dirname(version_root))
+        except OSError:
+            pass
+    return total_size
+
+
+def read_pyramid_tile_image(map_aid, map_hash, tile_z, tile_x, tile_y):
+    """Return a tile of a pre-rendered pyramid as a BGRA array, or None"""
+    # Prefer lossless stored formats
+    stored_mimes = sorted(
+        settings.TILES_PYRAMID_MIMES, key=lambda mime: mime != "image/png"
+    )
+    for img_mime in stored_mimes:
+        data = read_pyramid_tile(map_aid, map_hash, tile_z, tile_x, tile_y, img_mime)
+        if data is None:
+            continue
+        tile_img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+        if tile_img is None:
+            continue
+        return cv2.cvtColor(tile_img, cv2.COLOR_BGR2BGRA)
+    return None
+
+
+def pyramid_zoom_range(width, height, max_zoom):
+    """
+    Zoom levels from the one where the map image fits in about one tile to
+    the one matching its native resolution
+    """
+    zoom_levels = max(0, math.ceil(math.log2(max(width, height, 1) / TILE_SIZE)))
+    return max(0, max_zoom - zoom_levels), max_zoom
+
+
+_worker_mip_chain = None
+_worker_corners = None
+
+
+def _init_pyramid_worker(map_aid, image_name, corners_xy):
+    global _worker_mip_chain, _worker_corners
+    cv2.setNumThreads(1)
+    # The levels are memory mapped, the workers share them in the page cache
+    levels = []
+    while (level := load_raster(map_aid, image_name, len(levels))) is not None:
+        levels.append(level)
+    if not levels:
+        raise FileNotFoundError(f"No rasters stored for map {map_aid}")
+    _worker_mip_chain = levels
+    _worker_corners = corners_xy
+
+
+def _render_pyramid_column(root, tile_z, tile_x, tile_ys, img_mimes):
+    n = 0
+    column_dir = os.path.join(root, str(tile_z), str(tile_x))
+    for tile_y in tile_ys:
+        height, width = _worker_mip_chain[0].shape[:2]
+        tile_img = warp_tile_from_mip_chain(
+            _worker_mip_chain.__getitem__,
+            len(_worker_mip_chain),
+            width,
+            height,
+            _worker_corners,
+            TILE_SIZE,
+            TILE_SIZE,
+            *tile_bounds(tile_x, tile_y, tile_z),
+        )
+        if not tile_img[:, :, 3].any():
+            # Blank tiles are not stored
+            continue
+        os.makedirs(column_dir, exist_ok=True)
+        for img_mime in img_mimes:
+            with open(
+                os.path.join(column_dir, f"{tile_y}.{TILE_EXTENSIONS[img_mime]}"),
+                "wb",
+            ) as fp:
+                fp.write(encode_tile(tile_img, img_mime))
+        n += 1
+    return n
+
+
+def render_pyramid(
+    map_aid, map_hash, image_name, corners_xy, width, height, max_zoom, processes=None
+):
+    """
+    Render all the tiles of a map from the zoom level where it fits in a tile
+    to its native resolution, and remove the pyramids of the previous versions
+    of the map. The mip chain of the map image must be in the raster store.
+    Returns the number of tiles rendered.
+    """
+    final_dir = pyramid_dir(map_aid, map_hash)
+    if has_pyramid(map_aid, map_hash):
+        return 0
+    min_zoom, max_zoom = pyramid_zoom_range(width, height, max_zoom)
+    img_mimes = [
+        mime for mime in settings.TILES_PYRAMID_MIMES if mime in TILE_EXTENSIONS
+    ]
+    tmp_dir = f"{final_dir}.{short_random_key()}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes or settings.TILES_PYRAMID_PROCESSES,
+            initializer=_init_pyramid_worker,
+            initargs=(map_aid, image_name, corners_xy),
+        ) as executor:
+            futures = []
+            for tile_z in range(min_zoom, max_zoom + 1):
+                tile_xs, tile_ys = tiles_covering(corners_xy, tile_z)
+                for tile_x in tile_xs:
+                    # Skip the tiles of the bounding box outside a rotated map
+                    intersects = quad_intersects_bboxes(
+                        corners_xy,
+                        [tile_bounds(tile_x, tile_y, tile_z) for tile_y in tile_ys],
+                    )
+                    column_ys = [
+                        tile_y
+                        for tile_y, intersect in zip(tile_ys, intersects)
+                        if intersect
+                    ]
+                    if not column_ys:
+                        continue
+                    futures.append(
+                        executor.submit(
+                            _render_pyramid_column,
+                            tmp_dir,
+                            tile_z,
+                            tile_x,
+                            column_ys,
+                            img_mimes,
+                        )
+                    )
+            n = sum(future.result() for future in futures)
+        with open(os.path.join(tmp_dir, PYRAMID_INFO_FILE), "w") as fp:
+            json.dump(
+                {"min_zoom": min_zoom, "max_zoom": max_zoom, "mimes": img_mimes}, fp
+            )
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    map_root = os.path.dirname(final_dir)
+    for name in os.listdir(map_root):
+        if name != map_hash and not name.endswith(".tmp"):
+            shutil.rmtree(os.path.join(map_root, name), ignore_errors=True)
+    return n
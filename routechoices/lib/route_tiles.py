@@ -0,0 +1,94 @@
+import cbor2
+import numpy as np
+
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.map_geometry import latlon_to_meters_array
+from routechoices.lib.map_tiles import tile_bounds
+
+GLOBAL_MERCATOR = GlobalMercator()
+# Tiles are drawn 256 pixels wide, their coordinates have half a pixel precision
+ROUTE_TILE_EXTENT = 512
+# Extent units around a tile in which the lines are kept so they join smoothly
+ROUTE_TILE_BUFFER = 8
+ROUTE_TILES_MAX_ZOOM = 18
+
+
+def project_tracks(tracks):
+    """
+    Return the tracks given as competitor aid and list of (timestamp, lat, lon)
+    as competitor aid and spherical mercator X and Y arrays
+    """
+    projected = []
+    for competitor_aid, locations in tracks:
+        if not locations:
+            continue
+        _, lats, lons = zip(*locations)
+        xs, ys = latlon_to_meters_array(lats, lons)
+        projected.append((competitor_aid, xs, ys))
+    return projected
+
+
+def simplify_tracks(tracks, zoom):
+    """
+    Snap the points of the projected tracks on the grid of a route tile at the
+    given zoom and drop the consecutive points falling in the same cell
+    """
+    cell_size = (
+        2 * GLOBAL_MERCATOR.originShift / 2 ** min(zoom, ROUTE_TILES_MAX_ZOOM)
+    ) / ROUTE_TILE_EXTENT
+    simplified = []
+    for competitor_aid, xs, ys in tracks:
+        cells_x = np.floor(xs / cell_size)
+        cells_y = np.floor(ys / cell_size)
+        keep = np.ones(len(xs), dtype=bool)
+        keep[1:] = (cells_x[1:] != cells_x[:-1]) | (cells_y[1:] != cells_y[:-1])
+        simplified.append((competitor_aid, xs[keep], ys[keep]))
+    return simplified
+
+
+def clip_track(xs, ys, min_x, max_x, min_y, max_y):
+    """
+    Return the start and end indexes of the runs of points of a track forming
+    the segments that cross a bounding box
+    """
+    if len(xs) == 1:
+        if min_x <= xs[0] <= max_x and min_y <= ys[0] <= max_y:
+            return [(0, 1)]
+        return []
+    crossing = (
+        (np.minimum(xs[:-1], xs[1:]) <= max_x)
+        & (np.maximum(xs[:-1], xs[1:]) >= min_x)
+        & (np.minimum(ys[:-1], ys[1:]) <= max_y)
+        & (np.maximum(ys[:-1], ys[1:]) >= min_y)
+    )
+    edges = np.diff(np.concatenate(([0], crossing.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # A run of n segments has n + 1 points
+    return list(zip(starts.tolist(), (ends + 1).tolist()))
+
+
+def encode_route_tile(tracks, tile_z, tile_x, tile_y):
+    """
+    Encode the parts of the tracks simplified for the tile zoom crossing the
+    tile as CBOR, each competitor being a list of lines of interleaved X and
+    Y coordinates in tile units from the top left corner, delta encoded
+    """
+    min_x, max_x, min_y, max_y = tile_bounds(tile_x, tile_y, tile_z)
+    scale = ROUTE_TILE_EXTENT / (max_x - min_x)
+    buffer = ROUTE_TILE_BUFFER / scale
+    features = []
+    for competitor_aid, xs, ys in tracks:
+        lines = []
+        for start, end in clip_track(
+            xs, ys, min_x - buffer, max_x + buffer, min_y - buffer, max_y + buffer
+        ):
+            tile_xs = np.round((xs[start:end] - min_x) * scale).astype(np.int64)
+            tile_ys = np.round((max_y - ys[start:end]) * scale).astype(np.int64)
+            coordinates = np.empty(2 * len(tile_xs), dtype=np.int64)
+            coordinates[0::2] = np.diff(tile_xs, prepend=0)
+            coordinates[1::2] = np.diff(tile_ys, prepend=0)
+            lines.append(coordinates.tolist())
+        if lines:
+            features.append({"id": competitor_aid, "lines": lines})
+    return cbor2.dumps({"extent": ROUTE_TILE_EXTENT, "features": features})
@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+import aiohttp
+import arrow
+from asgiref.sync import sync_to_async
+from defusedxml.ElementTree import DefusedXMLParser
+
+from routechoices.core.models import Device, SpotFeed
+
+SPOT_API_URL = (
+    "https://api.findmespot.com/spot-main-web/consumer"
+    "/rest-api/2.0/public/feed/{feed_id}/message.xml"
+)
+SPOT_TRACK_MESSAGE_TYPES = ("TRACK", "EXTREME-TRACK", "UNLIMITED-TRACK")
+SPOT_MESSAGE_FIELDS = (
+    "messageType",
+    "messengerId",
+    "latitude",
+    "longitude",
+    "unixTime",
+)
+
+
+class SpotFeedTarget:
+    """Parser target collecting track positions per messenger from a feed"""
+
+    def __init__(self):
+        self.positions = {}
+        self.message = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        tag = tag.rsplit("}", 1)[-1]
+        if tag == "message":
+            self.message = {}
+        self.text = []
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        if self.message is None:
+            return
+        tag = tag.rsplit("}", 1)[-1]
+        if tag in SPOT_MESSAGE_FIELDS:
+            self.message[tag] = "".join(self.text).strip()
+        elif tag == "message":
+            self.add_message(self.message)
+            self.message = None
+
+    def add_message(self, message):
+        if message.get("messageType") not in SPOT_TRACK_MESSAGE_TYPES:
+            return
+        try:
+            messenger_id = message["messengerId"]
+            ts = int(message["unixTime"])
+            lat = float(message["latitude"])
+            lon = float(message["longitude"])
+        except (KeyError, ValueError):
+            return
+        self.positions.setdefault(messenger_id, []).append((ts, lat, lon))
+
+    def close(self):
+        return self.positions
+
+
+def store_spot_positions(positions):
+    """
+    Store the positions of each messenger, return the number of positions
+    stored and the messenger ids whose positions could not be
+    """
+    devices = Device.objects.filter(
+        spot_device__messenger_id__in=positions.keys()
+    ).select_related("spot_device")
+    n = 0
+    failed = set()
+    for device in devices:
+        messenger_id = device.spot_device.messenger_id
+        locations = positions[messenger_id]
+        try:
+            device.add_locations(locations)
+        except Exception as e:
+            failed.add(messenger_id)
+            print(f"Error storing SPOT positions of {messenger_id}: {e}", flush=True)
+            continue
+        n += len(locations)
+    return n, failed
+
+
+class SpotFeedState:
+    def __init__(self, last_fetch):
+        self.last_fetch = last_fetch
+        self.failures = 0
+        self.next_attempt = 0
+
+    def fetch_failed(self, interval, max_backoff):
+        self.failures += 1
+        self.next_attempt = time.time() + min(
+            max_backoff, interval * 2 ** (self.failures - 1)
+        )
+
+    def fetch_succeeded(self, fetch_date):
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_fetch = fetch_date
+
+
+class SpotCrawler:
+    def __init__(
+        self,
+        api_url=SPOT_API_URL,
+        concurrency=8,
+        interval=150,
+        max_backoff=3600,
+        timeout=10,
+    ):
+        self.api_url = api_url
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.feeds_state = {}
+
+    def get_feed_state(self, feed_id):
+        if feed_id not in self.feeds_state:
+            self.feeds_state[feed_id] = SpotFeedState(
+                arrow.utcnow().shift(weeks=-1).format("YYYY-MM-DD[T]HH:mm:ssZZ")
+            )
+        return self.feeds_state[feed_id]
+
+    async def fetch_feed(self, session, feed_id):
+        """
+        Return the positions of a feed since its last successful crawl and the
+        date to resume from once they are stored, None if it was not fetched
+        """
+        state = self.get_feed_state(feed_id)
+        if state.next_attempt > time.time():
+            return None
+        now = arrow.utcnow().format("YYYY-MM-DD[T]HH:mm:ssZZ")
+        url = self.api_url.format(feed_id=feed_id)
+        params = {"startDate": state.last_fetch, "endDate": now}
+        async with self.semaphore:
+            try:
+                async with session.get(url, params=params) as res:
+                    if res.status != 200:
+                        raise Exception(f"HTTP status {res.status}")
+                    parser = DefusedXMLParser(target=SpotFeedTarget())
+                    async for chunk in res.content.iter_chunked(16384):
+                        parser.feed(chunk)
+                    positions = parser.close()
+            except Exception as e:
+                state.fetch_failed(self.interval, self.max_backoff)
+                print(f"Error fetching SPOT feed {feed_id}: {e}", flush=True)
+                return None
+        return feed_id, now, positions
+
+    async def crawl(self):
+        feed_ids = await sync_to_async(list)(
+            SpotFeed.objects.values_list("feed_id", flat=True)
+        )
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            results = await asyncio.gather(
+                *[self.fetch_feed(session, feed_id) for feed_id in feed_ids]
+            )
+        results = [result for result in results if result]
+        positions = {}
+        for _, _, feed_positions in results:
+            for messenger_id, locations in feed_positions.items():
+                positions.setdefault(messenger_id, []).extend(locations)
+        n, failed = 0, set()
+        if positions:
+            n, failed = await sync_to_async(store_spot_positions)(positions)
+        # Feeds resume from the end of this crawl only once their positions
+        # are stored, else they are fetched again from the same date
+        for feed_id, fetch_date, feed_positions in results:
+            if failed.isdisjoint(feed_positions.keys()):
+                self.get_feed_state(feed_id).fetch_succeeded(fetch_date)
+        return n
+
+    async def run(self):
+        while True:
+            t0 = time.time()
+            try:
+                n = await self.crawl()
+            except Exception as e:
+                print(f"Error crawling SPOT feeds: {e}", flush=True)
+            else:
+                print(f"{n} new positions, sleeping now...", flush=True)
+            await asyncio.sleep(max(0, self.interval - (time.time() - t0)))
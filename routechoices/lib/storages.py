@@ -2,6 +2,7 @@ import gzip
 import re
 import shutil
 
+from botocore.exceptions import ClientError
 from django.conf import settings
 from django_s3_storage.storage import S3File, S3Storage, _wrap_errors
 
@@ -48,6 +49,28 @@ class OverwriteImageStorage(S3Storage):
         # All done!
         return S3File(content, name, self)
 
+    @_wrap_errors
+    def etag(self, name):
+        try:
+            obj = self.s3_connection.head_object(**self._object_params(name))
+        except ClientError as ex:
+            # Responses to HEAD have no body, a missing object is a bare 404
+            # that _wrap_errors would raise as a generic OSError
+            if ex.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(f"S3Storage error at {name!r}: {ex}")
+            raise
+        return obj["ETag"]
+
+    @_wrap_errors
+    def download(self, name, fp):
+        """Stream a file to fp without loading it in memory, return its ETag"""
+        obj = self.s3_connection.get_object(**self._object_params(name))
+        body = obj["Body"]
+        if obj.get("ContentEncoding") == "gzip":
+            body = gzip.GzipFile(name, "rb", fileobj=body)
+        shutil.copyfileobj(body, fp)
+        return obj["ETag"]
+
     def url(self, name):
         simple_name = re.sub(
             STORED_MEDIA_RE,
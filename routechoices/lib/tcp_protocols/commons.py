@@ -1,10 +1,17 @@
+import asyncio
 import logging
 import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
 import arrow
 from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.db import connection
+from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 from tornado.tcpserver import TCPServer
 
@@ -38,6 +45,117 @@ class GenericTCPServer(TCPServer):
             pass
 
 
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, address):
+        asyncio.ensure_future(self.server.on_datagram(data, address))
+
+    def error_received(self, exc):
+        print(f"UDP error received: {exc}", flush=True)
+
+
+class GenericUDPServer(ABC):
+    """Datagram counterpart of GenericTCPServer
+
+    Every datagram is self contained: it carries the device IMEI and is
+    acknowledged on its own, retransmitted datagrams are acknowledged again
+    but not ingested twice.
+    """
+
+    max_seen_packets = 4096
+    max_cached_devices = 1024
+    device_cache_ttl = 300
+
+    def __init__(self):
+        self.transport = None
+        self.logger = logger
+        self.seen_packets = OrderedDict()
+        self.devices = OrderedDict()
+        # Locks of the IMEIs being handled and how many datagrams hold them
+        self.device_locks = {}
+
+    def listen(self, port, address=""):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, port))
+        self.add_socket(sock)
+
+    def add_socket(self, sock):
+        sock.setblocking(False)
+        IOLoop.current().add_callback(self._start_endpoint, sock)
+
+    async def _start_endpoint(self, sock):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: UDPServerProtocol(self), sock=sock)
+
+    def stop(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def send(self, data, address):
+        if self.transport:
+            self.transport.sendto(data, address)
+
+    def is_retransmit(self, key):
+        if key in self.seen_packets:
+            self.seen_packets.move_to_end(key)
+            return True
+        self.seen_packets[key] = True
+        if len(self.seen_packets) > self.max_seen_packets:
+            self.seen_packets.popitem(last=False)
+        return False
+
+    def forget_packet(self, key):
+        self.seen_packets.pop(key, None)
+
+    async def get_device(self, imei):
+        cached = self.devices.get(imei)
+        if cached and time.time() - cached[1] < self.device_cache_ttl:
+            self.devices.move_to_end(imei)
+            return cached[0]
+        device = await get_device_by_imei(imei)
+        if device:
+            self.devices[imei] = (device, time.time())
+            self.devices.move_to_end(imei)
+            if len(self.devices) > self.max_cached_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.pop(imei, None)
+        return device
+
+    @asynccontextmanager
+    async def device_lock(self, imei):
+        lock, users = self.device_locks.get(imei, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.device_locks[imei] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.device_locks[imei]
+            if users == 1:
+                del self.device_locks[imei]
+            else:
+                self.device_locks[imei] = (lock, users - 1)
+
+    async def on_datagram(self, data, address):
+        try:
+            await self.handle_datagram(data, address)
+        except Exception as e:
+            print(f"Error processing datagram from {address}: {str(e)}", flush=True)
+
+    @abstractmethod
+    async def handle_datagram(self, data, address):
+        """Ingest a datagram and send its acknowledgement"""
+
+
 @sync_to_async
 def get_device_by_imei(imei):
     device = Device.objects.filter(physical_device__imei=imei).first()
@@ -60,8 +178,8 @@ def send_sos(device):
 
 
 @sync_to_async
-def save_device(device):
-    device.save()
+def save_device(device, update_fields=None):
+    device.save(update_fields=update_fields)
     connection.close()
 
 
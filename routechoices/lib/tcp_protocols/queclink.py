@@ -6,6 +6,7 @@ from django.core.exceptions import ValidationError
 from routechoices.lib.helpers import random_key
 from routechoices.lib.tcp_protocols.commons import (
     GenericTCPServer,
+    GenericUDPServer,
     add_locations,
     get_device_by_imei,
     get_pending_commands,
@@ -15,6 +16,56 @@ from routechoices.lib.tcp_protocols.commons import (
 )
 from routechoices.lib.validators import validate_imei
 
+POSITION_REPORT_TYPES = (
+    "FRI",
+    "GEO",
+    "SPD",
+    "SOS",
+    "RTL",
+    "PNL",
+    "NMR",
+    "DIS",
+    "DOG",
+    "IGL",
+    "LOC",
+)
+
+
+def is_position_report(parts):
+    return (
+        parts[0][:8] in ("+RESP:GT", "+BUFF:GT")
+        and parts[0][8:] in POSITION_REPORT_TYPES
+    )
+
+
+def parse_position_report(parts):
+    nb_pts = int(parts[6])
+    print(f"Contains {nb_pts} pts")
+    if 12 * nb_pts + 10 == len(parts):
+        len_points = 12
+    elif 11 * nb_pts + 11 == len(parts):
+        len_points = 11
+    else:
+        len_points = math.floor((len(parts) - 10) / nb_pts)
+    print(f"Each point has {len_points} data")
+    pts = []
+    for i in range(nb_pts):
+        try:
+            lon = float(parts[11 + i * len_points])
+            lat = float(parts[12 + i * len_points])
+            tim = arrow.get(parts[13 + i * len_points], "YYYYMMDDHHmmss").int_timestamp
+        except Exception as e:
+            print(f"Error parsing position: {str(e)}", flush=True)
+            continue
+        else:
+            pts.append((tim, lat, lon))
+    batt = None
+    try:
+        batt = int(parts[-3])
+    except Exception:
+        pass
+    return pts, batt
+
 
 class QueclinkConnection:
     def __init__(self, stream, address, logger):
@@ -85,49 +136,11 @@ class QueclinkConnection:
     async def process_line(self, data):
         try:
             parts = data.split(",")
-            if parts[0][:8] in ("+RESP:GT", "+BUFF:GT") and parts[0][8:] in (
-                "FRI",
-                "GEO",
-                "SPD",
-                "SOS",
-                "RTL",
-                "PNL",
-                "NMR",
-                "DIS",
-                "DOG",
-                "IGL",
-                "LOC",
-            ):
+            if is_position_report(parts):
                 imei = parts[2]
                 if imei != self.imei:
                     raise Exception("Cannot change IMEI while connected")
-                nb_pts = int(parts[6])
-                print(f"Contains {nb_pts} pts")
-                if 12 * nb_pts + 10 == len(parts):
-                    len_points = 12
-                elif 11 * nb_pts + 11 == len(parts):
-                    len_points = 11
-                else:
-                    len_points = math.floor((len(parts) - 10) / nb_pts)
-                print(f"Each point has {len_points} data")
-                pts = []
-                for i in range(nb_pts):
-                    try:
-                        lon = float(parts[11 + i * len_points])
-                        lat = float(parts[12 + i * len_points])
-                        tim = arrow.get(
-                            parts[13 + i * len_points], "YYYYMMDDHHmmss"
-                        ).int_timestamp
-                    except Exception as e:
-                        print(f"Error parsing position: {str(e)}", flush=True)
-                        continue
-                    else:
-                        pts.append((tim, lat, lon))
-                batt = None
-                try:
-                    batt = int(parts[-3])
-                except Exception:
-                    pass
+                pts, batt = parse_position_report(parts)
                 await self.on_data(pts, batt)
                 if parts[0][8:] == "SOS":
                     sos_device_aid, sos_lat, sos_lon, sos_sent_to = await send_sos(
@@ -180,3 +193,64 @@ class QueclinkConnection:
 
 class QueclinkServer(GenericTCPServer):
     connection_class = QueclinkConnection
+
+
+class QueclinkUDPServer(GenericUDPServer):
+    async def handle_datagram(self, data_bin, address):
+        data = data_bin.decode("ascii").strip()
+        parts = data.rstrip("$").split(",")
+        imei = None
+        if parts[0][:7] == "+ACK:GT" or parts[0][:8] in ("+RESP:GT", "+BUFF:GT"):
+            imei = parts[2]
+        if not imei:
+            print(f"No imei ({address})", flush=True)
+            return
+        try:
+            validate_imei(imei)
+        except ValidationError:
+            print("Invalid imei", flush=True)
+            return
+        self.logger.info(f"GL300 UDP DATA, {address}, {imei}: {data}")
+        count_number = parts[-1]
+        if parts[0] == "+ACK:GTHBD":
+            self.send(
+                f"+SACK:GTHBD,{parts[1]},{count_number}$".encode("ascii"), address
+            )
+            return
+        packet_key = (imei, parts[0], count_number)
+        async with self.device_lock(imei):
+            if self.is_retransmit(packet_key):
+                print(f"{imei} retransmitted message {count_number}")
+                self.send(f"+SACK:{count_number}$".encode("ascii"), address)
+                return
+            db_device = await self.get_device(imei)
+            if not db_device:
+                print(f"Imei {imei} not registered ({address})", flush=True)
+                self.forget_packet(packet_key)
+                return
+            try:
+                if is_position_report(parts):
+                    pts, batt = parse_position_report(parts)
+                    if not db_device.user_agent:
+                        db_device.user_agent = "Queclink"
+                    if batt:
+                        db_device.battery_level = batt
+                    await add_locations(db_device, pts)
+                    print(f"{len(pts)} Locations wrote to DB", flush=True)
+                elif parts[0] == "+RESP:GTINF":
+                    db_device.battery_level = int(parts[18])
+                    # The cached device may hold outdated locations
+                    await save_device(db_device, update_fields=["battery_level"])
+            except Exception:
+                self.forget_packet(packet_key)
+                raise
+            self.send(f"+SACK:{count_number}$".encode("ascii"), address)
+            if parts[0][8:] == "SOS":
+                sos_device_aid, sos_lat, sos_lon, sos_sent_to = await send_sos(
+                    db_device
+                )
+                print(
+                    f"SOS triggered by device {sos_device_aid}, {sos_lat},"
+                    f" {sos_lon} email sent to {sos_sent_to}",
+                    flush=True,
+                )
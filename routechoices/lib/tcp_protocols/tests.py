@@ -10,8 +10,8 @@ from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
 from routechoices.core.models import Device, ImeiDevice
 from routechoices.lib.tcp_protocols.gt06 import GT06Server
 from routechoices.lib.tcp_protocols.mictrack import MicTrackServer
-from routechoices.lib.tcp_protocols.queclink import QueclinkServer
-from routechoices.lib.tcp_protocols.tmt250 import TMT250Server
+from routechoices.lib.tcp_protocols.queclink import QueclinkServer, QueclinkUDPServer
+from routechoices.lib.tcp_protocols.tmt250 import TMT250Server, TMT250UDPServer
 from routechoices.lib.tcp_protocols.tracktape import TrackTapeServer
 from routechoices.lib.tcp_protocols.xexun import XexunServer
 
@@ -31,6 +31,18 @@ def refresh_device(device):
     return device
 
 
+def bind_unused_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    return sock, sock.getsockname()[1]
+
+
+async def udp_exchange(client, data):
+    loop = asyncio.get_running_loop()
+    await loop.sock_sendall(client, data)
+    return await asyncio.wait_for(loop.sock_recv(client, 255), 1)
+
+
 class TCPConnectionsTest(AsyncTestCase, TransactionTestCase):
     @gen_test
     async def test_gt06(self):
@@ -143,7 +155,10 @@ class TCPConnectionsTest(AsyncTestCase, TransactionTestCase):
         init_data = bytes.fromhex("000f333536333037303432343431303133")
         ack_data = b"\x01"
         gps_data = bytes.fromhex(
-            "00000000000000FE080400000113fc208dff000f33353633303730343234343130313304030101150316030001460000015d0000000113fc17610b000f14ffe0209cc580006e00c00500010004030101150316010001460000015e0000000113fc284945000f150f00209cd200009501080400000004030101150016030001460000015d0000000113fc267c5b000f150a50209cccc0009300680400000004030101150016030001460000015b0004"
+            "00000000000000a7080400000113fc208dff000f33353633303730343234343130313304030101150316030001460000015d0000000113fc17610b000f14ffe0209cc580006e00c00500010004030101150316010001460000015e0000000113fc284945000f150f00209cd200009501080400000004030101150016030001460000015d0000000113fc267c5b000f150a50209cccc0009300680400000004030101150016030001460000015b00040000b0bb"
+        )
+        gps_data_extended = bytes.fromhex(
+            "00000000000000368e010000018d6988e620000b1119702408b370000a000007000000000003000200715000ec000000000000000001012c00036162630100000000"
         )
 
         server = client = None
@@ -157,9 +172,19 @@ class TCPConnectionsTest(AsyncTestCase, TransactionTestCase):
         data = await client.read_bytes(255, partial=True)
         self.assertEqual(data, ack_data)
         await client.write(gps_data)
-        await asyncio.sleep(0.05)
+        data = await client.read_bytes(4)
+        self.assertEqual(data, b"\x00\x00\x00\x04")
         device = await refresh_device(device)
         self.assertEqual(device.location_count, 4)
+        # Frames can be split across reads and several frames sent at once
+        await client.write(gps_data[:100])
+        await asyncio.sleep(0.05)
+        await client.write(gps_data[100:] + gps_data_extended)
+        data = await client.read_bytes(8)
+        self.assertEqual(data, b"\x00\x00\x00\x04\x00\x00\x00\x01")
+        device = await refresh_device(device)
+        self.assertEqual(device.location_count, 5)
+        self.assertEqual(device.battery_level, 80)
         if server is not None:
             server.stop()
         if client is not None:
@@ -231,3 +256,68 @@ class TCPConnectionsTest(AsyncTestCase, TransactionTestCase):
             server.stop()
         if client is not None:
             client.close()
+
+
+class UDPDatagramsTest(AsyncTestCase, TransactionTestCase):
+    @gen_test
+    async def test_teltonika_udp(self):
+        gps_data = bytes.fromhex(
+            "00bccafe0105000f333536333037303432343431303133080400000113fc208dff000f33353633303730343234343130313304030101150316030001460000015d0000000113fc17610b000f14ffe0209cc580006e00c00500010004030101150316010001460000015e0000000113fc284945000f150f00209cd200009501080400000004030101150016030001460000015d0000000113fc267c5b000f150a50209cccc0009300680400000004030101150016030001460000015b0004"
+        )
+        ack_data = bytes.fromhex("0005cafe010504")
+
+        device = await create_imei_device("356307042441013")
+        sock, port = bind_unused_udp_port()
+        server = TMT250UDPServer()
+        server.add_socket(sock)
+        await asyncio.sleep(0.05)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setblocking(False)
+        client.connect(("127.0.0.1", port))
+        try:
+            data = await udp_exchange(client, gps_data)
+            self.assertEqual(data, ack_data)
+            device = await refresh_device(device)
+            self.assertEqual(device.location_count, 4)
+            # Retransmitted datagram is acknowledged again but not stored twice
+            data = await udp_exchange(client, gps_data)
+            self.assertEqual(data, ack_data)
+            device = await refresh_device(device)
+            self.assertEqual(device.location_count, 4)
+        finally:
+            server.stop()
+            client.close()
+
+    @gen_test
+    async def test_queclink_udp(self):
+        hbt_data = b"+ACK:GTHBD,C30203,860201061588748,,20240201161532,FFFF$"
+        hbt_ack_data = b"+SACK:GTHBD,C30203,FFFF$"
+        gps_data = b"+BUFF:GTFRI,8020040200,860201061588748,,12194,10,1,3,0.0,0,20.1,-71.596533,-33.524718,20240201161533,0730,0001,772A,052B253E,02,0,0.0,,,,,0,420000,,,,20230926200340,1549$"
+        gps_ack_data = b"+SACK:1549$"
+        battery_data = b"+RESP:GTINF,020102,860201061588748,,41,898600810906F8048812,16,0,0,0,,4.10,0,0,0,0,,020240201161534,69,,,+0800,0,20100214093254,11F0$"
+
+        device = await create_imei_device("860201061588748")
+        sock, port = bind_unused_udp_port()
+        server = QueclinkUDPServer()
+        server.add_socket(sock)
+        await asyncio.sleep(0.05)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setblocking(False)
+        client.connect(("127.0.0.1", port))
+        try:
+            data = await udp_exchange(client, hbt_data)
+            self.assertEqual(data, hbt_ack_data)
+            data = await udp_exchange(client, gps_data)
+            self.assertEqual(data, gps_ack_data)
+            device = await refresh_device(device)
+            self.assertEqual(device.location_count, 1)
+            data = await udp_exchange(client, gps_data)
+            self.assertEqual(data, gps_ack_data)
+            await udp_exchange(client, battery_data)
+            device = await refresh_device(device)
+            self.assertEqual(device.location_count, 1)
+            self.assertEqual(device.battery_level, 69)
+            self.assertEqual(server.device_locks, {})
+        finally:
+            server.stop()
+            client.close()
@@ -1,14 +1,79 @@
-from struct import pack, unpack
+from struct import Struct, pack
 
 from routechoices.lib.helpers import random_key, safe64encode
 from routechoices.lib.tcp_protocols.commons import (
     GenericTCPServer,
+    GenericUDPServer,
     add_locations,
     get_device_by_imei,
     send_sos,
 )
 from routechoices.lib.validators import validate_imei
 
+CODEC_8 = 0x08
+CODEC_8_EXTENDED = 0x8E
+
+IO_BATTERY_LEVEL = 113
+IO_ALARM = 236
+
+FRAME_HEADER = Struct(">II")
+FRAME_CRC_SIZE = 4
+MAX_FRAME_SIZE = 65536
+UDP_HEADER = Struct(">HHBBH")
+# For each codec: struct of the beginning of a record up to the count of
+# 1 byte IO values (timestamp, longitude, latitude, count), struct of the
+# (IO id, value) pairs for 1 byte values, and sizes of IO ids and counters
+IO_FORMATS = {
+    CODEC_8: (Struct(">Qxii7x2xB"), Struct(">BB"), 1),
+    CODEC_8_EXTENDED: (Struct(">Qxii7x4xH"), Struct(">HB"), 2),
+}
+UINT16 = Struct(">H")
+
+
+class TMT250FrameReader:
+    """Accumulate TCP data in a single buffer and yield complete AVL frames
+
+    Data is read directly into the buffer and frames are returned as
+    memoryviews of it, they are only valid until the next call to write_view.
+    """
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def write_view(self):
+        pending = self.end - self.start
+        if self.start > 0:
+            if pending:
+                self.buffer[:pending] = self.buffer[self.start : self.end]
+            self.start = 0
+            self.end = pending
+        if self.end == len(self.buffer):
+            if len(self.buffer) >= MAX_FRAME_SIZE:
+                raise Exception("frame too large")
+            self.buffer = self.buffer + bytearray(len(self.buffer))
+            self.view = memoryview(self.buffer)
+        return self.view[self.end :]
+
+    def commit(self, data_len):
+        self.end += data_len
+
+    def frames(self):
+        while self.end - self.start >= FRAME_HEADER.size:
+            zeroes, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if zeroes != 0:
+                raise Exception("zeroes should be 0")
+            frame_len = FRAME_HEADER.size + length + FRAME_CRC_SIZE
+            if frame_len > MAX_FRAME_SIZE:
+                raise Exception("frame too large")
+            if self.end - self.start < frame_len:
+                return
+            frame = self.view[self.start : self.start + frame_len]
+            self.start += frame_len
+            yield frame
+
 
 class TMT250Decoder:
     def __init__(self):
@@ -21,51 +86,89 @@ class TMT250Decoder:
         return pack(">i", s)
 
     def decode_alv(self, data):
-        self.packet["zeroes"] = unpack(">i", data[:4])[0]
+        buffer = memoryview(data)
+        self.packet["zeroes"], self.packet["length"] = FRAME_HEADER.unpack_from(buffer)
         if self.packet["zeroes"] != 0:
             raise Exception("zeroes should be 0")
-        self.packet["length"] = unpack(">i", data[4:8])[0]
-        self.packet["codec"] = data[8]
-        if self.packet["codec"] != 8:
-            raise Exception("codec should be 8")
-        self.packet["num_data"] = data[9]
-        self.extract_records(data)
+        self.packet["codec"] = buffer[8]
+        self.packet["num_data"] = buffer[9]
+        self.extract_records(buffer, 10)
         return self.packet
 
-    def extract_records(self, buffer):
-        remaining_data = self.packet["num_data"]
-        self.packet["records"] = []
-        pointer = 10
+    def decode_udp(self, data):
+        buffer = memoryview(data)
+        self.packet = {}
+        (
+            self.packet["length"],
+            self.packet["packet_id"],
+            _,
+            self.packet["avl_packet_id"],
+            imei_len,
+        ) = UDP_HEADER.unpack_from(buffer)
+        if self.packet["length"] != len(buffer) - 2:
+            raise Exception("invalid packet length")
+        pointer = UDP_HEADER.size
+        self.packet["imei"] = bytes(buffer[pointer : pointer + imei_len]).decode(
+            "ascii"
+        )
+        pointer += imei_len
+        self.packet["codec"] = buffer[pointer]
+        self.packet["num_data"] = buffer[pointer + 1]
+        self.extract_records(buffer, pointer + 2)
+        return self.packet
+
+    def generate_udp_response(self, success=True):
+        s = self.packet["num_data"] if success else 0
+        return pack(
+            ">HHBBB",
+            5,
+            self.packet["packet_id"],
+            1,
+            self.packet["avl_packet_id"],
+            s,
+        )
+
+    def extract_records(self, buffer, pointer=10):
+        codec = self.packet["codec"]
+        if codec not in IO_FORMATS:
+            raise Exception("codec should be 8 or 8 extended")
+        record_struct, io_struct, count_size = IO_FORMATS[codec]
+        extended = codec == CODEC_8_EXTENDED
+        num_data = self.packet["num_data"]
+        records = []
         self.alarm_triggered = False
-        while remaining_data > 0:
-            timestamp = unpack(">Q", buffer[pointer : pointer + 8])[0] / 1e3
-            lon = unpack(">i", buffer[pointer + 9 : pointer + 13])[0] / 1e7
-            lat = unpack(">i", buffer[pointer + 13 : pointer + 17])[0] / 1e7
-            n1 = buffer[pointer + 26]
-            pointer += 27
-            for i in range(n1):
-                avl_id = buffer[pointer + i * 2]
-                if avl_id == 113:
-                    self.battery_level = buffer[pointer + 1 + i * 2]
-                if avl_id == 236:
-                    self.alarm_triggered = buffer[pointer + 1 + i * 2]
-            pointer += n1 * 2
-
-            n2 = buffer[pointer]
-            pointer += 1 + 3 * n2
-
-            n4 = buffer[pointer]
-            pointer += 1 + 5 * n4
-
-            n8 = buffer[pointer]
-            pointer += 1 + 9 * n8
-            self.packet["records"].append(
+        for _ in range(num_data):
+            timestamp, lon, lat, n1 = record_struct.unpack_from(buffer, pointer)
+            pointer += record_struct.size
+            if n1:
+                end = pointer + n1 * io_struct.size
+                for avl_id, value in io_struct.iter_unpack(buffer[pointer:end]):
+                    if avl_id == IO_BATTERY_LEVEL:
+                        self.battery_level = value
+                    elif avl_id == IO_ALARM:
+                        self.alarm_triggered = value
+                pointer = end
+            # skip 2, 4 and 8 bytes IO values
+            for value_size in (2, 4, 8):
+                if extended:
+                    n = UINT16.unpack_from(buffer, pointer)[0]
+                else:
+                    n = buffer[pointer]
+                pointer += count_size + n * (count_size + value_size)
+            if extended:
+                nx = UINT16.unpack_from(buffer, pointer)[0]
+                pointer += 2
+                for _ in range(nx):
+                    pointer += 4 + UINT16.unpack_from(buffer, pointer + 2)[0]
+            records.append(
                 {
-                    "timestamp": timestamp,
-                    "latlon": [lat, lon],
+                    "timestamp": timestamp / 1e3,
+                    "latlon": [lat / 1e7, lon / 1e7],
                 }
             )
-            remaining_data -= 1
+        if pointer >= len(buffer) or buffer[pointer] != num_data:
+            raise Exception("number of data mismatch")
+        self.packet["records"] = records
         return pointer
 
 
@@ -78,8 +181,7 @@ class TMT250Connection:
         self.stream = stream
         self.stream.set_close_callback(self._on_close)
         self.decoder = TMT250Decoder()
-        self.packet_len = 0
-        self.buffer = None
+        self.reader = TMT250FrameReader()
         self.db_device = None
         self.logger = logger
 
@@ -124,25 +226,20 @@ class TMT250Connection:
         while await self._on_write_complete():
             pass
 
-    async def _on_read_line(self, data):
-        zeroes = unpack(">i", data[:4])[0]
-        if zeroes != 0:
-            raise Exception("zeroes should be 0")
-        self.packet_length = unpack(">i", data[4:8])[0] + 4
-        self.buffer = bytes(data)
-        await self._on_full_data()
-
     async def _on_write_complete(self):
         if not self.stream.reading():
-            data = bytearray(b"0" * 2048)
             try:
-                data_len = await self.stream.read_into(data, partial=True)
-                print(f"{self.imei} is sending {data_len} bytes")
-                self.logger.info(
-                    f"TMT250 DATA, {self.aid}, {self.address}, {self.imei}: "
-                    f"{safe64encode(bytes(data[:data_len]))}"
+                data_len = await self.stream.read_into(
+                    self.reader.write_view(), partial=True
                 )
-                await self._on_read_line(data[:data_len])
+                print(f"{self.imei} is sending {data_len} bytes")
+                self.reader.commit(data_len)
+                for frame in self.reader.frames():
+                    self.logger.info(
+                        f"TMT250 DATA, {self.aid}, {self.address}, {self.imei}: "
+                        f"{safe64encode(bytes(frame))}"
+                    )
+                    await self._on_full_data(frame)
             except Exception as e:
                 print("exception reading data " + str(e))
                 return False
@@ -151,9 +248,9 @@ class TMT250Connection:
     def _on_close(self):
         print("Client quit", self.address)
 
-    async def _on_full_data(self):
+    async def _on_full_data(self, frame):
         try:
-            decoded = self.decoder.decode_alv(self.buffer)
+            decoded = self.decoder.decode_alv(frame)
         except Exception:
             print("error decoding packet")
             await self.stream.write(self.decoder.generate_response(False))
@@ -182,3 +279,52 @@ class TMT250Connection:
 
 class TMT250Server(GenericTCPServer):
     connection_class = TMT250Connection
+
+
+class TMT250UDPServer(GenericUDPServer):
+    async def handle_datagram(self, data, address):
+        decoder = TMT250Decoder()
+        try:
+            decoded = decoder.decode_udp(data)
+            imei = decoded["imei"]
+            validate_imei(imei)
+        except Exception:
+            print(f"error decoding udp packet from {address}", flush=True)
+            return
+        self.logger.info(
+            f"TMT250 UDP DATA, {address}, {imei}: {safe64encode(bytes(data))}"
+        )
+        packet_key = (imei, decoded["packet_id"], decoded["avl_packet_id"])
+        async with self.device_lock(imei):
+            if self.is_retransmit(packet_key):
+                print(f"{imei} retransmitted packet {decoded['packet_id']}")
+                self.send(decoder.generate_udp_response(), address)
+                return
+            db_device = await self.get_device(imei)
+            if not db_device:
+                print(f"imei {imei} not registered ({address})", flush=True)
+                self.forget_packet(packet_key)
+                return
+            loc_array = []
+            for r in decoded.get("records", []):
+                loc_array.append((int(r["timestamp"]), r["latlon"][0], r["latlon"][1]))
+            if not db_device.user_agent:
+                db_device.user_agent = "Teltonika"
+            if decoder.battery_level:
+                db_device.battery_level = decoder.battery_level
+            try:
+                await add_locations(db_device, loc_array)
+            except Exception:
+                self.forget_packet(packet_key)
+                raise
+            print(f"{len(loc_array)} locations wrote to DB", flush=True)
+            self.send(decoder.generate_udp_response(), address)
+            if decoder.alarm_triggered:
+                sos_device_aid, sos_lat, sos_lon, sos_sent_to = await send_sos(
+                    db_device
+                )
+                print(
+                    f"SOS triggered by device {sos_device_aid}, {sos_lat}, {sos_lon}"
+                    f" email sent to {sos_sent_to}",
+                    flush=True,
+                )
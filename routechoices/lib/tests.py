@@ -1,14 +1,53 @@
+import os
+import socket
+import struct
+import tempfile
+from io import BytesIO
 from unittest.mock import Mock, patch
 
-from django.test import TestCase, override_settings
+import cbor2
+import numpy as np
+from aiohttp import web
+from asgiref.sync import sync_to_async
+from django.test import TestCase, TransactionTestCase, override_settings
+from PIL import Image
+
+from routechoices.core.models import Device, SpotDevice, SpotFeed
 
 from . import plausible
+from .globalmaptiles import GlobalMercator
 from .helpers import (
     check_cname_record,
     check_txt_record,
     compute_corners_from_kml_latlonbox,
     three_point_calibration_to_corners,
 )
+from .map_geometry import get_map_geometry
+from .map_originals import checked_path, evict_originals, load_original, original_path
+from .map_processing import (
+    PNG_SIGNATURE,
+    MapImageTooLarge,
+    check_map_image,
+    png_chunk,
+    write_png_strips,
+)
+from .map_tiles import (
+    build_mip_chain,
+    evict_rasters,
+    fit_zoom,
+    frontend_tiles_plan,
+    load_raster,
+    mip_chain_length,
+    mip_level_for_tile,
+    store_rasters,
+    tile_bounds,
+    tiles_covering,
+)
+from .route_tiles import clip_track, encode_route_tile, project_tracks
+from .spot_crawler import SpotCrawler
+from .tile_cache import MemoryTier, TileCache
+
+GLOBAL_MERCATOR = GlobalMercator()
 
 
 @override_settings(ANALYTICS_API_KEY=True)
@@ -125,3 +164,340 @@ class HelperTestCase(TestCase):
     def test_check_dns(self):
         self.assertTrue(check_cname_record("live.kiilat.com"))
         self.assertTrue(check_txt_record("live.kiilat.com"))
+
+
+SPOT_FEED_XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<response><feedMessageResponse><count>3</count><messages>
+<message><messengerId>0-1234567</messengerId><unixTime>1706872596</unixTime>
+<messageType>TRACK</messageType><latitude>60.455</latitude>
+<longitude>18.567</longitude></message>
+<message><messengerId>0-1234567</messengerId><unixTime>1706872597</unixTime>
+<messageType>OK</messageType><latitude>60.456</latitude>
+<longitude>18.568</longitude></message>
+<message><messengerId>0-7654321</messengerId><unixTime>1706872598</unixTime>
+<messageType>UNLIMITED-TRACK</messageType><latitude>60.457</latitude>
+<longitude>18.569</longitude></message>
+</messages></feedMessageResponse></response>"""
+
+
+class MapGeometryTestCase(TestCase):
+    def test_map_geometry(self):
+        corners = (
+            "61.45075,24.18994,61.44656,24.24721,61.42094,24.23851,61.42533,24.18156"
+        )
+        geometry = get_map_geometry(corners, 4000, 3000)
+        self.assertIs(geometry, get_map_geometry(corners, 4000, 3000))
+        self.assertEqual(geometry.bound["topRight"], {"lat": 61.44656, "lon": 24.24721})
+        self.assertEqual(geometry.min_lat, 61.42094)
+        self.assertEqual(geometry.max_lon, 24.24721)
+        self.assertEqual(geometry.max_zoom, 20)
+
+        lats = np.array([61.45075, 61.42094, 61.43])
+        lons = np.array([24.18994, 24.23851, 24.2])
+        xs, ys = geometry.wsg84_to_map_xy_array(lats, lons)
+        self.assertAlmostEqual(xs[0], 0, places=3)
+        self.assertAlmostEqual(ys[0], 0, places=3)
+        self.assertAlmostEqual(xs[1], 4000, places=3)
+        self.assertAlmostEqual(ys[1], 3000, places=3)
+        mx, my = geometry.map_xy_to_spherical_mercator_array(xs, ys)
+        for i in range(3):
+            x, y = geometry.map_xy_to_spherical_mercator(xs[i], ys[i])
+            self.assertAlmostEqual(x, mx[i], places=6)
+            self.assertAlmostEqual(y, my[i], places=6)
+
+    def test_map_tile_intersection(self):
+        # Map rotated 45 degrees
+        geometry = get_map_geometry("0.01,0,0,0.01,-0.01,0,0,-0.01", 1000, 1000)
+        bboxes = [
+            # Tile at the center
+            (-100, 100, -100, 100),
+            # Tile in the bounding box of the map but outside of it
+            (800, 1100, 800, 1100),
+            # Tile overlapping a corner
+            (1000, 1200, -100, 100),
+            # Tile outside the bounding box
+            (2000, 2100, 0, 100),
+        ]
+        expected = [True, False, True, False]
+        self.assertEqual(
+            [geometry.intersects_with_bbox(*bbox) for bbox in bboxes], expected
+        )
+        self.assertEqual(geometry.intersects_with_bboxes(bboxes).tolist(), expected)
+
+
+class MapTilesTestCase(TestCase):
+    def test_mip_chain(self):
+        img = np.zeros((1500, 2100, 4), dtype=np.uint8)
+        levels = build_mip_chain(img)
+        self.assertEqual(
+            [level.shape[:2] for level in levels],
+            [(1500, 2100), (750, 1050), (375, 525), (188, 263)],
+        )
+        self.assertEqual(mip_chain_length(2100, 1500), len(levels))
+
+        # Map covering exactly the tile 0/0/0
+        min_x, max_x, min_y, max_y = tile_bounds(0, 0, 0)
+        corners = ((min_x, max_y), (max_x, max_y), (max_x, min_y), (min_x, min_y))
+        bounds = (min_x, max_x, min_y, max_y)
+        self.assertEqual(
+            mip_level_for_tile(2048, 2048, corners, 256, 256, *bounds, 4), 3
+        )
+        self.assertEqual(
+            mip_level_for_tile(2048, 2048, corners, 256, 256, *bounds, 2), 1
+        )
+        self.assertEqual(mip_level_for_tile(256, 256, corners, 256, 256, *bounds, 1), 0)
+
+    @override_settings(RASTER_STORE_ROOT=tempfile.mkdtemp())
+    def test_raster_store(self):
+        img = np.full((600, 800, 4), 255, dtype=np.uint8)
+        self.assertIsNone(load_raster("abc", "maps/abc.png", 0))
+        with override_settings(RASTER_STORE_MAX_BYTES=2**30):
+            store_rasters("abc", "maps/abc.png", build_mip_chain(img))
+        raster = load_raster("abc", "maps/abc.png", 1)
+        self.assertIsInstance(raster, np.memmap)
+        self.assertEqual(raster.shape, (300, 400, 4))
+        self.assertTrue((raster == 255).all())
+
+        # Level 0 is the least recently used raster
+        level_0_path = raster.filename.replace("1.npy", "0.npy")
+        os.utime(level_0_path, (0, 0))
+        evict_rasters(raster.nbytes + 1024)
+        self.assertIsNone(load_raster("abc", "maps/abc.png", 0))
+        self.assertIsNotNone(load_raster("abc", "maps/abc.png", 1))
+
+    def test_frontend_tiles_plan(self):
+        corners = get_map_geometry(
+            "61.45075,24.18994,61.44656,24.24721,61.42094,24.23851,61.42533,24.18156",
+            4000,
+            3000,
+        ).corners_xy
+        self.assertEqual(fit_zoom(corners, 1920, 1080), 14)
+        self.assertEqual(fit_zoom(corners, 390, 844), 13)
+        plan = frontend_tiles_plan(corners, 20, [(1920, 1080), (390, 844)], 2)
+        self.assertEqual(
+            [zoom for zoom, _ in plan], [13] * 2 + [14] * 4 + [15] * 14 + [16] * 38
+        )
+        # Leaflet asks the 512px tiles covering the 256px tiles of the zoom below
+        tiles_x, tiles_y = tiles_covering(corners, 12)
+        self.assertIn(
+            plan[0][1], [tile_bounds(x, y, 12) for x in tiles_x for y in tiles_y]
+        )
+        plan = frontend_tiles_plan(corners, 14, [(1920, 1080), (390, 844)], 2)
+        self.assertEqual(max(zoom for zoom, _ in plan), 14)
+
+    def test_route_tiles(self):
+        self.assertEqual(
+            clip_track(np.array([0, 5, 10, 15]), np.zeros(4), 4, 6, -1, 1), [(0, 3)]
+        )
+        self.assertEqual(
+            len(project_tracks([("abc", [(0, 61.45, 24.19)]), ("def", [])])), 1
+        )
+        origin = GLOBAL_MERCATOR.originShift
+        tracks = [
+            (
+                "abc",
+                np.array([-origin / 2, -origin / 4, origin / 2]),
+                np.array([origin / 2, origin / 4, -origin / 2]),
+            ),
+            ("def", np.array([origin / 2, origin / 2 + 1]), np.full(2, -origin / 2)),
+        ]
+        # Lines are delta encoded from the top left corner of the tile
+        self.assertEqual(
+            cbor2.loads(encode_route_tile(tracks, 1, 0, 0)),
+            {
+                "extent": 512,
+                "features": [{"id": "abc", "lines": [[256, 256, 128, 128, 384, 384]]}],
+            },
+        )
+        features = cbor2.loads(encode_route_tile(tracks, 1, 1, 1))["features"]
+        self.assertEqual(features[0]["lines"], [[-128, -128, 384, 384]])
+        self.assertEqual(features[1]["id"], "def")
+
+    def test_write_png_strips(self):
+        pixels = np.random.default_rng(0).integers(0, 255, (300, 413, 3), np.uint8)
+        image = Image.fromarray(pixels).convert("P")
+        image.info["transparency"] = 0
+        out = BytesIO()
+        write_png_strips(image, out)
+        out.seek(0)
+        with Image.open(out) as png:
+            self.assertEqual(png.info["dpi"], (72.009, 72.009))
+            self.assertTrue(
+                (np.asarray(png) == np.asarray(image.convert("RGBA"))).all()
+            )
+
+    @override_settings(MAP_MAX_PIXELS=300 * 10**6, MAP_PROCESSING_MAX_BYTES=2**30)
+    def test_check_map_image(self):
+        def png_header(width, height):
+            return BytesIO(
+                PNG_SIGNATURE
+                + png_chunk(
+                    b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+                )
+                + png_chunk(b"IEND", b"")
+            )
+
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        # Above the decompression bomb limit of Pillow
+        self.assertEqual(check_map_image(png_header(15000, 15000)), (15000, 15000))
+        # Under MAP_MAX_PIXELS but too large to be decoded by the worker
+        with self.assertRaises(MapImageTooLarge):
+            check_map_image(png_header(20000, 15000))
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, max_image_pixels)
+
+    @override_settings(
+        MAP_ORIGINALS_ROOT=tempfile.mkdtemp(),
+        MAP_ORIGINALS_MAX_BYTES=2**30,
+        MAP_ORIGINALS_REVALIDATE_SECONDS=300,
+    )
+    def test_map_originals_store(self):
+        objects = {"maps/abc": (b"abc", '"1"'), "maps/def": (b"defgh", '"1"')}
+        storage = Mock()
+        storage.etag.side_effect = lambda name: objects[name][1]
+
+        def download(name, fp):
+            fp.write(objects[name][0])
+            return objects[name][1]
+
+        storage.download.side_effect = download
+        data = load_original(storage, "maps/abc")
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(bytes(data), b"abc")
+        self.assertEqual(bytes(load_original(storage, "maps/abc")), b"abc")
+        self.assertEqual(storage.download.call_count, 1)
+        storage.etag.assert_not_called()
+
+        # Changes on the storage are seen once the copy is revalidated
+        objects["maps/abc"] = (b"abcd", '"2"')
+        self.assertEqual(bytes(load_original(storage, "maps/abc")), b"abc")
+        os.utime(checked_path(original_path("maps/abc")), (0, 0))
+        self.assertEqual(bytes(load_original(storage, "maps/abc")), b"abcd")
+        self.assertEqual(storage.download.call_count, 2)
+        self.assertEqual(bytes(data), b"abc")
+
+        # The local copy is kept while the storage is unreachable, not once
+        # the object is deleted
+        os.utime(checked_path(original_path("maps/abc")), (0, 0))
+        storage.etag.side_effect = OSError("S3Storage error")
+        self.assertEqual(bytes(load_original(storage, "maps/abc")), b"abcd")
+        storage.etag.side_effect = FileNotFoundError("S3Storage error")
+        storage.download.side_effect = FileNotFoundError("S3Storage error")
+        with self.assertRaises(FileNotFoundError):
+            load_original(storage, "maps/abc")
+        storage.etag.side_effect = lambda name: objects[name][1]
+        storage.download.side_effect = download
+
+        # The least recently used copy is evicted first, copies end with
+        # their ETag and its length
+        load_original(storage, "maps/def")
+        os.utime(original_path("maps/abc"), (0, 0))
+        self.assertEqual(evict_originals(10), 10)
+        self.assertFalse(os.path.exists(original_path("maps/abc")))
+        self.assertEqual(bytes(load_original(storage, "maps/def")), b"defgh")
+
+    def test_memory_tier_eviction(self):
+        tier = MemoryTier(10)
+        tier.set("map:abc:1", b"1234")
+        tier.set("map:abc:2", b"1234")
+        tier.get("map:abc:1")
+        tier.set("map:def:1", b"1234")
+        self.assertEqual(tier.size, 8)
+        self.assertIsNone(tier.get("map:abc:2"))
+        self.assertEqual(tier.get("map:abc:1"), b"1234")
+        self.assertEqual(tier.delete_map("abc"), 1)
+        self.assertEqual(tier.size, 4)
+
+    @override_settings(TILES_CACHE_ROOT=tempfile.mkdtemp(), TILES_CACHE_S3_BUCKET=None)
+    def test_tile_cache_tiers(self):
+        tile_cache = TileCache()
+        tile_cache.reset_stats()
+        tile_cache.set("map:abc:tile", b"tile", "abc")
+        tile_cache.set("tile:blank", b"blank")
+        tile_cache.memory.delete_map("abc")
+        self.assertEqual(tile_cache.get("map:abc:tile", "abc"), b"tile")
+        # Disk hits are copied to the memory tier
+        self.assertEqual(tile_cache.memory.get("map:abc:tile"), b"tile")
+        self.assertEqual(tile_cache.get("tile:blank"), b"blank")
+        self.assertIsNone(tile_cache.get("map:abc:other", "abc"))
+        self.assertEqual(tile_cache.disk.map_count("abc"), 1)
+        self.assertEqual(tile_cache.delete_map("abc"), {"memory": 1, "disk": 1})
+        self.assertIsNone(tile_cache.get("map:abc:tile", "abc"))
+        self.assertEqual(tile_cache.get("tile:blank"), b"blank")
+
+        stats = tile_cache.stats()
+        self.assertEqual(stats["memory"]["hits"], 2)
+        self.assertEqual(stats["memory"]["misses"], 3)
+        self.assertEqual(stats["memory"]["hit_rate"], 0.4)
+        self.assertEqual(stats["disk"]["hits"], 1)
+        self.assertEqual(stats["disk"]["misses"], 2)
+        self.assertIsNone(stats["s3"]["hit_rate"])
+
+    @override_settings(
+        TILES_CACHE_ROOT=tempfile.mkdtemp(), TILES_CACHE_S3_BUCKET="tiles-cache"
+    )
+    @patch("routechoices.lib.tile_cache.get_s3_client")
+    def test_tile_cache_s3_misses(self, mock_s3_client):
+        s3 = mock_s3_client.return_value
+        s3.get_object.side_effect = Exception("NoSuchKey")
+        tile_cache = TileCache()
+        tile_cache.set_s3_miss("map:abc:tile", False)
+        self.assertIsNone(tile_cache.get("map:abc:tile", "abc"))
+        # The miss is remembered, S3 is not asked again
+        self.assertIsNone(tile_cache.get("map:abc:tile", "abc"))
+        self.assertEqual(s3.get_object.call_count, 1)
+        # Blank tiles are not sent to S3
+        tile_cache.set("map:abc:blank", b"blank", "abc", blank=True)
+        s3.put_object.assert_not_called()
+        tile_cache.set("map:abc:tile", b"tile", "abc")
+        s3.put_object.assert_called_once()
+        self.assertFalse(tile_cache.is_s3_miss("map:abc:tile"))
+
+
+class SpotCrawlerTestCase(TransactionTestCase):
+    async def test_crawl(self):
+        requests = []
+
+        async def feed_view(request):
+            requests.append(request.match_info["feed_id"])
+            if request.match_info["feed_id"] == "broken":
+                return web.Response(status=500)
+            return web.Response(body=SPOT_FEED_XML, content_type="application/xml")
+
+        app = web.Application()
+        app.router.add_get("/{feed_id}/message.xml", feed_view)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        site = web.SockSite(runner, sock)
+        await site.start()
+        port = sock.getsockname()[1]
+
+        def create_data():
+            SpotFeed.objects.create(feed_id="feed")
+            SpotFeed.objects.create(feed_id="broken")
+            device = Device.objects.create()
+            SpotDevice.objects.create(messenger_id="0-1234567", device=device)
+            return device
+
+        device = await sync_to_async(create_data)()
+        crawler = SpotCrawler(
+            api_url=f"http://127.0.0.1:{port}/{{feed_id}}/message.xml"
+        )
+        start_date = crawler.get_feed_state("feed").last_fetch
+        try:
+            # Positions that could not be stored are fetched again
+            with patch.object(Device, "add_locations", side_effect=Exception("DB")):
+                n = await crawler.crawl()
+            self.assertEqual(n, 0)
+            self.assertEqual(sorted(requests), ["broken", "feed"])
+            self.assertEqual(crawler.get_feed_state("feed").last_fetch, start_date)
+            # Failing feed is not fetched again before its backoff delay
+            n = await crawler.crawl()
+            self.assertEqual(n, 1)
+            self.assertEqual(sorted(requests), ["broken", "feed", "feed"])
+            self.assertNotEqual(crawler.get_feed_state("feed").last_fetch, start_date)
+        finally:
+            await runner.cleanup()
+        device = await sync_to_async(Device.objects.get)(id=device.id)
+        self.assertEqual(device.location_count, 1)
@@ -0,0 +1,115 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+
+from routechoices.lib.helpers import safe64encodedsha
+from routechoices.lib.map_tiles import cache_lock
+from routechoices.lib.storages import OverwriteImageStorage
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_MIMES = ("image/jpeg", "image/webp", "image/avif", "image/jxl")
+THUMBNAIL_CACHE_TIMEOUT = 31 * 24 * 3600
+
+
+def thumbnail_storage():
+    return OverwriteImageStorage(aws_s3_bucket_name=settings.AWS_S3_BUCKET)
+
+
+def thumbnails_prefix(owner, aid):
+    return f"thumbnails/{owner}/{aid}/"
+
+
+def thumbnail_object_name(owner, aid, cache_key, mime):
+    """Objects are named after the cache key, which changes with their content"""
+    return f"{thumbnails_prefix(owner, aid)}{safe64encodedsha(cache_key)}.{mime[6:]}"
+
+
+def read_thumbnail(object_name):
+    try:
+        with thumbnail_storage().open(object_name) as fp:
+            return fp.read()
+    except Exception:
+        return None
+
+
+def store_thumbnail(cache_key, object_name, data):
+    try:
+        thumbnail_storage().save(object_name, ContentFile(data))
+    except Exception:
+        logger.exception("Could not store thumbnail %s", object_name)
+    try:
+        cache.set(cache_key, data, THUMBNAIL_CACHE_TIMEOUT)
+    except Exception:
+        pass
+
+
+def get_thumbnail(cache_key, object_name, render):
+    """
+    Return a thumbnail from the cache or the object storage, rendering it when
+    it was not precomputed, only once at a time across the workers
+    """
+    try:
+        data = cache.get(cache_key)
+    except Exception:
+        data = None
+    if data:
+        return data
+    data = read_thumbnail(object_name)
+    if data:
+        try:
+            cache.set(cache_key, data, THUMBNAIL_CACHE_TIMEOUT)
+        except Exception:
+            pass
+        return data
+    with cache_lock(f"{cache_key}:rendering", timeout=60, wait=30) as acquired:
+        if not acquired:
+            # The other worker did not finish in time, render it here too
+            return render()
+        try:
+            data = cache.get(cache_key)
+        except Exception:
+            data = None
+        if not data:
+            data = render()
+            store_thumbnail(cache_key, object_name, data)
+    return data
+
+
+def precompute_thumbnails(owner, aid, renders):
+    """
+    Store the thumbnails given as (cache_key, object_name, render) not stored
+    yet and delete the objects of the thumbnails outdated by them
+    """
+    storage = thumbnail_storage()
+    prefix = thumbnails_prefix(owner, aid)
+    try:
+        _, stored = storage.listdir(prefix)
+    except Exception:
+        stored = []
+    stored = {f"{prefix}{name}" for name in stored}
+    object_names = set()
+    for cache_key, object_name, render in renders:
+        object_names.add(object_name)
+        if object_name in stored:
+            continue
+        store_thumbnail(cache_key, object_name, render())
+    for object_name in stored - object_names:
+        try:
+            storage.delete(object_name)
+        except Exception:
+            pass
+    return len(object_names)
+
+
+def delete_thumbnails(owner, aid):
+    storage = thumbnail_storage()
+    prefix = thumbnails_prefix(owner, aid)
+    try:
+        _, stored = storage.listdir(prefix)
+        for name in stored:
+            storage.delete(f"{prefix}{name}")
+    except Exception:
+        pass
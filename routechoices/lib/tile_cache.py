@@ -0,0 +1,308 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import arrow
+from diskcache import FanoutCache
+from django.conf import settings
+from django.core.cache import cache
+
+from routechoices.lib.s3 import get_s3_client
+
+TILE_CACHE_TIMEOUT = 3600 * 24 * 30
+TIERS = ("memory", "disk", "s3")
+STATS_KEY = "tile_cache:stats:{}:{}"
+S3_MISS_KEY = "tile_cache:s3_miss:{}"
+STATS_FLUSH_INTERVAL = 10
+
+
+class MemoryTier:
+    """LRU of tiles bounded in bytes, private to the worker process"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, map_aid=None):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def set(self, key, data, map_aid=None):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def delete_map(self, map_aid):
+        prefix = f"map:{map_aid}:"
+        with self.lock:
+            keys = [key for key in self.items if key.startswith(prefix)]
+            for key in keys:
+                self.size -= len(self.items.pop(key))
+        return len(keys)
+
+
+class DiskTier:
+    """
+    Local disk cache bounded in bytes, shared by the workers of the host,
+    tiles are tagged with their map aid so they can be pruned by map
+    """
+
+    def __init__(self, directory, max_bytes, eviction_policy):
+        self.cache = FanoutCache(
+            directory,
+            shards=4,
+            timeout=0.1,
+            size_limit=max_bytes,
+            eviction_policy=eviction_policy,
+            tag_index=True,
+        )
+
+    def get(self, key, map_aid=None):
+        return self.cache.get(key)
+
+    def set(self, key, data, map_aid=None):
+        self.cache.set(key, data, expire=TILE_CACHE_TIMEOUT, tag=map_aid)
+
+    def delete_map(self, map_aid):
+        return self.cache.evict(map_aid)
+
+    def map_count(self, map_aid):
+        prefix = f"map:{map_aid}:"
+        return sum(
+            1 for key in self.cache if isinstance(key, str) and key.startswith(prefix)
+        )
+
+
+class S3Tier:
+    """
+    Tiles kept in an object storage bucket, shared by all the hosts, only the
+    tiles of a map are stored there and they expire after max_age seconds
+    """
+
+    def __init__(self, bucket, prefix, max_age):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_age = max_age
+
+    def object_key(self, key, map_aid):
+        return f"{self.prefix}/{map_aid}/{hashlib.sha256(key.encode()).hexdigest()}"
+
+    def get(self, key, map_aid=None):
+        if not map_aid:
+            return None
+        obj = get_s3_client().get_object(
+            Bucket=self.bucket, Key=self.object_key(key, map_aid)
+        )
+        if obj["LastModified"] < arrow.utcnow().shift(seconds=-self.max_age).datetime:
+            return None
+        return obj["Body"].read()
+
+    def set(self, key, data, map_aid=None):
+        if not map_aid:
+            return
+        get_s3_client().put_object(
+            Bucket=self.bucket, Key=self.object_key(key, map_aid), Body=data
+        )
+
+    def list_objects(self, prefix):
+        s3 = get_s3_client()
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get("Contents", [])
+
+    def delete_objects(self, objects):
+        s3 = get_s3_client()
+        keys = [{"Key": obj["Key"]} for obj in objects]
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": keys[i : i + 1000]}
+            )
+        return len(keys)
+
+    def map_objects(self, map_aid):
+        return list(self.list_objects(f"{self.prefix}/{map_aid}/"))
+
+    def delete_map(self, map_aid):
+        return self.delete_objects(self.map_objects(map_aid))
+
+    def delete_expired(self):
+        expired_before = arrow.utcnow().shift(seconds=-self.max_age).datetime
+        return self.delete_objects(
+            obj
+            for obj in self.list_objects(f"{self.prefix}/")
+            if obj["LastModified"] < expired_before
+        )
+
+
+class TileCache:
+    """
+    Tiles looked up in the memory, disk and S3 tiers in that order, a hit in a
+    tier is copied to the tiers above it, hits and misses are counted per tier
+    and added to the default cache every few seconds so all the workers add
+    up. S3 misses are remembered in the default cache for a while so cold
+    tiles do not cost a round trip each. Neither is kept in the disk tier,
+    where they would be evicted along with the tiles.
+    """
+
+    def __init__(self):
+        self.memory = MemoryTier(settings.TILES_CACHE_MEMORY_MAX_BYTES)
+        self.disk = DiskTier(
+            settings.TILES_CACHE_ROOT,
+            settings.TILES_CACHE_MAX_BYTES,
+            settings.TILES_CACHE_EVICTION_POLICY,
+        )
+        self.s3 = None
+        if settings.TILES_CACHE_S3_BUCKET:
+            self.s3 = S3Tier(
+                settings.TILES_CACHE_S3_BUCKET,
+                settings.TILES_CACHE_S3_PREFIX,
+                settings.TILES_CACHE_S3_MAX_AGE,
+            )
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    @property
+    def tiers(self):
+        tiers = [("memory", self.memory), ("disk", self.disk)]
+        if self.s3:
+            tiers.append(("s3", self.s3))
+        return tiers
+
+    def count(self, tier_name, hit):
+        counter = (tier_name, "hits" if hit else "misses")
+        with self.counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+        if time.monotonic() - self.last_flush > STATS_FLUSH_INTERVAL:
+            self.flush_stats()
+
+    def flush_stats(self):
+        with self.counters_lock:
+            counters, self.counters = self.counters, {}
+            self.last_flush = time.monotonic()
+        try:
+            for (tier_name, kind), value in counters.items():
+                stats_key = STATS_KEY.format(tier_name, kind)
+                cache.add(stats_key, 0, None)
+                cache.incr(stats_key, value)
+        except Exception:
+            pass
+
+    def stats(self):
+        self.flush_stats()
+        stats = {}
+        for tier_name in TIERS:
+            hits = cache.get(STATS_KEY.format(tier_name, "hits"), 0)
+            misses = cache.get(STATS_KEY.format(tier_name, "misses"), 0)
+            stats[tier_name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else None,
+            }
+        return stats
+
+    def reset_stats(self):
+        with self.counters_lock:
+            self.counters = {}
+        for tier_name in TIERS:
+            for kind in ("hits", "misses"):
+                cache.delete(STATS_KEY.format(tier_name, kind))
+
+    def get(self, key, map_aid=None):
+        for i, (tier_name, tier) in enumerate(self.tiers):
+            if tier_name == "s3" and self.is_s3_miss(key):
+                self.count(tier_name, False)
+                continue
+            try:
+                data = tier.get(key, map_aid)
+            except Exception:
+                data = None
+            self.count(tier_name, data is not None)
+            if data is None and tier_name == "s3" and map_aid:
+                self.set_s3_miss(key, True)
+            if data is not None:
+                for _, upper_tier in self.tiers[:i]:
+                    try:
+                        upper_tier.set(key, data, map_aid)
+                    except Exception:
+                        pass
+                return data
+        return None
+
+    def set(self, key, data, map_aid=None, blank=False):
+        """Blank tiles are cheap to render again, they are not sent to S3"""
+        for tier_name, tier in self.tiers:
+            if tier_name == "s3":
+                if blank:
+                    continue
+                self.set_s3_miss(key, False)
+            try:
+                tier.set(key, data, map_aid)
+            except Exception:
+                pass
+
+    def is_s3_miss(self, key):
+        try:
+            return cache.get(S3_MISS_KEY.format(key)) is not None
+        except Exception:
+            return False
+
+    def set_s3_miss(self, key, missing):
+        try:
+            if missing:
+                cache.set(
+                    S3_MISS_KEY.format(key),
+                    True,
+                    settings.TILES_CACHE_S3_MISS_TIMEOUT,
+                )
+            else:
+                cache.delete(S3_MISS_KEY.format(key))
+        except Exception:
+            pass
+
+    def clear(self):
+        """Empty the memory tier of this worker and the disk tier of this host"""
+        self.memory.clear()
+        self.disk.cache.clear()
+
+    def delete_map(self, map_aid):
+        """
+        Remove the tiles of a map from the tiers of this host and from S3, the
+        memory tiers of the other workers let them go as they are evicted
+        """
+        deleted = {}
+        for tier_name, tier in self.tiers:
+            deleted[tier_name] = tier.delete_map(map_aid)
+        return deleted
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    global _tile_cache
+    if _tile_cache is None:
+        with _tile_cache_lock:
+            if _tile_cache is None:
+                _tile_cache = TileCache()
+    return _tile_cache
@@ -242,6 +242,57 @@ CACHES = {
 CACHE_TILES = True
 CACHE_THUMBS = True
 CACHE_EVENT_DATA = True
+TILES_PYRAMID_ROOT = os.path.join(BASE_DIR, "tiles")
+TILES_PYRAMID_MIMES = ["image/webp", "image/png"]
+TILES_PYRAMID_PROCESSES = 2
+TILES_METATILE_SIZE = 1
+TILES_PUBLIC_ROOT = os.path.join(BASE_DIR, "tiles_public")
+TILES_PUBLIC_MAX_BYTES = 4 * 2**30
+# Public tiles are written up to this many zoom levels past the map max zoom
+TILES_PUBLIC_EXTRA_ZOOMS = 2
+TILES_PUBLIC_EVICTION_INTERVAL = 10 * 60
+# Tile renders running at once across all the workers, 0 for no limit
+TILES_RENDER_CONCURRENCY = 4
+TILES_RENDER_QUEUE_TIMEOUT = 5
+TILES_RENDER_RETRY_AFTER = 2
+TILES_RENDER_CV2_THREADS = 1
+# Tiles are cached in a LRU in each worker, then on disk, then optionally on S3
+TILES_CACHE_MEMORY_MAX_BYTES = 64 * 2**20
+TILES_CACHE_ROOT = os.path.join(BASE_DIR, "tiles_cache")
+TILES_CACHE_MAX_BYTES = 4 * 2**30
+TILES_CACHE_EVICTION_POLICY = "least-recently-used"
+TILES_CACHE_S3_BUCKET = None
+TILES_CACHE_S3_PREFIX = "tiles-cache"
+TILES_CACHE_S3_MAX_AGE = 90 * 24 * 3600
+# Tiles missing from S3 are not looked up there again for this long
+TILES_CACHE_S3_MISS_TIMEOUT = 3600
+# Tiles of events starting in the next hours or live are rendered in advance
+TILES_WARM_HOURS_AHEAD = 3
+TILES_WARM_INTERVAL = 10 * 60
+TILES_WARM_CPU_SECONDS = 120
+# First choice of get_best_image_mime and fallback of the WMS layers
+TILES_WARM_MIMES = ["image/webp", "image/jpeg"]
+# Desktop and mobile viewports, the event page fits the map in them
+TILES_WARM_VIEWPORTS = [(1920, 1080), (390, 844)]
+TILES_WARM_EXTRA_ZOOMS = 2
+# Club changes precompute the thumbnails of its events ended in the last days
+THUMBNAILS_PRECOMPUTE_DAYS = 7
+# Uploaded map images with more pixels are rejected
+MAP_MAX_PIXELS = 300 * 10**6
+# Uploaded map images taking more memory once decoded are rejected, processing
+# decodes the whole image
+MAP_PROCESSING_MAX_BYTES = 2**30
+# Map images of KMZ files, downloaded or extracted, can not be larger
+MAP_IMPORT_MAX_BYTES = 100 * 2**20
+# Larger maps are stored as PNG, converted and compressed by strips of rows
+# instead of encoding a full RGBA copy at once
+MAP_WEBP_MAX_PIXELS = 32 * 10**6
+RASTER_STORE_ROOT = os.path.join(BASE_DIR, "rasters")
+RASTER_STORE_MAX_BYTES = 8 * 2**30
+# Local copies of the map images, checked against the storage ETag once in a while
+MAP_ORIGINALS_ROOT = os.path.join(BASE_DIR, "originals")
+MAP_ORIGINALS_MAX_BYTES = 4 * 2**30
+MAP_ORIGINALS_REVALIDATE_SECONDS = 300
 AWS_SESSION_TOKEN = ""
 AWS_S3_BUCKET = "routechoices"
 GEOIP_PATH = os.path.join(BASE_DIR, "geoip")
@@ -1,16 +1,43 @@
+import base64
+import os.path
 import tempfile
+from io import BytesIO
 from pathlib import Path
+from unittest.mock import patch
 
 import arrow
 from django.core.cache import cache
+from PIL import Image
 from rest_framework import status
 from rest_framework.test import APIClient, override_settings
 
 from routechoices.api.tests import EssentialApiBase
-from routechoices.core.models import Club, Event, Map, MapAssignation
+from routechoices.core.models import (
+    PRIVACY_PRIVATE,
+    PRIVACY_PUBLIC,
+    Club,
+    Event,
+    Map,
+    MapAssignation,
+)
+from routechoices.lib.map_tiles import (
+    RENDER_SLOT_KEY,
+    evict_public_tiles,
+    has_pyramid,
+    public_tile_path,
+    render_stats,
+    tile_bounds,
+    tiles_covering,
+)
+from routechoices.lib.tile_cache import TileCache, get_tile_cache
 
 
-@override_settings(MEDIA_ROOT=Path(tempfile.gettempdir()))
+@override_settings(
+    MEDIA_ROOT=Path(tempfile.gettempdir()),
+    TILES_PYRAMID_ROOT=tempfile.mkdtemp(),
+    TILES_PUBLIC_ROOT=tempfile.mkdtemp(),
+    RASTER_STORE_ROOT=tempfile.mkdtemp(),
+)
 class MapApiTestCase(EssentialApiBase):
     def test_get_tile(self):
         client = APIClient(HTTP_HOST="tiles.routechoices.dev")
@@ -126,8 +153,62 @@ class MapApiTestCase(EssentialApiBase):
         )
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
+    @override_settings(TILES_METATILE_SIZE=4)
+    def test_metatile_rendering(self):
+        cache.clear()
+        get_tile_cache().clear()
+        client = APIClient(HTTP_HOST="tiles.routechoices.dev")
+        url = self.reverse_and_check("tile_service", "/", "tiles")
+        club = Club.objects.create(name="Test club", slug="club")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+            width=1,
+            height=1,
+        )
+        raster_map.data_uri = (
+            "data:image/png;base64,"
+            "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAAXNSR0IArs4c6Q"
+            "AAAA1JREFUGFdjED765z8ABZcC1M3x7TQAAAAASUVORK5CYII="
+        )
+        raster_map.save()
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            open_registration=True,
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+        )
+        base_url = f"{url}?z=17&layers={event.aid}&format=image%2Fpng"
+        res = client.get(f"{base_url}&x=74352&y=36993")
+        self.assertEqual(res.headers["X-Cache-Hit"], "0")
+        # neighbour tile in the same metatile was rendered with the first one
+        res = client.get(f"{base_url}&x=74353&y=36994")
+        self.assertEqual(res.headers["X-Cache-Hit"], "1")
+        # tile in the next metatile was not
+        res = client.get(f"{base_url}&x=74356&y=36994")
+        self.assertEqual(res.headers["X-Cache-Hit"], "0")
+        # tile cached by another request while waiting for the metatile lock
+        with patch.object(TileCache, "get", side_effect=[None, b"tile"]):
+            self.assertEqual(
+                raster_map.create_tile(
+                    256,
+                    256,
+                    "image/png",
+                    *tile_bounds(74360, 36994, 17),
+                    tile_zxy=(17, 74360, 36994),
+                ),
+                (b"tile", 1),
+            )
+
     def test_should_hit_cache(self):
         cache.clear()
+        get_tile_cache().clear()
         client = APIClient(HTTP_HOST="tiles.routechoices.dev")
         url = self.reverse_and_check("tile_service", "/", "tiles")
         club = Club.objects.create(name="Test club", slug="club")
@@ -191,3 +272,219 @@ class MapApiTestCase(EssentialApiBase):
             f"{base_url}{non_intersecting_bbox_2}",
         )
         self.assertEqual(res.headers["X-Cache-Hit"], "2")
+
+    def test_serve_tile_from_pyramid(self):
+        cache.clear()
+        get_tile_cache().clear()
+        client = APIClient(HTTP_HOST="tiles.routechoices.dev")
+        url = self.reverse_and_check("tile_service", "/", "tiles")
+        club = Club.objects.create(name="Test club", slug="club")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+        )
+        buffer = BytesIO()
+        Image.new("RGB", (512, 512), (255, 0, 0)).save(buffer, "PNG")
+        raster_map.data_uri = (
+            f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+        )
+        raster_map.save()
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            open_registration=True,
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+        )
+        self.assertGreater(raster_map.render_tiles_pyramid(processes=1), 0)
+        # Already rendered
+        self.assertEqual(raster_map.render_tiles_pyramid(processes=1), 0)
+
+        z = raster_map.max_zoom
+        xs, ys = tiles_covering(raster_map.corners_xy, z)
+        tile_url = (
+            f"{url}?z={z}&x={xs[len(xs) // 2]}&y={ys[len(ys) // 2]}"
+            f"&layers={event.aid}"
+        )
+        res = client.get(f"{tile_url}&format=image%2Fwebp")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["content-type"], "image/webp")
+        self.assertEqual(res.headers["X-Cache-Hit"], "3")
+        # Formats not in the pyramid are transcoded from it
+        res = client.get(f"{tile_url}&format=image%2Favif")
+        self.assertEqual(res.headers["X-Cache-Hit"], "0")
+        res = client.get(f"{tile_url}&format=image%2Favif")
+        self.assertEqual(res.headers["X-Cache-Hit"], "1")
+        # Zoom levels not in the pyramid are rendered on demand
+        xs, ys = tiles_covering(raster_map.corners_xy, z + 1)
+        res = client.get(
+            f"{url}?z={z + 1}&x={xs[len(xs) // 2]}&y={ys[len(ys) // 2]}"
+            f"&layers={event.aid}&format=image%2Fwebp"
+        )
+        self.assertEqual(res.headers["X-Cache-Hit"], "0")
+        # The pyramid is removed with the map
+        map_aid, map_hash = raster_map.aid, raster_map.hash
+        self.assertTrue(has_pyramid(map_aid, map_hash))
+        event.delete()
+        raster_map.delete()
+        self.assertFalse(has_pyramid(map_aid, map_hash))
+
+    def test_serve_map_tile_immutable_url(self):
+        cache.clear()
+        get_tile_cache().clear()
+        client = APIClient(HTTP_HOST="tiles.routechoices.dev")
+        club = Club.objects.create(name="Test club", slug="club")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+        )
+        buffer = BytesIO()
+        Image.new("RGB", (512, 512), (255, 0, 0)).save(buffer, "PNG")
+        raster_map.data_uri = (
+            f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+        )
+        raster_map.save()
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            open_registration=True,
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+        )
+        z = raster_map.max_zoom + 1
+        xs, ys = tiles_covering(raster_map.corners_xy, z)
+        x, y = xs[len(xs) // 2], ys[len(ys) // 2]
+        tiles_url = raster_map.get_tiles_url()
+        self.assertEqual(
+            tiles_url,
+            f"//tiles.routechoices.dev/maps/{raster_map.aid}/{raster_map.hash}/"
+            "{z}/{x}/{y}.webp",
+        )
+        url = tiles_url.format(z=z, x=x, y=y)
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["content-type"], "image/webp")
+        self.assertIn("immutable", res["Cache-Control"])
+        self.assertIn("public", res["Cache-Control"])
+        # The tile is written where nginx serves it from
+        path = public_tile_path(raster_map.aid, raster_map.hash, z, x, y, "image/webp")
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), b"".join(res.streaming_content))
+        # Tiles outside of the map or zoomed in too far are not written
+        for tile_z, tile_x, tile_y in ((z, xs[0] - 2, y), (z + 3, x * 8, y * 8)):
+            res = client.get(tiles_url.format(z=tile_z, x=tile_x, y=tile_y))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertFalse(
+                os.path.exists(
+                    public_tile_path(
+                        raster_map.aid,
+                        raster_map.hash,
+                        tile_z,
+                        tile_x,
+                        tile_y,
+                        "image/webp",
+                    )
+                )
+            )
+
+        # Outdated version of the map
+        res = client.get(url.replace(raster_map.hash, "outdated"))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        # Invalid tile indexes
+        res = client.get(tiles_url.format(z=1, x=2, y=0))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Tiles of pre-rendered pyramid are served by nginx
+        raster_map.render_tiles_pyramid(processes=1)
+        pyramid_z = raster_map.max_zoom
+        xs, ys = tiles_covering(raster_map.corners_xy, pyramid_z)
+        res = client.get(
+            tiles_url.format(z=pyramid_z, x=xs[len(xs) // 2], y=ys[len(ys) // 2])
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res["X-Accel-Redirect"].startswith("/tiles-pyramid/"))
+
+        # Private events tiles need the signed URL
+        event.privacy = PRIVACY_PRIVATE
+        event.save()
+        self.assertFalse(os.path.exists(path))
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        private_url = raster_map.get_tiles_url(private=True).format(z=z, x=x, y=y)
+        res = client.get(private_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn("private", res["Cache-Control"])
+        res = client.get(
+            private_url.replace(raster_map.tiles_signature, "invalidsignature")
+        )
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+        # The least recently used maps tiles are evicted
+        event.privacy = PRIVACY_PUBLIC
+        event.save()
+        client.get(url)
+        evict_public_tiles(2**30)
+        self.assertTrue(os.path.exists(path))
+        evict_public_tiles(0)
+        self.assertFalse(os.path.exists(path))
+        # Tiles are removed once the map is in no public event
+        client.get(url)
+        self.assertTrue(os.path.exists(path))
+        event.delete()
+        self.assertFalse(os.path.exists(path))
+
+    @override_settings(TILES_RENDER_CONCURRENCY=1, TILES_RENDER_QUEUE_TIMEOUT=0)
+    def test_render_busy(self):
+        cache.clear()
+        get_tile_cache().clear()
+        client = APIClient(HTTP_HOST="tiles.routechoices.dev")
+        url = self.reverse_and_check("tile_service", "/", "tiles")
+        club = Club.objects.create(name="Test club", slug="club")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+            width=1,
+            height=1,
+        )
+        raster_map.data_uri = (
+            "data:image/png;base64,"
+            "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAAXNSR0IArs4c6Q"
+            "AAAA1JREFUGFdjED765z8ABZcC1M3x7TQAAAAASUVORK5CYII="
+        )
+        raster_map.save()
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            open_registration=True,
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+        )
+        tile_url = f"{url}?z=17&x=74352&y=36993&layers={event.aid}&format=image%2Fpng"
+        # The only render slot is taken by another worker
+        cache.add(RENDER_SLOT_KEY.format(0), 1, 60)
+        res = client.get(tile_url)
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(res["Retry-After"], "2")
+        self.assertEqual(render_stats()["active"], 1)
+        self.assertEqual(render_stats()["rejected"], 1)
+
+        cache.delete(RENDER_SLOT_KEY.format(0))
+        res = client.get(tile_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(render_stats()["active"], 0)
+        self.assertEqual(render_stats()["queued"], 0)
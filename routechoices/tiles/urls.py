@@ -4,4 +4,18 @@ from routechoices.tiles import views
 
 urlpatterns = [
     re_path(r"^$", views.serve_tile, name="tile_service"),
+    re_path(
+        r"^maps/(?P<map_aid>[-0-9a-zA-Z_]+)/(?P<map_hash>[-0-9a-zA-Z_]+)/"
+        r"(?P<tile_z>\d+)/(?P<tile_x>\d+)/(?P<tile_y>\d+)\."
+        r"(?P<img_ext>png|webp|jpeg|avif|jxl)$",
+        views.serve_map_tile,
+        name="map_tile",
+    ),
+    re_path(
+        r"^private/(?P<signature>[-0-9a-zA-Z_]+)/(?P<map_aid>[-0-9a-zA-Z_]+)/"
+        r"(?P<map_hash>[-0-9a-zA-Z_]+)/(?P<tile_z>\d+)/(?P<tile_x>\d+)/"
+        r"(?P<tile_y>\d+)\.(?P<img_ext>png|webp|jpeg|avif|jxl)$",
+        views.serve_map_tile,
+        name="private_map_tile",
+    ),
 ]
@@ -1,13 +1,39 @@
-from django.http.response import HttpResponseBadRequest
+import os.path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http.response import Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.http import condition
 
-from routechoices.core.models import PRIVACY_PRIVATE, Event
+from routechoices.core.bg_tasks import evict_public_map_tiles
+from routechoices.core.models import PRIVACY_PRIVATE, PYRAMID_TILE, Event, Map
 from routechoices.lib.globalmaptiles import GlobalMercator
 from routechoices.lib.helpers import get_best_image_mime, safe64encodedsha
+from routechoices.lib.map_tiles import (
+    TILE_MIMES,
+    TILE_SIZE,
+    TileRenderBusy,
+    pyramid_tile_path,
+    store_public_tile,
+    tile_bounds,
+)
 from routechoices.lib.slippy_tiles import tile_xy_to_north_west_latlon
 from routechoices.lib.streaming_response import StreamingHttpRangeResponse
 
 GLOBAL_MERCATOR = GlobalMercator()
+MAX_TILE_ZOOM = 24
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def render_busy_response(exception):
+    return HttpResponse(
+        "Too many tiles being rendered, retry later",
+        status=503,
+        headers={"Retry-After": exception.retry_after},
+        content_type="text/plain",
+    )
 
 
 def common_tile(function):
@@ -84,6 +110,7 @@ def common_tile(function):
             "width": out_w,
             "height": out_h,
         }
+        request.tile = {"x": tile_x, "y": tile_y, "z": tile_z}
         request.bound = {
             "min_x": min_x,
             "max_x": max_x,
@@ -119,15 +146,28 @@ def serve_tile(request):
     get_params = {}
     for key in request.GET.keys():
         get_params[key.lower()] = request.GET[key]
-    data_out, cache_hit = request.raster_map.create_tile(
-        request.image_request["width"],
-        request.image_request["height"],
+    data_out = request.raster_map.get_pyramid_tile(
+        request.tile["z"],
+        request.tile["x"],
+        request.tile["y"],
         request.image_request["mime"],
-        request.bound["min_x"],
-        request.bound["max_x"],
-        request.bound["min_y"],
-        request.bound["max_y"],
     )
+    if data_out is not None:
+        cache_hit = PYRAMID_TILE
+    else:
+        try:
+            data_out, cache_hit = request.raster_map.create_tile(
+                request.image_request["width"],
+                request.image_request["height"],
+                request.image_request["mime"],
+                request.bound["min_x"],
+                request.bound["max_x"],
+                request.bound["min_y"],
+                request.bound["max_y"],
+                tile_zxy=(request.tile["z"], request.tile["x"], request.tile["y"]),
+            )
+        except TileRenderBusy as e:
+            return render_busy_response(e)
     headers = {"X-Cache-Hit": cache_hit}
     if request.event.privacy == PRIVACY_PRIVATE:
         headers = {"Cache-Control": "Private"}
@@ -137,3 +177,91 @@ def serve_tile(request):
         content_type=request.image_request["mime"],
         headers=headers,
     )
+
+
+def publish_tile(raster_map, tile_zxy, img_mime, data=None, src_path=None):
+    """
+    Write a tile where nginx serves it from, unless it is outside of the map
+    or zoomed in too far past its resolution, not to let anyone fill the disk
+    """
+    tile_z, tile_x, tile_y = tile_zxy
+    if tile_z > raster_map.max_zoom + settings.TILES_PUBLIC_EXTRA_ZOOMS:
+        return
+    if not raster_map.intersects_with_tile(*tile_bounds(tile_x, tile_y, tile_z)):
+        return
+    store_public_tile(
+        raster_map.aid,
+        raster_map.hash,
+        *tile_zxy,
+        img_mime,
+        data=data,
+        src_path=src_path,
+    )
+    try:
+        if cache.add(
+            "tiles:public:eviction", True, settings.TILES_PUBLIC_EVICTION_INTERVAL
+        ):
+            evict_public_map_tiles(remove_existing_tasks=True)
+    except Exception:
+        pass
+
+
+def serve_map_tile(
+    request, map_aid, map_hash, tile_z, tile_x, tile_y, img_ext, signature=None
+):
+    """
+    Serve a tile of a version of a map, tiles of maps of public events are
+    also written where nginx serves them from for the next requests
+    """
+    tile_z, tile_x, tile_y = int(tile_z), int(tile_x), int(tile_y)
+    if tile_z > MAX_TILE_ZOOM or tile_x >= 2**tile_z or tile_y >= 2**tile_z:
+        return HttpResponseBadRequest("invalid tile indexes")
+    img_mime = TILE_MIMES[img_ext]
+
+    raster_map = get_object_or_404(Map.objects.exclude(image=""), aid=map_aid)
+    if raster_map.hash != map_hash:
+        raise Http404()
+    public = signature is None
+    if public:
+        if not raster_map.has_public_events():
+            raise Http404()
+    elif not constant_time_compare(signature, raster_map.tiles_signature):
+        raise Http404()
+
+    headers = {
+        "Cache-Control": (
+            f"{'public' if public else 'private'}, "
+            f"max-age={IMMUTABLE_MAX_AGE}, immutable"
+        )
+    }
+    tile_zxy = (tile_z, tile_x, tile_y)
+    path = pyramid_tile_path(map_aid, map_hash, *tile_zxy, img_mime)
+    if img_mime in settings.TILES_PYRAMID_MIMES and os.path.exists(path):
+        if public:
+            publish_tile(raster_map, tile_zxy, img_mime, src_path=path)
+        headers["X-Cache-Hit"] = PYRAMID_TILE
+        response = HttpResponse("", content_type=img_mime, headers=headers)
+        response["X-Accel-Redirect"] = (
+            f"/tiles-pyramid/{os.path.relpath(path, settings.TILES_PYRAMID_ROOT)}"
+        )
+        return response
+
+    try:
+        data_out, cache_hit = raster_map.create_tile(
+            TILE_SIZE,
+            TILE_SIZE,
+            img_mime,
+            *tile_bounds(tile_x, tile_y, tile_z),
+            tile_zxy=tile_zxy,
+        )
+    except TileRenderBusy as e:
+        return render_busy_response(e)
+    if public:
+        publish_tile(raster_map, tile_zxy, img_mime, data=data_out)
+    headers["X-Cache-Hit"] = cache_hit
+    return StreamingHttpRangeResponse(
+        request,
+        data_out,
+        content_type=img_mime,
+        headers=headers,
+    )
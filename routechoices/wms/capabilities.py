@@ -0,0 +1,189 @@
+from django.core.cache import cache
+from django.db.models import Prefetch, Q
+from django.template.loader import render_to_string
+from django.utils.timezone import now
+
+from routechoices.core.models import PRIVACY_PUBLIC, Event, MapAssignation
+from routechoices.lib.globalmaptiles import GlobalMercator
+from routechoices.lib.helpers import short_random_key
+
+GLOBAL_MERCATOR = GlobalMercator()
+LAYERS_PLACEHOLDER = "<!-- layers -->"
+CAPABILITIES_VERSION_KEY = "wms:capabilities:version"
+CAPABILITIES_MAX_AGE = 7 * 24 * 3600
+
+
+def capabilities_events(club_slug=None, event_aid=None):
+    events = Event.objects.filter(
+        privacy=PRIVACY_PUBLIC,
+        on_events_page=True,
+    )
+    if club_slug:
+        events = events.filter(club__slug__iexact=club_slug)
+    if event_aid:
+        events = events.filter(aid=event_aid)
+    return events
+
+
+def event_layers(event):
+    if not event.map:
+        return []
+    layers = [
+        {
+            "id": event.aid,
+            "event": event,
+            "title": event.map_title if event.map_title else "Main map",
+            "map": event.map,
+        }
+    ]
+    for count_layer, layer in enumerate(event.map_assignations.all(), start=2):
+        layers.append(
+            {
+                "id": f"{event.aid}/{count_layer}",
+                "event": event,
+                "title": layer.title,
+                "map": layer.map,
+            }
+        )
+    return layers
+
+
+def event_layers_cache_key(event_aid):
+    return f"wms:capabilities:event:{event_aid}"
+
+
+def events_layers_xml(events, event_aids):
+    """
+    Layers of the events in the capabilities document, the ones of the events
+    that did not change since they were last rendered are read from the cache
+    """
+    keys = [event_layers_cache_key(event_aid) for event_aid in event_aids]
+    try:
+        layers_xml = cache.get_many(keys)
+    except Exception:
+        layers_xml = {}
+    missing = [
+        event_aid for event_aid, key in zip(event_aids, keys) if key not in layers_xml
+    ]
+    if missing:
+        events = (
+            events.filter(aid__in=missing)
+            .select_related("club", "map")
+            .prefetch_related(
+                Prefetch(
+                    "map_assignations",
+                    queryset=MapAssignation.objects.select_related("map"),
+                )
+            )
+        )
+        rendered = {
+            event_layers_cache_key(event.aid): render_to_string(
+                "wms/layers.xml", {"layers": event_layers(event)}
+            )
+            for event in events
+        }
+        try:
+            cache.set_many(rendered, CAPABILITIES_MAX_AGE)
+        except Exception:
+            pass
+        layers_xml.update(rendered)
+    return [layers_xml.get(key, "") for key in keys]
+
+
+def capabilities_version():
+    """
+    Random token changed when any layer changes, a lost token is replaced by
+    a new one so the documents of an older token are never served again
+    """
+    version = cache.get(CAPABILITIES_VERSION_KEY)
+    if version is None:
+        cache.add(CAPABILITIES_VERSION_KEY, short_random_key(), None)
+        version = cache.get(CAPABILITIES_VERSION_KEY)
+    return version
+
+
+def capabilities_cache_key(scheme, club_slug=None, event_aid=None):
+    version = capabilities_version()
+    scope = f"club:{club_slug.lower()}" if club_slug else "all"
+    if event_aid:
+        scope = f"{scope}:event:{event_aid}"
+    return f"wms:capabilities:{version}:{scheme}:{scope}"
+
+
+def capabilities_timeout(club_slug=None, event_aid=None):
+    """Seconds until the next event start adds layers to the document"""
+    next_start = (
+        capabilities_events(club_slug, event_aid)
+        .filter(start_date__gt=now())
+        .order_by("start_date")
+        .values_list("start_date", flat=True)
+        .first()
+    )
+    if not next_start:
+        return CAPABILITIES_MAX_AGE
+    return max(1, min(CAPABILITIES_MAX_AGE, (next_start - now()).total_seconds()))
+
+
+def get_cached_capabilities(scheme, club_slug=None, event_aid=None):
+    try:
+        return cache.get(capabilities_cache_key(scheme, club_slug, event_aid))
+    except Exception:
+        return None
+
+
+def stream_capabilities(request, club_slug=None, event_aid=None):
+    """
+    Yield the capabilities document by chunks, the layers of each event being
+    rendered only when it changed, and cache it once complete
+    """
+    cache_key = capabilities_cache_key(request.scheme, club_slug, event_aid)
+    timeout = capabilities_timeout(club_slug, event_aid)
+    max_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": 89.9, "lon": 180})
+    min_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": -89.9, "lon": -180})
+    head, tail = render_to_string(
+        "wms/index.xml",
+        {"min_xy": min_xy, "max_xy": max_xy},
+        request=request,
+    ).split(LAYERS_PLACEHOLDER)
+
+    events = (
+        capabilities_events(club_slug, event_aid)
+        .filter(start_date__lte=now())
+        .exclude(map__isnull=True)
+    )
+    event_aids = list(events.order_by("id").values_list("aid", flat=True))
+    chunks = [head.encode()]
+    yield chunks[-1]
+    for i in range(0, len(event_aids), 200):
+        chunks.append(
+            "".join(events_layers_xml(events, event_aids[i : i + 200])).encode()
+        )
+        yield chunks[-1]
+    chunks.append(tail.encode())
+    yield chunks[-1]
+    try:
+        cache.set(cache_key, b"".join(chunks), timeout)
+    except Exception:
+        pass
+
+
+def invalidate_capabilities(event_aids=()):
+    """
+    Drop the cached layers of the given events and all the cached documents,
+    the documents are rebuilt from the layers of the other events still cached
+    """
+    try:
+        cache.delete_many([event_layers_cache_key(aid) for aid in event_aids])
+        cache.set(CAPABILITIES_VERSION_KEY, short_random_key(), None)
+    except Exception:
+        pass
+
+
+def map_event_aids(raster_map):
+    return list(
+        Event.objects.filter(
+            Q(map_id=raster_map.id) | Q(map_assignations__map_id=raster_map.id)
+        )
+        .values_list("aid", flat=True)
+        .distinct()
+    )
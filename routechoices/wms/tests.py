@@ -1,16 +1,25 @@
+import base64
 import tempfile
+from io import BytesIO
 from pathlib import Path
 
 import arrow
 from django.core.cache import cache
+from PIL import Image
 from rest_framework import status
 from rest_framework.test import APIClient, override_settings
 
 from routechoices.api.tests import EssentialApiBase
-from routechoices.core.models import Club, Event, Map, MapAssignation
+from routechoices.core.bg_tasks import warm_events_tiles
+from routechoices.core.models import PRIVACY_PRIVATE, Club, Event, Map, MapAssignation
+from routechoices.lib.map_tiles import frontend_tiles_plan
+from routechoices.lib.tile_cache import get_tile_cache
 
 
-@override_settings(MEDIA_ROOT=Path(tempfile.gettempdir()))
+@override_settings(
+    MEDIA_ROOT=Path(tempfile.gettempdir()),
+    RASTER_STORE_ROOT=tempfile.mkdtemp(),
+)
 class MapApiTestCase(EssentialApiBase):
     def test_get_tile(self):
         client = APIClient(HTTP_HOST="wms.routechoices.dev")
@@ -195,6 +204,7 @@ class MapApiTestCase(EssentialApiBase):
 
     def test_should_hit_cache(self):
         cache.clear()
+        get_tile_cache().clear()
         client = APIClient(HTTP_HOST="wms.routechoices.dev")
         url = self.reverse_and_check("wms_service", "/", "wms")
         club = Club.objects.create(name="Test club", slug="club")
@@ -268,3 +278,135 @@ class MapApiTestCase(EssentialApiBase):
             f"{base_url}&bbox={non_intersecting_bbox_2}",
         )
         self.assertEqual(res.headers["X-Cache-Hit"], "2")
+
+    def test_warm_tiles(self):
+        cache.clear()
+        get_tile_cache().clear()
+        client = APIClient(HTTP_HOST="wms.routechoices.dev")
+        url = self.reverse_and_check("wms_service", "/", "wms")
+        club = Club.objects.create(name="Test club", slug="club")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+            width=400,
+            height=300,
+        )
+        buffer = BytesIO()
+        Image.new("RGB", (400, 300), "blue").save(buffer, "PNG")
+        raster_map.data_uri = (
+            f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+        )
+        raster_map.save()
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            open_registration=True,
+            start_date=arrow.get().shift(hours=1).datetime,
+            end_date=arrow.get().shift(hours=2).datetime,
+            map=raster_map,
+        )
+        Event.objects.create(
+            club=club,
+            name="Later event",
+            open_registration=True,
+            start_date=arrow.get().shift(days=1).datetime,
+            end_date=arrow.get().shift(days=2).datetime,
+            map=raster_map,
+        )
+        self.assertEqual(warm_events_tiles.now(), {event.aid: 100})
+
+        _, (min_x, max_x, min_y, max_y) = frontend_tiles_plan(
+            raster_map.corners_xy,
+            raster_map.max_zoom,
+            [(1920, 1080), (390, 844)],
+            2,
+        )[-1]
+        # Leaflet computes the bounds with some float noise
+        bbox = f"{min_x + 1e-9},{min_y - 1e-9},{max_x},{max_y}"
+        res = client.get(
+            f"{url}?service=WMS&request=GetMap&layers={event.aid}&styles=&"
+            "format=image%2Fjpeg&transparent=false&version=1.1.1&"
+            f"width=512&height=512&srs=EPSG%3A3857&bbox={bbox}",
+            HTTP_ACCEPT="image/webp",
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["content-type"], "image/webp")
+        self.assertEqual(res.headers["X-Cache-Hit"], "1")
+
+    def test_get_capabilities(self):
+        cache.clear()
+        client = APIClient(HTTP_HOST="wms.routechoices.dev")
+        url = self.reverse_and_check("wms_service", "/", "wms")
+        club = Club.objects.create(name="Test club", slug="club")
+        other_club = Club.objects.create(name="Other club", slug="other")
+        raster_map = Map.objects.create(
+            club=club,
+            name="Test map",
+            corners_coordinates=(
+                "61.45075,24.18994,61.44656,24.24721,"
+                "61.42094,24.23851,61.42533,24.18156"
+            ),
+            width=1,
+            height=1,
+        )
+        event = Event.objects.create(
+            club=club,
+            name="Test event",
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+            on_events_page=True,
+        )
+        other_event = Event.objects.create(
+            club=other_club,
+            name="Other event",
+            start_date=arrow.get().shift(minutes=-1).datetime,
+            end_date=arrow.get().shift(hours=1).datetime,
+            map=raster_map,
+            on_events_page=True,
+        )
+        capabilities_url = f"{url}?service=WMS&request=GetCapabilities"
+
+        res = client.get(capabilities_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.streaming)
+        content = b"".join(res.streaming_content).decode()
+        self.assertIn(f"<Name>{event.aid}</Name>", content)
+        self.assertIn("Main map of Test event by Test club", content)
+        self.assertIn(f"<Name>{other_event.aid}</Name>", content)
+
+        # Served from the cache
+        res = client.get(capabilities_url)
+        self.assertFalse(res.streaming)
+        self.assertEqual(res.content.decode(), content)
+
+        # Rebuilt when an event changes
+        MapAssignation.objects.create(event=event, map=raster_map, title="Course B")
+        res = client.get(capabilities_url)
+        self.assertTrue(res.streaming)
+        content = b"".join(res.streaming_content).decode()
+        self.assertIn(f"<Name>{event.aid}/2</Name>", content)
+        self.assertIn("Course B of Test event by Test club", content)
+
+        club.name = "Renamed club"
+        club.save()
+        res = client.get(capabilities_url)
+        content = b"".join(res.streaming_content).decode()
+        self.assertIn("Main map of Test event by Renamed club", content)
+        self.assertIn("Main map of Other event by Other club", content)
+
+        # Layers of a club only
+        res = client.get(f"{capabilities_url}&club=other")
+        content = b"".join(res.streaming_content).decode()
+        self.assertNotIn(f"<Name>{event.aid}</Name>", content)
+        self.assertIn(f"<Name>{other_event.aid}</Name>", content)
+
+        other_event.privacy = PRIVACY_PRIVATE
+        other_event.save()
+        res = client.get(f"{capabilities_url}&club=other")
+        content = b"".join(res.streaming_content).decode()
+        self.assertNotIn(f"<Name>{other_event.aid}</Name>", content)
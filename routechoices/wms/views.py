@@ -1,20 +1,15 @@
-from django.db.models import Prefetch
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.http.response import HttpResponseBadRequest
-from django.shortcuts import render
-from django.utils.timezone import now
 from django.views.decorators.http import condition
 from rest_framework import status
 
-from routechoices.core.models import (
-    PRIVACY_PRIVATE,
-    PRIVACY_PUBLIC,
-    Event,
-    MapAssignation,
-)
+from routechoices.core.models import PRIVACY_PRIVATE, Event
 from routechoices.lib.globalmaptiles import GlobalMercator
 from routechoices.lib.helpers import get_best_image_mime, safe64encodedsha
+from routechoices.lib.map_tiles import TileRenderBusy
 from routechoices.lib.streaming_response import StreamingHttpRangeResponse
+from routechoices.tiles.views import render_busy_response
+from routechoices.wms.capabilities import get_cached_capabilities, stream_capabilities
 
 GLOBAL_MERCATOR = GlobalMercator()
 
@@ -151,15 +146,18 @@ def wms_service(request):
     for key in request.GET.keys():
         get_params[key.lower()] = request.GET[key]
     if get_params.get("request", "").lower() == "getmap":
-        data_out, cache_hit = request.raster_map.create_tile(
-            request.image_request["width"],
-            request.image_request["height"],
-            request.image_request["mime"],
-            request.bound["min_x"],
-            request.bound["max_x"],
-            request.bound["min_y"],
-            request.bound["max_y"],
-        )
+        try:
+            data_out, cache_hit = request.raster_map.create_tile(
+                request.image_request["width"],
+                request.image_request["height"],
+                request.image_request["mime"],
+                request.bound["min_x"],
+                request.bound["max_x"],
+                request.bound["min_y"],
+                request.bound["max_y"],
+            )
+        except TileRenderBusy as e:
+            return render_busy_response(e)
         headers = {"X-Cache-Hit": cache_hit}
         if request.event.privacy == PRIVACY_PRIVATE:
             headers = {"Cache-Control": "Private"}
@@ -171,50 +169,15 @@ def wms_service(request):
         )
 
     if get_params.get("request", "").lower() == "getcapabilities":
-        max_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": 89.9, "lon": 180})
-        min_xy = GLOBAL_MERCATOR.latlon_to_meters({"lat": -89.9, "lon": -180})
-
-        events = (
-            Event.objects.filter(
-                privacy=PRIVACY_PUBLIC,
-                on_events_page=True,
-            )
-            .filter(start_date__lte=now())
-            .select_related("club", "map")
-            .prefetch_related(
-                Prefetch(
-                    "map_assignations",
-                    queryset=MapAssignation.objects.select_related("map"),
-                )
-            )
-        )
-
-        layers = []
-        for event in events:
-            if event.map:
-                layers.append(
-                    {
-                        "id": event.aid,
-                        "event": event,
-                        "title": event.map_title if event.map_title else "Main map",
-                        "map": event.map,
-                    }
-                )
-                count_layer = 1
-                for layer in event.map_assignations.all():
-                    count_layer += 1
-                    layers.append(
-                        {
-                            "id": f"{event.aid}/{count_layer}",
-                            "event": event,
-                            "title": layer.title,
-                            "map": layer.map,
-                        }
-                    )
-        return render(
-            request,
-            "wms/index.xml",
-            {"layers": layers, "min_xy": min_xy, "max_xy": max_xy},
+        # Vendor parameters to get a smaller document with the layers of a club
+        # or of an event only
+        club_slug = get_params.get("club")
+        event_aid = get_params.get("event")
+        cached = get_cached_capabilities(request.scheme, club_slug, event_aid)
+        if cached:
+            return HttpResponse(cached, content_type="text/xml")
+        return StreamingHttpResponse(
+            stream_capabilities(request, club_slug, event_aid),
             content_type="text/xml",
         )
 